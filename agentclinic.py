@@ -1,16 +1,295 @@
 import argparse
+import copy
 import json
 import os
 import time
-
-import openai
+import uuid
+from dataclasses import dataclass, field
+from typing import Dict, Optional
 
 from agents.DoctorAgent import DoctorAgent
 from agents.MeasurementAgent import MeasurementAgent
 from agents.PatientAgent import PatientAgent
-from agents.SoapAgent import QueryModelChatClient, SoapAgent, SoapAgentConfig
-from utilities.utility import load_huggingface_model, compare_results
+from utilities.utility import load_huggingface_model, compare_results, end_conversation, get_cost_tracker, load_personalities, set_cost_tracker, set_image_cache, set_response_cache
 from utilities.scenario import *
+from utilities.cost_tracker import BudgetExceeded
+from utilities.dialogue_monitor import DialogueMonitor, NUDGE_PROMPT
+
+
+@dataclass
+class ClinicConfig:
+    doctor_llm: str = "gpt4"
+    patient_llm: str = "gpt4"
+    measurement_llm: str = "gpt4"
+    moderator_llm: str = "gpt4"
+    doctor_bias: str = "None"
+    patient_bias: str = "None"
+    dataset: str = "MedQA"
+    inf_type: str = "llm"
+    img_request: bool = False
+    total_inferences: int = 20
+    enable_big5: bool = False
+    # role -> "O,C,E,A,N"; roles without an entry get no personality
+    personalities: Dict[str, str] = field(default_factory=dict)
+    # persona card file for the doctor, None to use personalities["doctor"]
+    doctor_persona_json: Optional[str] = "agent_personas/doc_pos.json"
+    # also give the moderator its personality when grading
+    moderator_persona: bool = False
+    generate_soap_note: bool = False
+    soap_llm: str = "gpt4"
+    # draft S/O during the dialogue, finalize only A/P at the end
+    soap_incremental: bool = False
+    # LLM delta update of the draft every N turns (at least 1 with soap_incremental)
+    soap_delta_every: int = 4
+    # "structured" (validated models.NotePayload) or "text"
+    soap_format: str = "text"
+    # pause between turns to prevent API timeouts
+    turn_delay: float = 1.0
+    # when the doctor keeps repeating itself: "none", "nudge" towards a diagnosis or ask the "final" question early
+    stall_action: str = "none"
+    # answer repeated test requests with the earlier result instead of a measurement call
+    reuse_test_results: bool = False
+    # n-gram overlap with a recent doctor turn that counts as a repeat, and repeats in a row that make a stall
+    stall_threshold: float = 0.6
+    stall_patience: int = 2
+
+
+def set_api_keys(cfg: ClinicConfig, api_key=None, replicate_api_key=None, anthropic_api_key=None):
+    # Reading secret keys
+    if api_key is not None:
+        import openai
+        openai.api_key = api_key
+    anthropic_llms = ["claude3.5sonnet"]
+    replicate_llms = ["llama-3-70b-instruct", "llama-2-70b-chat", "mixtral-8x7b"]
+    if cfg.patient_llm in replicate_llms or cfg.doctor_llm in replicate_llms:
+        os.environ["REPLICATE_API_TOKEN"] = replicate_api_key
+    if cfg.doctor_llm in anthropic_llms:
+        os.environ["ANTHROPIC_API_KEY"] = anthropic_api_key
+    if cfg.generate_soap_note and cfg.soap_llm in replicate_llms:
+        os.environ["REPLICATE_API_TOKEN"] = replicate_api_key
+    if cfg.generate_soap_note and cfg.soap_llm in anthropic_llms:
+        os.environ["ANTHROPIC_API_KEY"] = anthropic_api_key
+
+
+def build_agents(cfg: ClinicConfig, scenario):
+    personalities = cfg.personalities if cfg.enable_big5 else {}
+    meas_agent = MeasurementAgent(
+        scenario=scenario,
+        backend_str=cfg.measurement_llm,
+        big5_enabled=cfg.enable_big5,
+        personality=personalities.get("measurement", ""),)
+    patient_agent = PatientAgent(
+        scenario=scenario,
+        bias_present=cfg.patient_bias,
+        backend_str=cfg.patient_llm,
+        big5_enabled=cfg.enable_big5,
+        personality=personalities.get("patient", ""))
+    doctor_agent = DoctorAgent(
+        scenario=scenario,
+        bias_present=cfg.doctor_bias,
+        backend_str=cfg.doctor_llm,
+        max_infs=cfg.total_inferences,
+        img_request=cfg.img_request,
+        big5_enabled=cfg.enable_big5,
+        personality=personalities.get("doctor", ""),
+        persona_json=cfg.doctor_persona_json)
+    return doctor_agent, patient_agent, meas_agent
+
+
+def objective_cache(scenario) -> dict:
+    try:
+        exam_info = scenario.exam_information()
+    except Exception:
+        exam_info = None
+    return {
+        "patient_information": scenario.patient_information(),
+        "exam_information": exam_info,
+        "examiner_information": getattr(scenario, "examiner_information", lambda: "")(),
+    }
+
+
+@dataclass
+class DialogueSnapshot:
+    """State of a dialogue after `turns` doctor turns, from run_scenario(..., snapshot_at=turns)."""
+    scenario_id: int
+    turns: int
+    pi_dialogue: str
+    doctor_dialogue: str
+    transcript: list
+    soap_turn: int
+    # role -> agent.snapshot()
+    agents: Dict[str, dict]
+    monitor: Optional[DialogueMonitor] = None
+    stalled: bool = False
+
+
+def run_scenario(cfg: ClinicConfig, scenario_id, scenario_loader=None, pipe=None, verbose=True,
+                 snapshot_at=None, fork_from: Optional[DialogueSnapshot] = None) -> dict:
+    """
+    Simulate one scenario and grade the diagnosis. Returns a summary dict with
+    scenario_id, correct (None if no diagnosis was made), turns, diagnosis and,
+    when enabled, the SOAP note and the per-role "cost". "transcript" holds [turn, role, text] lines
+    for offline SOAP generation and the results database.
+    With `snapshot_at=k` the dialogue stops after k doctor turns and result["snapshot"] holds its
+    state (unless it ended earlier); `fork_from` continues such a snapshot with the agents of `cfg`.
+    """
+    log = print if verbose else (lambda *args, **kwargs: None)
+    if scenario_loader is None:
+        scenario_loader = get_scenario_loader(cfg.dataset)
+    pi_dialogue = str()
+
+    # Initialize scenarios (MedQA/NEJM)
+    scenario = scenario_loader.get_scenario(id=scenario_id)
+    cost_tracker = get_cost_tracker()
+    if cost_tracker is not None:
+        cost_tracker.start_scope()
+    soap_agent = None
+    try:
+        soap_turn = 1
+        if cfg.generate_soap_note:
+            from agents.SoapAgent import QueryModelChatClient, SoapAgent, SoapAgentConfig
+            soap_agent = SoapAgent(
+                llm_client=QueryModelChatClient(cfg.soap_llm),
+                scenario=scenario,
+                config=SoapAgentConfig(incremental=cfg.soap_incremental, delta_every=cfg.soap_delta_every,
+                                       structured=cfg.soap_format == "structured"),
+                enable_big5=cfg.enable_big5,
+            )
+            soap_agent.objective_cache = objective_cache(scenario)
+
+        # Initialize agents
+        doctor_agent, patient_agent, meas_agent = build_agents(cfg, scenario)
+        # one key per agent dialogue, lets local models keep its KV cache between turns
+        conversation = "{}:{}".format(scenario_id, uuid.uuid4().hex)
+        agents = {"doctor": doctor_agent, "patient": patient_agent, "measurement": meas_agent}
+        for role, agent in agents.items():
+            agent.conversation_id = "{}:{}".format(conversation, role)
+
+        result = {"scenario_id": scenario_id, "correct": None, "turns": 0, "diagnosis": None, "grade": None,
+                  "correct_diagnosis": scenario.diagnosis_information(), "transcript": []}
+        doctor_dialogue = ""
+        total_inferences = cfg.total_inferences
+        monitor = None
+        if cfg.stall_action != "none" or cfg.reuse_test_results:
+            monitor = DialogueMonitor(threshold=cfg.stall_threshold, patience=cfg.stall_patience)
+        stalled = final_forced = False
+        first_turn = 0
+        if fork_from is not None:
+            # continue the shared prefix with this config's agents
+            for role, agent in agents.items():
+                agent.restore(fork_from.agents[role])
+            pi_dialogue, doctor_dialogue = fork_from.pi_dialogue, fork_from.doctor_dialogue
+            result["transcript"] = [list(line) for line in fork_from.transcript]
+            soap_turn = fork_from.soap_turn
+            if soap_agent:
+                for turn, role, text in result["transcript"]:
+                    soap_agent.observe(role, text, turn)
+            if monitor is not None and fork_from.monitor is not None:
+                monitor = copy.deepcopy(fork_from.monitor)
+                stalled = fork_from.stalled
+            first_turn = result["turns"] = fork_from.turns
+        try:
+            for _inf_id in range(first_turn, total_inferences):
+                result["turns"] = _inf_id + 1
+                # Check for medical image request
+                if cfg.dataset == "NEJM":
+                    if cfg.img_request:
+                        imgs = "REQUEST IMAGES" in doctor_dialogue
+                    else: imgs = True
+                else: imgs = False
+
+                # Check if final inference
+                if stalled and cfg.stall_action == "final":
+                    final_forced = True
+                if _inf_id == total_inferences - 1 or final_forced:
+                    pi_dialogue += "This is the final question. Please provide a diagnosis.\n"
+                elif stalled and cfg.stall_action == "nudge":
+                    pi_dialogue += NUDGE_PROMPT
+
+                # Obtain doctor dialogue (human or llm agent)
+                if cfg.inf_type == "human_doctor":
+                    doctor_dialogue = input("\nQuestion for patient: ")
+                else:
+                    doctor_dialogue = doctor_agent.inference_doctor(pi_dialogue, image_requested=imgs)
+                log("Doctor [{}%]:".format(int(((_inf_id+1)/total_inferences)*100)), doctor_dialogue)
+                result["transcript"].append([soap_turn, "Doctor", doctor_dialogue])
+                if soap_agent:
+                    soap_agent.observe("Doctor", doctor_dialogue, soap_turn)
+                soap_turn += 1
+                if monitor is not None:
+                    stalled = monitor.observe_doctor(doctor_dialogue)
+                    if stalled:
+                        log("[stall] doctor is repeating itself, action: {}".format(cfg.stall_action))
+
+                # Doctor has arrived at a diagnosis, check correctness
+                if "DIAGNOSIS READY" in doctor_dialogue:
+                    moderator_personality = cfg.personalities.get("moderator", "") if cfg.enable_big5 and cfg.moderator_persona else ""
+                    grade = compare_results(doctor_dialogue, scenario.diagnosis_information(), cfg.moderator_llm, pipe, moderator_personality)
+                    result["correct"] = grade == "yes"
+                    result["grade"] = grade
+                    result["diagnosis"] = doctor_dialogue
+                    log("\nCorrect answer:", scenario.diagnosis_information())
+                    break
+                # Obtain medical exam from measurement reader
+                if "REQUEST TEST" in doctor_dialogue:
+                    reused = monitor.cached_result(doctor_dialogue) if monitor is not None and cfg.reuse_test_results else None
+                    if reused is not None:
+                        pi_dialogue = reused
+                        meas_agent.add_hist(doctor_dialogue + "\n\n" + pi_dialogue)
+                    else:
+                        pi_dialogue = meas_agent.inference_measurement(doctor_dialogue,)
+                        if monitor is not None:
+                            monitor.record_test(doctor_dialogue, pi_dialogue)
+                    log("Measurement [{}%]{}:".format(int(((_inf_id+1)/total_inferences)*100), " (earlier result)" if reused is not None else ""), pi_dialogue)
+                    patient_agent.add_hist(pi_dialogue)
+                    result["transcript"].append([soap_turn, "Measurement", pi_dialogue])
+                    if soap_agent:
+                        soap_agent.observe("Measurement", pi_dialogue, soap_turn)
+                    soap_turn += 1
+                # Obtain response from patient
+                else:
+                    if cfg.inf_type == "human_patient":
+                        pi_dialogue = input("\nResponse to doctor: ")
+                    else:
+                        pi_dialogue = patient_agent.inference_patient(doctor_dialogue)
+                    log("Patient [{}%]:".format(int(((_inf_id+1)/total_inferences)*100)), pi_dialogue)
+                    meas_agent.add_hist(pi_dialogue)
+                    result["transcript"].append([soap_turn, "Patient", pi_dialogue])
+                    if soap_agent:
+                        soap_agent.observe("Patient", pi_dialogue, soap_turn)
+                    soap_turn += 1
+                if final_forced:
+                    break
+                if snapshot_at is not None and _inf_id + 1 >= snapshot_at:
+                    result["snapshot"] = DialogueSnapshot(
+                        scenario_id=scenario_id, turns=_inf_id + 1, pi_dialogue=pi_dialogue, doctor_dialogue=doctor_dialogue,
+                        transcript=[list(line) for line in result["transcript"]], soap_turn=soap_turn,
+                        agents={role: agent.snapshot() for role, agent in agents.items()},
+                        monitor=copy.deepcopy(monitor), stalled=stalled)
+                    break
+                # Prevent API timeouts
+                time.sleep(cfg.turn_delay)
+        finally:
+            # local models drop the conversations' KV caches
+            for agent in agents.values():
+                end_conversation(agent.conversation_id)
+
+        if soap_agent and soap_turn > 1 and "snapshot" not in result:
+            turn_range = (1, soap_turn - 1)
+            result["soap_note"] = soap_agent.generate(turn_range)
+        if monitor is not None:
+            result["stall_events"] = monitor.stall_events
+            result["tests_reused"] = monitor.tests_reused
+    finally:
+        # also when the dialogue stopped at a snapshot or failed
+        if soap_agent is not None:
+            soap_agent.close()
+        # a failed or aborted scenario still counts toward the budget projection
+        scenario_cost = cost_tracker.end_scope() if cost_tracker is not None else None
+    if scenario_cost is not None:
+        result["cost"] = scenario_cost
+    return result
+
 
 def main(api_key,
          replicate_api_key,
@@ -30,163 +309,153 @@ def main(api_key,
          anthropic_api_key=None,
          generate_soap_note=False,
          soap_llm="gpt4",
-         soap_note_dir="soap_notes"):
+         soap_note_dir="soap_notes",
+         response_cache=None,
+         soap_incremental=False,
+         soap_delta_every=4,
+         soap_format="text",
+         save_transcripts=False,
+         hf_max_batch_size=8,
+         hf_batch_window_ms=20.0,
+         hf_max_conversations=0,
+         hf_quantize="none",
+         hf_threads=None,
+         results_db="results.sqlite",
+         budget=None,
+         budget_abort=False,
+         price_table=None,
+         cost_report="cost_report.json",
+         stall_action="none",
+         reuse_test_results=False,
+         metrics_port=None,
+         status_file=None,
+         status_interval=15.0,
+         image_cache="image_cache",
+         offline_images=None,
+         image_max_side=None):
 
-    # Reading secret keys
-    openai.api_key = api_key
-    anthropic_llms = ["claude3.5sonnet"]
-    replicate_llms = ["llama-3-70b-instruct", "llama-2-70b-chat", "mixtral-8x7b"]
-    if patient_llm in replicate_llms or doctor_llm in replicate_llms:
-        os.environ["REPLICATE_API_TOKEN"] = replicate_api_key
-    if doctor_llm in anthropic_llms:
-        os.environ["ANTHROPIC_API_KEY"] = anthropic_api_key
-    if generate_soap_note and soap_llm in replicate_llms:
-        os.environ["REPLICATE_API_TOKEN"] = replicate_api_key
-    if generate_soap_note and soap_llm in anthropic_llms:
-        os.environ["ANTHROPIC_API_KEY"] = anthropic_api_key
+    cfg = ClinicConfig(
+        doctor_llm=doctor_llm,
+        patient_llm=patient_llm,
+        measurement_llm=measurement_llm,
+        moderator_llm=moderator_llm,
+        doctor_bias=doctor_bias,
+        patient_bias=patient_bias,
+        dataset=dataset,
+        inf_type=inf_type,
+        img_request=img_request,
+        total_inferences=total_inferences,
+        enable_big5=enable_big5,
+        generate_soap_note=generate_soap_note,
+        soap_llm=soap_llm,
+        soap_incremental=soap_incremental,
+        soap_delta_every=soap_delta_every,
+        soap_format=soap_format,
+        stall_action=stall_action,
+        reuse_test_results=reuse_test_results,
+    )
+    set_api_keys(cfg, api_key, replicate_api_key, anthropic_api_key)
+    if response_cache:
+        from utilities.response_cache import ResponseCache
+        set_response_cache(ResponseCache(response_cache))
+    cost_tracker = None
+    if budget is not None or cost_report:
+        from utilities.cost_tracker import CostTracker
+        cost_tracker = (CostTracker.from_price_table(price_table, budget=budget, abort_in_flight=budget_abort)
+                        if price_table else CostTracker(budget=budget, abort_in_flight=budget_abort))
+        set_cost_tracker(cost_tracker)
 
     # Load MedQA, MIMICIV or NEJM agent case scenarios
-    if dataset == "MedQA":
-        scenario_loader = ScenarioLoaderMedQA()
-    elif dataset == "MedQA_Ext":
-        scenario_loader = ScenarioLoaderMedQAExtended()
-    elif dataset == "NEJM":
-        scenario_loader = ScenarioLoaderNEJM()
-    elif dataset == "NEJM_Ext":
-        scenario_loader = ScenarioLoaderNEJMExtended()
-    elif dataset == "MIMICIV":
-        scenario_loader = ScenarioLoaderMIMICIV()
-    else:
-        raise Exception("Dataset {} does not exist".format(str(dataset)))
+    scenario_loader = get_scenario_loader(dataset)
     total_correct = 0
     total_presents = 0
 
-    doctor_personality = patient_personality = measurement_personality = moderator_personality = ''
     # Big 5 config
     if enable_big5:
-        with open('IPIP-BIG5/personalities_config.json', 'r') as f:
-            personalities = json.load(f)
-            doctor_personality = f"{personalities['doctor']['openness']},{personalities['doctor']['conscientiousness']},{personalities['doctor']['extraversion']},{personalities['doctor']['agreeableness']},{personalities['doctor']['neuroticism']}"
-            patient_personality = f"{personalities['patient']['openness']},{personalities['patient']['conscientiousness']},{personalities['patient']['extraversion']},{personalities['patient']['agreeableness']},{personalities['patient']['neuroticism']}"
-            measurement_personality = f"{personalities['measurement']['openness']},{personalities['measurement']['conscientiousness']},{personalities['measurement']['extraversion']},{personalities['measurement']['agreeableness']},{personalities['measurement']['neuroticism']}"
-            moderator_personality = f"{personalities['moderator']['openness']},{personalities['moderator']['conscientiousness']},{personalities['moderator']['extraversion']},{personalities['moderator']['agreeableness']},{personalities['moderator']['neuroticism']}"
-
-    # Pipeline for huggingface models
+        cfg.personalities = load_personalities('IPIP-BIG5/personalities_config.json')
+
+    # Local huggingface models are served by one batching queue per model
+    if any(llm.startswith("HF_") for llm in (doctor_llm, patient_llm, measurement_llm, moderator_llm, soap_llm)):
+        from utilities.local_backend import configure_local_backend
+        configure_local_backend(hf_max_batch_size, hf_batch_window_ms, hf_max_conversations, hf_quantize, hf_threads)
     if "HF_" in moderator_llm:
         pipe = load_huggingface_model(moderator_llm.replace("HF_", ""))
     else:
         pipe = None
+    if evaluate_doctor:
+        doctor_agent, _, _ = build_agents(cfg, scenario_loader.get_scenario(id=0))
+        print(doctor_agent.take_test(question_set=120, sex="N", age=55))
+        return
     if num_scenarios is None: num_scenarios = scenario_loader.num_scenarios
-    if generate_soap_note:
+    note_store = None
+    from utilities.results_db import new_run_id
+    run_id = new_run_id()
+    results = None
+    if results_db:
+        from utilities.results_db import ResultsDB
+        results = ResultsDB(results_db)
+        results.add_run(run_id, cfg)
+    if generate_soap_note or save_transcripts:
         os.makedirs(soap_note_dir, exist_ok=True)
-    for _scenario_id in range(0, min(num_scenarios, scenario_loader.num_scenarios)):
-        total_presents += 1
-        pi_dialogue = str()
-
-        # Initialize scenarios (MedQA/NEJM)
-        scenario =  scenario_loader.get_scenario(id=_scenario_id)
-        soap_agent = None
-        soap_turn = 1
-        if generate_soap_note:
-            soap_agent = SoapAgent(
-                llm_client=QueryModelChatClient(soap_llm),
-                scenario=scenario,
-                config=SoapAgentConfig(),
-                enable_big5=enable_big5,
-            )
-            try:
-                exam_info = scenario.exam_information()
-            except Exception:
-                exam_info = None
-            soap_agent.objective_cache = {
-                "patient_information": scenario.patient_information(),
-                "exam_information": exam_info,
-                "examiner_information": getattr(scenario, "examiner_information", lambda: "")(),
-            }
-
-        # Initialize agents
-        meas_agent = MeasurementAgent(
-            scenario=scenario,
-            backend_str=measurement_llm,
-            big5_enabled=enable_big5,
-            personality=measurement_personality,)
-        patient_agent = PatientAgent(
-            scenario=scenario, 
-            bias_present=patient_bias,
-            backend_str=patient_llm,
-            big5_enabled=enable_big5,
-            personality=patient_personality)
-        doctor_agent = DoctorAgent(
-            scenario=scenario, 
-            bias_present=doctor_bias,
-            backend_str=doctor_llm,
-            max_infs=total_inferences, 
-            img_request=img_request,
-            big5_enabled=enable_big5,
-            personality=doctor_personality)
-
-        doctor_dialogue = ""
-        if evaluate_doctor:
-            print(doctor_agent.take_test(question_set=120, sex="N", age=55))
+        if soap_format == "structured" or save_transcripts:
+            from utilities.note_store import NoteStore
+            note_store = NoteStore(os.path.join(soap_note_dir, "notes.sqlite"))
+    stopped_by_budget = False
+    num_scenarios = min(num_scenarios, scenario_loader.num_scenarios)
+    # NEJM cases come with an image: fetch each one once and send it inline from disk
+    if dataset.startswith("NEJM") and (image_cache or offline_images):
+        from utilities.image_cache import ImageCache
+        images = ImageCache(image_cache or offline_images, offline_dir=offline_images, max_side=image_max_side)
+        images.prefetch(scenario_loader.get_scenario(id=i).image_url for i in range(num_scenarios))
+        set_image_cache(images)
+    metrics = None
+    if metrics_port or status_file:
+        from utilities.metrics import start_metrics
+        metrics = start_metrics(metrics_port, status_file, status_interval, num_scenarios)
+    for _scenario_id in range(0, num_scenarios):
+        if cost_tracker is not None and cost_tracker.should_stop():
+            print("Budget of ${:.2f} reached (${:.2f} spent), not starting scenario {}".format(budget, cost_tracker.spent, _scenario_id))
+            stopped_by_budget = True
             break
-        for _inf_id in range(total_inferences):
-            # Check for medical image request
-            if dataset == "NEJM":
-                if img_request:
-                    imgs = "REQUEST IMAGES" in doctor_dialogue
-                else: imgs = True
-            else: imgs = False
-
-            # Check if final inference
-            if _inf_id == total_inferences - 1:
-                pi_dialogue += "This is the final question. Please provide a diagnosis.\n"
-
-            # Obtain doctor dialogue (human or llm agent)
-            if inf_type == "human_doctor":
-                doctor_dialogue = input("\nQuestion for patient: ")
-            else: 
-                doctor_dialogue = doctor_agent.inference_doctor(pi_dialogue, image_requested=imgs)
-            print("Doctor [{}%]:".format(int(((_inf_id+1)/total_inferences)*100)), doctor_dialogue)
-            if soap_agent:
-                soap_agent.observe("Doctor", doctor_dialogue, soap_turn)
-                soap_turn += 1
-
-            # Doctor has arrived at a diagnosis, check correctness
-            if "DIAGNOSIS READY" in doctor_dialogue:
-                correctness = compare_results(doctor_dialogue, scenario.diagnosis_information(), moderator_llm, pipe) == "yes"
-                if correctness: total_correct += 1
-                print("\nCorrect answer:", scenario.diagnosis_information())
-                print("Scene {}, The diagnosis was ".format(_scenario_id), "CORRECT" if correctness else "INCORRECT", int((total_correct/total_presents)*100))
-                break
-            # Obtain medical exam from measurement reader
-            if "REQUEST TEST" in doctor_dialogue:
-                pi_dialogue = meas_agent.inference_measurement(doctor_dialogue,)
-                print("Measurement [{}%]:".format(int(((_inf_id+1)/total_inferences)*100)), pi_dialogue)
-                patient_agent.add_hist(pi_dialogue)
-                if soap_agent:
-                    soap_agent.observe("Measurement", pi_dialogue, soap_turn)
-                    soap_turn += 1
-            # Obtain response from patient
-            else:
-                if inf_type == "human_patient":
-                    pi_dialogue = input("\nResponse to doctor: ")
-                else:
-                    pi_dialogue = patient_agent.inference_patient(doctor_dialogue)
-                print("Patient [{}%]:".format(int(((_inf_id+1)/total_inferences)*100)), pi_dialogue)
-                meas_agent.add_hist(pi_dialogue)
-                if soap_agent:
-                    soap_agent.observe("Patient", pi_dialogue, soap_turn)
-                    soap_turn += 1
-            # Prevent API timeouts
-            time.sleep(1.0)
+        if metrics is not None:
+            metrics.scenario_started()
+        result = None
+        try:
+            result = run_scenario(cfg, _scenario_id, scenario_loader, pipe)
+        except BudgetExceeded as e:
+            # the aborted scenario is left out, everything written so far stays valid
+            print("{}, aborted scenario {}".format(e, _scenario_id))
+            stopped_by_budget = True
+            break
+        finally:
+            if metrics is not None:
+                metrics.scenario_finished(result)
+        total_presents += 1
+        if result["correct"] is not None:
+            if result["correct"]: total_correct += 1
+            print("Scene {}, The diagnosis was ".format(_scenario_id), "CORRECT" if result["correct"] else "INCORRECT", int((total_correct/total_presents)*100))
+        if results is not None:
+            results.add_scenario(run_id, result)
 
-        if soap_agent and soap_turn > 1:
-            turn_range = (1, soap_turn - 1)
-            soap_note = soap_agent.generate(turn_range)
+        if save_transcripts:
+            note_store.add_transcript(result["transcript"], run_id=run_id, scenario_id=_scenario_id, dataset=dataset,
+                                      doctor_llm=doctor_llm,
+                                      objective_cache=objective_cache(scenario_loader.get_scenario(id=_scenario_id)))
+        if "soap_note" in result and soap_format == "structured":
+            note_store.add(result["soap_note"], run_id=run_id, scenario_id=_scenario_id, dataset=dataset,
+                           doctor_llm=doctor_llm, soap_llm=soap_llm)
+            print(f"SOAP note saved to {note_store.path} (run {run_id})")
+        elif "soap_note" in result:
             note_path = os.path.join(soap_note_dir, f"scenario_{_scenario_id}_soap.txt")
             with open(note_path, "w", encoding="utf-8") as f:
-                json.dump(soap_note, f, indent=2, ensure_ascii=False)
+                json.dump(result["soap_note"], f, indent=2, ensure_ascii=False)
             print(f"SOAP note saved to {note_path}")
+    if metrics is not None:
+        metrics.close()
+    if cost_tracker is not None:
+        print("Spent ${:.4f} on {} calls ({} served from cache)".format(cost_tracker.spent, cost_tracker.total["calls"], cost_tracker.total["cached_calls"]))
+        if cost_report:
+            cost_tracker.write_report(cost_report, run_id=run_id, scenarios_completed=total_presents, stopped_by_budget=stopped_by_budget)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Medical Diagnosis Simulation CLI')
@@ -204,6 +473,27 @@ if __name__ == "__main__":
     parser.add_argument('--num_scenarios', type=int, default=None, required=False, help='Number of scenarios to simulate')
     parser.add_argument('--total_inferences', type=int, default=20, required=False, help='Number of inferences between patient and doctor')
     parser.add_argument('--anthropic_api_key', type=str, default=None, required=False, help='Anthropic API key for Claude 3.5 Sonnet')
+    parser.add_argument('--response_cache', type=str, default=None, required=False, help='SQLite file used to cache and replay backend responses')
+    parser.add_argument('--results_db', type=str, default='results.sqlite', help='SQLite database of runs, scenarios, turns and test requests ("" to disable)')
+    parser.add_argument('--stall_action', type=str, choices=['none', 'nudge', 'final'], default='none', help='What to do when the doctor keeps repeating questions or tests: nudge it towards a diagnosis or ask the final question early')
+    parser.add_argument('--reuse_test_results', action='store_true', help='Answer repeated test requests with the earlier result instead of calling the measurement agent')
+    parser.add_argument('--budget', type=float, default=None, help='Stop starting new scenarios once the projected spend (USD) reaches this')
+    parser.add_argument('--budget_abort', action='store_true', help='Also abort the running scenario once the budget is spent')
+    parser.add_argument('--price_table', type=str, default=None, help='JSON {model: [usd_per_1M_prompt, usd_per_1M_completion]} overriding the built-in prices')
+    parser.add_argument('--cost_report', type=str, default='cost_report.json', help='Token and cost summary written at the end of the run ("" to disable)')
+    parser.add_argument('--image_cache', type=str, default='image_cache', help='Directory where NEJM images are downloaded once and sent inline from ("" to let the provider fetch the URL every turn)')
+    parser.add_argument('--offline_images', type=str, default=None, help='Serve NEJM images only from this directory (an earlier --image_cache or files named <image id>.jpg), no downloads')
+    parser.add_argument('--image_max_side', type=int, default=None, help='Downscale cached images to this long side (default: per-model limit, 0 = original size; needs Pillow)')
+    parser.add_argument('--metrics_port', type=int, default=None, help='Serve live progress and backend metrics in Prometheus format on this local port')
+    parser.add_argument('--status_file', type=str, default=None, help='JSON file rewritten with the same live metrics every --status_interval seconds')
+    parser.add_argument('--status_interval', type=float, default=15.0)
+    parser.add_argument('--profile', type=str, nargs='?', const='spans', default=None, choices=['spans', 'cprofile', 'sample'], help='Time main, the agents and query_model (wall vs CPU), optionally with cProfile or stack sampling; output in --profile_dir')
+    parser.add_argument('--profile_dir', type=str, default='profiles', help='Profile output, one sub-directory per run')
+    parser.add_argument('--hf_max_batch_size', type=int, default=8, help='Max prompts per generate call for local HF_ models')
+    parser.add_argument('--hf_batch_window_ms', type=float, default=20.0, help='How long a local HF_ model waits to fill a batch')
+    parser.add_argument('--hf_max_conversations', type=int, default=0, help='Agent dialogues whose KV cache a local HF_ model keeps between turns (default 0: off, cached dialogues are not batched)')
+    parser.add_argument('--hf_quantize', type=str, choices=['none', 'int8', 'int4'], default='none', help='Weight quantization for local HF_ models on CPU (int4 needs optimum-quanto)')
+    parser.add_argument('--hf_threads', type=int, default=None, help='CPU threads used by local HF_ models')
 
     # BIG-5 args
     parser.add_argument('--enable_big5', type=bool, default=False, required=False, help='Enable Big5 diagnosis')
@@ -211,6 +501,22 @@ if __name__ == "__main__":
     parser.add_argument('--generate_soap_note', action='store_true', help='Generate a SOAP note after each scenario')
     parser.add_argument('--soap_llm', type=str, default='gpt4', help='LLM backend for SOAP note generation')
     parser.add_argument('--soap_note_dir', type=str, default='soap_notes', help='Directory to store SOAP notes')
+    parser.add_argument('--soap_format', type=str, choices=['structured', 'text'], default='text', help='structured: validated notes in <soap_note_dir>/notes.sqlite; text: one file per scenario')
+    parser.add_argument('--save_transcripts', action='store_true', help='Store dialogue transcripts in <soap_note_dir>/notes.sqlite for offline SOAP generation (soap_batch.py)')
+    parser.add_argument('--soap_incremental', action='store_true', help='Draft the S/O sections during the dialogue and only finalize A/P at the end')
+    parser.add_argument('--soap_delta_every', type=int, default=4, help='With --soap_incremental, refresh the S/O draft with a small LLM call every N turns')
     args = parser.parse_args()
 
-    main(args.openai_api_key, args.replicate_api_key, args.inf_type, args.doctor_bias, args.patient_bias, args.doctor_llm, args.patient_llm, args.measurement_llm, args.moderator_llm, args.num_scenarios, args.agent_dataset, args.doctor_image_request, args.total_inferences, args.enable_big5, args.evaluate_doctor, args.anthropic_api_key, args.generate_soap_note, args.soap_llm, args.soap_note_dir)
+    profiler = None
+    if args.profile:
+        from utilities.profiler import Profiler
+        profiler = Profiler(args.profile)
+        profiler.install(globals())
+    try:
+        main(args.openai_api_key, args.replicate_api_key, args.inf_type, args.doctor_bias, args.patient_bias, args.doctor_llm, args.patient_llm, args.measurement_llm, args.moderator_llm, args.num_scenarios, args.agent_dataset, args.doctor_image_request, args.total_inferences, args.enable_big5, args.evaluate_doctor, args.anthropic_api_key, args.generate_soap_note, args.soap_llm, args.soap_note_dir, args.response_cache, args.soap_incremental, args.soap_delta_every, args.soap_format, args.save_transcripts, args.hf_max_batch_size, args.hf_batch_window_ms, args.hf_max_conversations, args.hf_quantize, args.hf_threads, args.results_db, args.budget, args.budget_abort, args.price_table, args.cost_report, args.stall_action, args.reuse_test_results, args.metrics_port, args.status_file, args.status_interval, args.image_cache, args.offline_images, args.image_max_side)
+    finally:
+        if profiler is not None:
+            profiler.uninstall()
+            out_dir = profiler.dump(os.path.join(args.profile_dir, time.strftime("%Y%m%d-%H%M%S")))
+            print(profiler.report())
+            print("Profile written to {}".format(out_dir))
@@ -1,8 +1,8 @@
-from utilities.utility import query_model, parse_big5, persona_card, persona_card_from_json
+from utilities.utility import kv_reuse, query_model, parse_big5, persona_card, persona_card_from_json
 
 
 class DoctorAgent:
-    def __init__(self, scenario, backend_str="gpt4", max_infs=20, bias_present=None, img_request=False, big5_enabled=False, personality="") -> None:
+    def __init__(self, scenario, backend_str="gpt4", max_infs=20, bias_present=None, img_request=False, big5_enabled=False, personality="", persona_json="agent_personas/doc_pos.json") -> None:
         # number of inference calls to the doctor
         self.infs = 0
         # maximum number of inference calls to the doctor
@@ -19,6 +19,10 @@ class DoctorAgent:
         self.scenario = scenario
         self.big5_enabled = big5_enabled
         self.personality = personality
+        # persona card file; None builds the card from the O,C,E,A,N `personality` string
+        self.persona_json = persona_json
+        # key under which a local backend may keep this dialogue's KV cache
+        self.conversation_id = None
         self.reset()
         self.pipe = None
         self.img_request = img_request
@@ -63,22 +67,29 @@ class DoctorAgent:
     def inference_doctor(self, question, image_requested=False, test_mode=False) -> str:
         answer = str()
         if self.infs >= self.MAX_INFS: return "Maximum inferences reached"
-        answer = query_model(self.backend, "\nHere is a history of your dialogue: " + self.agent_hist + "\n Here was the patient response: " + question + "Now please continue your dialogue\nDoctor: ", self.system_prompt(test_mode=test_mode), image_requested=image_requested, scene=self.scenario)
+        # a cached local dialogue needs a fixed system prompt, so the question count moves to the end
+        progress_in_prompt = self.conversation_id is not None and kv_reuse(self.backend)
+        progress = "You have asked {} questions so far. ".format(self.infs) if progress_in_prompt else ""
+        answer = query_model(self.backend, "\nHere is a history of your dialogue: " + self.agent_hist + "\n Here was the patient response: " + question + progress + "Now please continue your dialogue\nDoctor: ", self.system_prompt(test_mode=test_mode, progress=not progress_in_prompt), image_requested=image_requested, scene=self.scenario, conversation=self.conversation_id, role="doctor")
         self.agent_hist += question + "\n\n" + answer + "\n\n"
         self.infs += 1
         return answer
 
-    def system_prompt(self, test_mode=False) -> str:
+    def persona_card(self) -> str:
+        if self.persona_json is None:
+            return persona_card("Doctor", parse_big5(self.personality))
+        return persona_card_from_json(self.persona_json)
+
+    def system_prompt(self, test_mode=False, progress=True) -> str:
         bias_prompt = ""
         base = (
                 "You are a doctor named Dr. Agent who only responds in the form of dialogue. "
                 "You are inspecting a patient who you will ask questions in order to understand their disease. "
-                "You are only allowed to ask {} questions total before you must make a decision. "
-                "You have asked {} questions so far. "
-                "You can request test results using the format \"REQUEST TEST: [test]\". For example, \"REQUEST TEST: Chest_X-Ray\". "
+                "You are only allowed to ask {} questions total before you must make a decision. ".format(self.MAX_INFS)
+                + ("You have asked {} questions so far. ".format(self.infs) if progress else "")
+                + "You can request test results using the format \"REQUEST TEST: [test]\". For example, \"REQUEST TEST: Chest_X-Ray\". "
                 "Your dialogue will only be 1-3 sentences in length. "
                 "Once you have decided to make a diagnosis please type \"DIAGNOSIS READY: [diagnosis here]\""
-                .format(self.MAX_INFS, self.infs)
                 + (
                     " You may also request medical images related to the disease to be returned with \"REQUEST IMAGES\"." if self.img_request else "")
                 + (
@@ -97,18 +108,29 @@ class DoctorAgent:
         if self.bias_present is not None:
             bias_prompt = self.generate_bias()
         if self.big5_enabled:
-            doctor_big5 = "agent_personas/doc_pos.json"
-            base = base + persona_card_from_json(doctor_big5)
+            base = base + self.persona_card()
         presentation = "\n\nBelow is all of the information you have. {}. \n\n Remember, you must discover their disease by asking them questions. You are also able to provide exams.".format(self.presentation)
         return base + bias_prompt + presentation
 
+    def inventory_system_prompt(self) -> str:
+        # persona only: no scenario presentation or dialogue state, so answers
+        # can be cached per (model, persona) and reused across scenarios
+        base = "You are a doctor named Dr. Agent."
+        if self.bias_present is not None:
+            base += self.generate_bias()
+        if self.big5_enabled:
+            base = base + self.persona_card()
+        return base
+
     def take_test(
             self,
             *,
             question_set: int = 120,
             sex: str = "N",
             age: int = 35,
-            batch_size: int = 20,
+            batch_size: int = 30,
+            max_workers: int = 4,
+            use_cache: bool = True,
             show_progress: bool = True,
     ):
         try:
@@ -116,81 +138,35 @@ class DoctorAgent:
         except ImportError:
             raise ImportError("Please install with: pip install five-factor-e")
 
-        import json, re, urllib.request
+        import json
+        from utilities.personality_inventory import administer_inventory
 
         if question_set not in (120, 300):
             raise ValueError("question_set must be 120 or 300")
         if not (10 <= int(age) <= 110):
             raise ValueError("age must be between 10 and 110")
 
-        # ---- 1. Download the question file ----
-        url = f"https://raw.githubusercontent.com/NeuroQuestAi/five-factor-e/main/data/IPIP-NEO/{question_set}/questions.json"
-        with urllib.request.urlopen(url) as r:
-            questions_json = json.loads(r.read().decode("utf-8"))
-
-        # Expect {'questions':[...], 'select':[...]}
-        q_list = questions_json.get("questions")
-        if not q_list:
-            raise ValueError("Downloaded file missing 'questions' key.")
-
-        # Normalize: {id:int, text:str}
-        questions = [{"id": int(q["id"]), "text": q["text"]} for q in q_list]
-        questions.sort(key=lambda q: q["id"])
-        ids = [q["id"] for q in questions]
-        id2text = {q["id"]: q["text"] for q in questions}
-
-        # ---- 2. Tell the doctor how to respond ----
-        test_prompt = """**Inventory Mode**. Now you must ignore your conversation with the patient. Instead now I am forcing you to take the personality test instructed as below \n
-                You are currently completing a standardized personality inventory (IPIP-NEO).
-                When you are shown inventory items, reply to EACH item with ONE integer 1–5 ONLY, where
-                1=Very Inaccurate, 2=Moderately Inaccurate, 3=Neither, 4=Moderately Accurate, 5=Very Accurate.
-                Do not add explanations or commentary. Do not provide medical advice during the test.
-                You will now take a personality inventory (IPIP-NEO).For each statement, answer with ONE number 1–5 ONLY. Do not explain."""
-
-
-        # ---- 3. Helper to coerce to 1–5 ----
-        def _to_1_5(resp) -> int:
-            s = str(resp).strip().lower()
-            m = re.search(r"\b([1-5])\b", s)
-            if m:
-                return int(m.group(1))
-            if "very inaccurate" in s: return 1
-            if "moderately inaccurate" in s: return 2
-            if "neither" in s or "neutral" in s: return 3
-            if "moderately accurate" in s: return 4
-            if "very accurate" in s: return 5
-            digits = re.findall(r"[1-5]", s)
-            if digits:
-                return int(digits[-1])
-            raise ValueError(f"Invalid Likert answer: {resp!r}")
-
-        # ---- 4. Ask all questions via your LLM agent ----
-        collected = {}
-        for i in range(0, len(ids), batch_size):
-            chunk = ids[i:i + batch_size]
-            prompt = "\n".join(f"{qid}. {id2text[qid]}  (Answer 1–5 only)" for qid in chunk)
-            resp = self.inference_doctor(test_prompt + prompt, test_mode=True)
-
-            nums = [int(n) for n in re.findall(r"\b([1-5])\b", str(resp))]
-            if len(nums) < len(chunk):
-                # ask missing one by one
-                for qid in chunk[len(nums):]:
-                    single = self.inference_doctor(f"{qid}. (1–5 only)")
-                    nums.append(_to_1_5(single))
-            for qid, n in zip(chunk, nums[:len(chunk)]):
-                collected[qid] = _to_1_5(n)
-
-            if show_progress:
-                print(f"[IPIP-NEO] Collected {len(collected)}/{len(ids)}")
-
-        # ---- 5. Build payload from doctor’s answers ----
-        payload = {"answers": [{"id_question": qid, "id_select": collected[qid]} for qid in ids]}
-
-        # ---- 6. Compute personality ----
+        # ---- 1. Ask all questions from the local bank, outside the dialogue history ----
+        collected = administer_inventory(
+            self.backend,
+            self.inventory_system_prompt(),
+            question_set=question_set,
+            batch_size=batch_size,
+            max_workers=max_workers,
+            use_cache=use_cache,
+            # the first run on a fresh checkout prepares the local bank
+            allow_download=True,
+            show_progress=show_progress,
+        )
+
+        # ---- 2. Build payload from doctor’s answers ----
+        payload = {"answers": [{"id_question": qid, "id_select": collected[qid]} for qid in sorted(collected)]}
+
+        # ---- 3. Compute personality ----
         ipip = IpipNeo(question=question_set)
         result = ipip.compute(sex=sex, age=age, answers=payload, compare=False)
 
-        # ---- 7. Save summary for persona card ----
+        # ---- 4. Save summary for persona card ----
         bigfive = result.get("bigfive") or result.get("factors") or {}
 
         def _val(k):
@@ -205,4 +181,12 @@ class DoctorAgent:
 
     def reset(self) -> None:
         self.agent_hist = ""
-        self.presentation = self.scenario.examiner_information()
\ No newline at end of file
+        self.presentation = self.scenario.examiner_information()
+
+    def snapshot(self) -> dict:
+        """Dialogue state, to continue the conversation in another DoctorAgent (see restore)."""
+        return {"agent_hist": self.agent_hist, "infs": self.infs}
+
+    def restore(self, state: dict) -> None:
+        self.agent_hist = state["agent_hist"]
+        self.infs = state["infs"]
\ No newline at end of file
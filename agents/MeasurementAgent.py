@@ -13,6 +13,8 @@ class MeasurementAgent:
         self.scenario = scenario
         self.big5_enabled = big5_enabled
         self.personality = personality
+        # key under which a local backend may keep this dialogue's KV cache
+        self.conversation_id = None
         self.pipe = None
         self.reset()
 
@@ -20,7 +22,7 @@ class MeasurementAgent:
         answer = str()
         answer = query_model(self.backend,
                              "\nHere is a history of the dialogue: " + self.agent_hist + "\n Here was the doctor measurement request: " + question,
-                             self.system_prompt())
+                             self.system_prompt(), conversation=self.conversation_id, role="measurement")
         self.agent_hist += question + "\n\n" + answer + "\n\n"
         return answer
 
@@ -36,6 +38,12 @@ class MeasurementAgent:
     def add_hist(self, hist_str) -> None:
         self.agent_hist += hist_str + "\n\n"
 
+    def snapshot(self) -> dict:
+        return {"agent_hist": self.agent_hist}
+
+    def restore(self, state: dict) -> None:
+        self.agent_hist = state["agent_hist"]
+
     def reset(self) -> None:
         self.agent_hist = ""
         self.information = self.scenario.exam_information()
\ No newline at end of file
@@ -16,6 +16,8 @@ class PatientAgent:
         self.scenario = scenario
         self.big5_enabled = big5_enabled
         self.personality = personality
+        # key under which a local backend may keep this dialogue's KV cache
+        self.conversation_id = None
         self.reset()
         self.pipe = None
 
@@ -59,7 +61,7 @@ class PatientAgent:
     def inference_patient(self, question) -> str:
         answer = query_model(self.backend,
                              "\nHere is a history of your dialogue: " + self.agent_hist + "\n Here was the doctor response: " + question + "Now please continue your dialogue\nPatient: ",
-                             self.system_prompt())
+                             self.system_prompt(), conversation=self.conversation_id, role="patient")
         self.agent_hist += question + "\n\n" + answer + "\n\n"
         return answer
 
@@ -80,4 +82,10 @@ class PatientAgent:
         self.symptoms = self.scenario.patient_information()
 
     def add_hist(self, hist_str) -> None:
-        self.agent_hist += hist_str + "\n\n"
\ No newline at end of file
+        self.agent_hist += hist_str + "\n\n"
+
+    def snapshot(self) -> dict:
+        return {"agent_hist": self.agent_hist}
+
+    def restore(self, state: dict) -> None:
+        self.agent_hist = state["agent_hist"]
\ No newline at end of file
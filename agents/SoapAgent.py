@@ -1,6 +1,14 @@
+import contextvars
 import json
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Union
+
+from pydantic import ValidationError
+
+from agents.models import NotePayload
 from utilities.utility import query_model, persona_card_from_json
 
 
@@ -10,6 +18,48 @@ class SoapAgentConfig:
     include_markdown: bool = False
     temperature: float = 0.0
     max_output_tokens: int = 900
+    # keep a running S/O draft while the dialogue happens so generate() only
+    # has to write Assessment/Plan
+    incremental: bool = False
+    # refresh the draft with small LLM delta calls every N observed turns;
+    # calls run in the background. Incremental mode needs it: the local
+    # extraction is only a fallback and keeps the utterances verbatim.
+    delta_every: int = 4
+    delta_max_tokens: int = 300
+    finalize_max_tokens: int = 400
+    # return a validated models.NotePayload instead of raw text
+    structured: bool = False
+    # re-requests after a note fails schema validation (local repair first)
+    max_repairs: int = 2
+
+    def __post_init__(self):
+        if self.incremental and self.delta_every < 1:
+            raise ValueError("incremental SOAP notes need delta_every >= 1")
+
+
+# shape of the JSON requested in structured mode (mirrors models.NotePayload)
+NOTE_SCHEMA_EXAMPLE = {
+    "soap": {
+        "subjective": "...",
+        "objective": {
+            "vitals": {"Heart_Rate": "..."},
+            "exam": "...",
+            "tests": [{"name": "...", "result": "...", "evidence_turn": 3}],
+        },
+        "assessment": [{"problem": "...", "differential": ["..."], "rationale": "..."}],
+        "plan": [{"type": "medication|test|referral|education|follow-up", "item": "...", "rationale": "..."}],
+    },
+    "diagnosis": {"final": "...", "differential": ["..."], "confidence": 0.0},
+}
+
+
+def _repair_json(text: str) -> str:
+    # cheap local fixes: code fences, chatter around the object, trailing commas
+    text = text.replace("```json", "").replace("```", "")
+    start, end = text.find("{"), text.rfind("}")
+    if start != -1 and end > start:
+        text = text[start:end + 1]
+    return re.sub(r",\s*([}\]])", r"\1", text)
 
 
 class QueryModelChatClient:
@@ -39,6 +89,7 @@ class QueryModelChatClient:
             timeout=self.timeout,
             max_tokens=max_tokens,
             clip_prompt=False,
+            role="soap",
         )
 
 
@@ -50,10 +101,108 @@ class SoapAgent:
         self._lines: List[str] = []  # "[turn] Role: content"
         self.enable_big5 = enable_big5
         self.objective_cache: Optional[Dict[str, Any]] = None
+        # running draft for incremental mode
+        self._subjective: List[str] = []
+        self._objective: List[str] = []
+        self._requested: List[str] = []
+        self._llm_draft: Optional[Dict[str, str]] = None
+        self._undrafted: List[str] = []
+        # lines whose delta call failed, merged into the local draft if no later delta covers them
+        self._failed: List[str] = []
+        self._draft_lock = threading.Lock()
+        self._delta_pool: Optional[ThreadPoolExecutor] = None
+        self._delta_futures = []
 
     def observe(self, role: str, text: str, turn: int) -> None:
         safe_role = role.strip().title()
-        self._lines.append(f"[{turn}] {safe_role}: {text.strip()}")
+        line = f"[{turn}] {safe_role}: {text.strip()}"
+        self._lines.append(line)
+        if self.cfg.incremental:
+            self._update_draft(safe_role, text.strip(), line)
+
+    def _update_draft(self, role: str, text: str, line: str) -> None:
+        # cheap local extraction, one turn at a time
+        if role == "Patient" and text and text not in self._subjective:
+            self._subjective.append(text)
+        elif role == "Measurement":
+            result = re.sub(r"^\s*RESULTS:\s*", "", text)
+            if result and result not in self._objective:
+                self._objective.append(result)
+        elif role == "Doctor":
+            for test in re.findall(r"REQUEST TEST:\s*([^.\n]+)", text):
+                if test.strip() not in self._requested:
+                    self._requested.append(test.strip())
+        self._undrafted.append(line)
+        if len(self._undrafted) >= self.cfg.delta_every:
+            self._schedule_delta()
+
+    def _schedule_delta(self) -> None:
+        new_lines, self._undrafted = self._undrafted, []
+        if self._delta_pool is None:
+            # one worker keeps the deltas in dialogue order
+            self._delta_pool = ThreadPoolExecutor(max_workers=1)
+        # the caller's context carries the scenario's cost scope into the worker
+        ctx = contextvars.copy_context()
+        self._delta_futures.append(self._delta_pool.submit(ctx.run, self._delta_call, new_lines))
+
+    def _delta_call(self, new_lines: List[str]) -> None:
+        with self._draft_lock:
+            # retry lines an earlier delta failed on
+            new_lines, self._failed = self._failed + new_lines, []
+        try:
+            self._merge_delta(new_lines)
+        except Exception:
+            with self._draft_lock:
+                self._failed = new_lines + self._failed
+            raise
+
+    def _merge_delta(self, new_lines: List[str]) -> None:
+        current = self.draft()
+        user = (
+            f"CURRENT DRAFT:\nS: {current['subjective']}\nO: {current['objective']}\n\n"
+            "NEW DIALOGUE:\n" + "\n".join(new_lines) + "\n\n"
+            "Output the updated draft as exactly two lines starting with \"S:\" and \"O:\"."
+        )
+        raw = self.llm.chat(
+            system="You maintain the Subjective and Objective sections of a SOAP note while a clinical encounter is in progress. Merge the new dialogue into the draft using concise clinical language. Do not add an assessment or plan.",
+            messages=[{"role": "user", "content": user}],
+            temperature=self.cfg.temperature,
+            max_tokens=self.cfg.delta_max_tokens,
+        )
+        m_s = re.search(r"S:\s*(.*?)\s*(?=\bO:|$)", raw, re.S)
+        m_o = re.search(r"\bO:\s*(.*)$", raw, re.S)
+        if not (m_s and m_o):
+            raise ValueError("SOAP delta reply has no S:/O: lines")
+        self._llm_draft = {"subjective": m_s.group(1).strip(), "objective": m_o.group(1).strip()}
+
+    def draft(self) -> Dict[str, str]:
+        """
+        Current S/O draft: the latest LLM delta plus the local extraction of
+        lines no delta has covered yet, or only the local extraction.
+        """
+        if self._llm_draft is not None:
+            with self._draft_lock:
+                pending = list(self._failed)
+            draft = dict(self._llm_draft)
+            subjective, objective = [], []
+            for line in pending:
+                role, _, text = line.split("] ", 1)[-1].partition(": ")
+                if role == "Patient":
+                    subjective.append(text)
+                elif role == "Measurement":
+                    objective.append(re.sub(r"^\s*RESULTS:\s*", "", text))
+            if subjective:
+                draft["subjective"] += " " + " ".join(subjective)
+            if objective:
+                draft["objective"] += " " + " ".join(objective)
+            return draft
+        objective = " ".join(self._objective) if self._objective else "No results reported."
+        if self._requested:
+            objective += " Tests requested: " + ", ".join(self._requested) + "."
+        return {
+            "subjective": " ".join(self._subjective) if self._subjective else "No complaints recorded.",
+            "objective": objective,
+        }
 
     def transcript(self) -> str:
         return "\n".join(self._lines)
@@ -84,12 +233,112 @@ Important:
         t += "\n\nNow output the SOAP note report."
         return t
 
-    def generate(self, turn_range: tuple[int, int]) -> Dict[str, Any]:
+    def _parse_note(self, raw: str, turn_range: tuple[int, int], draft: Optional[Dict[str, str]] = None) -> NotePayload:
+        data = json.loads(_repair_json(raw))
+        if not isinstance(data, dict):
+            # goes through the repair retry like any other invalid note
+            raise ValueError("expected a JSON object, got {}".format(type(data).__name__))
+        if draft is not None:
+            # incremental mode: S/O come from the running draft
+            data = {
+                "soap": {
+                    "subjective": draft["subjective"],
+                    "objective": {"exam": draft["objective"]},
+                    "assessment": data.get("assessment", []),
+                    "plan": data.get("plan", []),
+                },
+                "diagnosis": data.get("diagnosis", {}),
+            }
+        note = NotePayload.model_validate(data)
+        note.meta.turn_range = [turn_range[0], turn_range[1]]
+        note.meta.note_status = "final"
+        return note
+
+    def _structured_chat(self, sys: str, user: str, max_tokens: int, turn_range: tuple[int, int],
+                         draft: Optional[Dict[str, str]] = None) -> NotePayload:
+        messages = [{"role": "user", "content": user}]
+        raw = ""
+        for attempt in range(self.cfg.max_repairs + 1):
+            raw = self.llm.chat(system=sys, messages=messages, temperature=self.cfg.temperature, max_tokens=max_tokens)
+            try:
+                return self._parse_note(raw, turn_range, draft)
+            except (ValueError, ValidationError) as e:
+                error = str(e).splitlines()[0] if str(e) else type(e).__name__
+            # targeted retry: previous output plus the validation error only
+            messages = [{"role": "user", "content": (
+                f"This SOAP note JSON is invalid ({error}). Fix it and return only the corrected JSON object "
+                f"of this shape:\n{json.dumps(NOTE_SCHEMA_EXAMPLE)}\n\nINVALID OUTPUT:\n{raw}")}]
+        # keep the text rather than losing the note
+        note = NotePayload(soap={"subjective": raw}, diagnosis={})
+        note.meta.turn_range = [turn_range[0], turn_range[1]]
+        note.meta.note_status = "unstructured"
+        return note
+
+    def _finalize(self, turn_range: tuple[int, int]) -> Union[str, NotePayload]:
+        # flush pending deltas so the draft covers the whole encounter
+        if self._undrafted:
+            self._schedule_delta()
+        errors = []
+        for future in self._delta_futures:
+            try:
+                future.result()
+            except Exception as e:
+                errors.append(e)
+        self.close()
+        if self._failed:
+            # no later update covered them, draft() merges their local extraction
+            print("[SOAP] {} draft update(s) failed ({}), {} turn(s) taken from the local draft".format(
+                len(errors), errors[-1], len(self._failed)))
+        draft = self.draft()
+        doctor_lines = [_l for _l in self._lines if "] Doctor: " in _l][-2:]
+        sys = (
+            "You are a clinical transcriber agent. The Subjective and Objective sections of a SOAP note are already written. "
+            "Write only the Assessment and Plan, each as one short paragraph starting with \"A:\" and \"P:\". "
+            "Do not include any dialogue or quotations."
+        )
+        if self.enable_big5:
+            doctor_big5 = "agent_personas/doc_pos.json"
+            sys = sys + persona_card_from_json(doctor_big5)
+        user = (
+            f"ENCOUNTER (turns {turn_range[0]}-{turn_range[1]}):\n"
+            f"S: {draft['subjective']}\nO: {draft['objective']}\n\n"
+            "LAST DOCTOR TURNS:\n" + "\n".join(doctor_lines) + "\n\nNow output A: and P:."
+        )
+        if self.cfg.structured:
+            example = {k: NOTE_SCHEMA_EXAMPLE["soap"][k] for k in ("assessment", "plan")}
+            example["diagnosis"] = NOTE_SCHEMA_EXAMPLE["diagnosis"]
+            user = user.replace("Now output A: and P:.", "Output only a JSON object of this shape:\n" + json.dumps(example))
+            return self._structured_chat(sys, user, self.cfg.finalize_max_tokens, turn_range, draft)
+        assessment_plan = self.llm.chat(
+            system=sys,
+            messages=[{"role": "user", "content": user}],
+            temperature=self.cfg.temperature,
+            max_tokens=self.cfg.finalize_max_tokens,
+        )
+        return f"S: {draft['subjective']}\nO: {draft['objective']}\n{assessment_plan.strip()}"
+
+    def close(self) -> None:
+        """Stops the delta worker; safe to call more than once."""
+        if self._delta_pool is not None:
+            self._delta_pool.shutdown(wait=True, cancel_futures=True)
+            self._delta_pool = None
+        self._delta_futures = []
+
+    def generate(self, turn_range: tuple[int, int]) -> Union[str, NotePayload]:
+        """Raw SOAP text, or a validated NotePayload with config.structured."""
+        if self.cfg.incremental:
+            return self._finalize(turn_range)
         sys = self._system_prompt()
         if self.enable_big5:
             doctor_big5 = "agent_personas/doc_pos.json"
             sys = sys + persona_card_from_json(doctor_big5)
         user = self._user_prompt(turn_range, self.objective_cache)
+        if self.cfg.structured:
+            user = user.replace(
+                "Now output the SOAP note report.",
+                "Now output the SOAP note report as a single JSON object of this shape (no prose):\n"
+                + json.dumps(NOTE_SCHEMA_EXAMPLE))
+            return self._structured_chat(sys, user, self.cfg.max_output_tokens, turn_range)
         raw = self.llm.chat(
             system=sys,
             messages=[{"role": "user", "content": user}],
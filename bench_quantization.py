@@ -0,0 +1,74 @@
+import argparse
+import json
+import time
+
+from utilities.scenario import get_scenario_loader
+from utilities.utility import compare_results
+
+# Speed and grading agreement of quantized local models.
+# Loads the model once per quantization mode, measures decode tokens/s and
+# latency over moderator grading prompts built from the dataset (every correct
+# diagnosis paired with itself and with another scenario's diagnosis), and
+# reports accuracy and agreement with the full-precision verdicts.
+
+
+def grading_items(dataset, num_scenarios):
+    loader = get_scenario_loader(dataset)
+    n = min(num_scenarios, loader.num_scenarios)
+    diagnoses = [loader.get_scenario(id=i).diagnosis_information() for i in range(n)]
+    items = []
+    for i, correct in enumerate(diagnoses):
+        items.append((correct, correct, True))
+        if n > 1:
+            items.append((diagnoses[(i + 1) % n], correct, False))
+    return items
+
+
+def bench_mode(model_name, quantize, items):
+    from utilities.local_backend import configure_local_backend, get_local_model, unload_local_model
+
+    # grade through compare_results like agentclinic does, on a server loaded in this mode
+    configure_local_backend(max_batch_size=1, max_conversations=0, quantize=quantize)
+    start = time.perf_counter()
+    server = get_local_model(model_name)
+    load_s = time.perf_counter() - start
+    verdicts, latencies = [], []
+    for diagnosis, correct, _ in items:
+        t0 = time.perf_counter()
+        grade = compare_results("DIAGNOSIS READY: " + diagnosis, correct, "HF_" + model_name, None)
+        latencies.append(time.perf_counter() - t0)
+        verdicts.append(grade == "yes")
+    unload_local_model(model_name)
+    return {
+        "quantize": quantize,
+        "load_s": load_s,
+        "tokens_per_sec": server.tokens_per_sec,
+        "mean_latency_s": sum(latencies) / len(latencies),
+        "accuracy": sum(v == expected for v, (_, _, expected) in zip(verdicts, items)) / len(items),
+        "verdicts": verdicts,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare quantized and full-precision local models on moderator grading')
+    parser.add_argument('--model', type=str, required=True, help='Hugging Face model name (without the HF_ prefix)')
+    parser.add_argument('--modes', type=str, default='none,int8,int4', help='Quantization modes, the first one is the reference')
+    parser.add_argument('--threads', type=int, default=None, help='CPU threads')
+    parser.add_argument('--agent_dataset', type=str, default='MedQA')
+    parser.add_argument('--num_scenarios', type=int, default=20)
+    parser.add_argument('--output', type=str, default=None, help='Optional JSON file for the results')
+    args = parser.parse_args()
+
+    from utilities.local_backend import configure_local_backend
+    configure_local_backend(threads=args.threads)
+    items = grading_items(args.agent_dataset, args.num_scenarios)
+    results = [bench_mode(args.model, mode.strip(), items) for mode in args.modes.split(',') if mode.strip()]
+    reference = results[0]["verdicts"]
+    print("{:<6} {:>8} {:>10} {:>12} {:>9} {:>10}".format("mode", "load_s", "tokens/s", "latency_s", "accuracy", "agreement"))
+    for res in results:
+        res["agreement"] = sum(a == b for a, b in zip(res["verdicts"], reference)) / len(reference)
+        print("{:<6} {:>8.1f} {:>10.1f} {:>12.3f} {:>9.3f} {:>10.3f}".format(
+            res["quantize"], res["load_s"], res["tokens_per_sec"], res["mean_latency_s"], res["accuracy"], res["agreement"]))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"model": args.model, "items": len(items), "results": results}, f, indent=2)
@@ -0,0 +1,60 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# Startup-time benchmark for agentclinic.py.
+# Each sample is a fresh interpreter, so import time and peak RSS are measured
+# cold. The run fails (exit code 1) when the median exceeds the budget or when
+# importing agentclinic pulls in a backend SDK that no agent has selected yet.
+
+HEAVY_MODULES = ["openai", "anthropic", "replicate", "transformers", "torch", "datasets", "pydantic"]
+
+_PROBE = """
+import json, resource, sys, time
+t0 = time.perf_counter()
+import agentclinic
+elapsed = time.perf_counter() - t0
+print(json.dumps({{
+    "import_s": elapsed,
+    "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "heavy": [m for m in {heavy!r} if m in sys.modules],
+}}))
+"""
+
+
+def sample_import():
+    out = subprocess.run([sys.executable, "-c", _PROBE.format(heavy=HEAVY_MODULES)], capture_output=True, text=True,
+                         check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def sample_help():
+    import time
+    t0 = time.perf_counter()
+    subprocess.run([sys.executable, "agentclinic.py", "--help"], capture_output=True, check=True,
+                   cwd=os.path.dirname(os.path.abspath(__file__)))
+    return time.perf_counter() - t0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measure agentclinic.py startup time against a budget')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget_ms', type=float, default=500.0, help='Allowed median `import agentclinic` time')
+    args = parser.parse_args()
+
+    samples = [sample_import() for _ in range(args.runs)]
+    import_ms = statistics.median(s["import_s"] for s in samples) * 1000
+    help_ms = statistics.median(sample_help() for _ in range(args.runs)) * 1000
+    rss_mb = max(s["max_rss_mb"] for s in samples)
+    heavy = sorted({m for s in samples for m in s["heavy"]})
+    print("import agentclinic: {:.0f} ms (median of {}), budget {:.0f} ms".format(import_ms, args.runs, args.budget_ms))
+    print("agentclinic.py --help: {:.0f} ms".format(help_ms))
+    print("peak RSS: {:.0f} MB".format(rss_mb))
+    print("eagerly imported backends: {}".format(", ".join(heavy) if heavy else "none"))
+    if import_ms > args.budget_ms or heavy:
+        print("FAIL: startup regression")
+        sys.exit(1)
+    print("OK")
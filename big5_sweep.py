@@ -0,0 +1,256 @@
+import argparse
+import csv
+import itertools
+import json
+import random
+import threading
+from dataclasses import replace
+
+from agentclinic import ClinicConfig, run_scenario, set_api_keys
+from utilities.cost_tracker import BudgetExceeded
+from utilities.metrics import start_metrics
+from utilities.results_db import new_run_id
+from utilities.scenario import get_scenario_loader
+from utilities.scheduler import LongestFirstPool, estimate_costs, makespan_bound
+from utilities.utility import get_cost_tracker, get_metrics, set_cost_tracker, set_response_cache
+
+# Big Five persona sweep: evaluates a grid or a random sample of O/C/E/A/N
+# vectors per role against the same scenarios. All (configuration, scenario)
+# pairs are scheduled on one thread pool, longest expected dialogue first, and
+# share the scenario store (and the response cache if one is given); the
+# output is one accuracy row per configuration.
+
+ROLES = ["doctor", "patient", "measurement", "moderator"]
+TRAITS = ["openness", "conscientiousness", "extraversion", "agreeableness", "neuroticism"]
+TRAIT_KEYS = {"O": "openness", "C": "conscientiousness", "E": "extraversion", "A": "agreeableness", "N": "neuroticism"}
+
+
+def role_vectors(base, traits, values):
+    """Every combination of `values` over `traits`, other traits kept from `base`."""
+    vectors = []
+    for combo in itertools.product(values, repeat=len(traits)):
+        vec = dict(base)
+        vec.update(zip(traits, combo))
+        vectors.append(vec)
+    return vectors
+
+
+def sweep_profiles(base_profiles, roles, traits, values, mode="grid", samples=10, seed=0):
+    """
+    Returns a list of {role: profile} dicts. "grid" is the full cross product
+    over roles; "random" draws `samples` joint profiles, each swept trait
+    uniformly from [min(values), max(values)].
+    """
+    if mode == "grid":
+        per_role = [role_vectors(base_profiles[role], traits, values) for role in roles]
+        profiles = []
+        for combo in itertools.product(*per_role):
+            prof = {role: dict(base_profiles[role]) for role in base_profiles}
+            prof.update(zip(roles, combo))
+            profiles.append(prof)
+        return profiles
+    rng = random.Random(seed)
+    lo, hi = min(values), max(values)
+    profiles = []
+    for _ in range(samples):
+        prof = {role: dict(base_profiles[role]) for role in base_profiles}
+        for role in roles:
+            for trait in traits:
+                prof[role][trait] = round(rng.uniform(lo, hi))
+        profiles.append(prof)
+    return profiles
+
+
+def profile_config(base_cfg, profile, roles):
+    personalities = {role: ",".join(str(vec[t]) for t in TRAITS) for role, vec in profile.items()}
+    return replace(
+        base_cfg,
+        enable_big5=True,
+        personalities=personalities,
+        # a swept doctor uses its vector instead of the fixed persona file
+        doctor_persona_json=None if "doctor" in roles else base_cfg.doctor_persona_json,
+        moderator_persona="moderator" in roles,
+    )
+
+
+def run_sweep(base_cfg, profiles, roles, scenario_ids, max_workers=8, log=print, results=None, run_prefix="sweep"):
+    """`results` is an optional ResultsDB; configuration i is stored as run <run_prefix>-<i>."""
+    configs = [profile_config(base_cfg, prof, roles) for prof in profiles]
+    if results is not None:
+        for idx, cfg in enumerate(configs):
+            results.add_run("{}-{}".format(run_prefix, idx), cfg)
+    loader = get_scenario_loader(base_cfg.dataset)
+    stats = [{"n": 0, "correct": 0, "diagnosed": 0, "turns": 0, "errors": 0, "skipped": 0} for _ in configs]
+    lock = threading.Lock()
+    tracker = get_cost_tracker()
+    running = [0]
+
+    metrics = get_metrics()
+
+    def _run(cfg, sid):
+        # over budget: queued runs are skipped instead of started
+        with lock:
+            if tracker is not None and tracker.should_stop(in_flight=running[0]):
+                if metrics is not None:
+                    metrics.add_scenarios(-1)
+                return None
+            running[0] += 1
+        if metrics is not None:
+            metrics.scenario_started()
+        result = None
+        try:
+            result = run_scenario(cfg, sid, loader, None, False)
+            return result
+        finally:
+            with lock:
+                running[0] -= 1
+            if metrics is not None:
+                metrics.scenario_finished(result)
+
+    jobs = [(idx, cfg, sid) for idx, cfg in enumerate(configs) for sid in scenario_ids]
+    costs = estimate_costs([(cfg, sid) for _, cfg, sid in jobs], {base_cfg.dataset: loader}, results)
+    log("[sweep] estimated {:.0f} turns of work, makespan >= {:.0f} turns on {} workers".format(
+        sum(costs), makespan_bound(costs, max_workers), max_workers))
+    if metrics is not None:
+        metrics.add_scenarios(len(jobs))
+    pool = LongestFirstPool(max_workers)
+    for done, (job, result, error) in enumerate(pool.run(jobs, costs, lambda job: _run(job[1], job[2])), 1):
+        idx = job[0]
+        with lock:
+            st = stats[idx]
+            if isinstance(error, BudgetExceeded) or (error is None and result is None):
+                st["skipped"] += 1
+            elif error is not None:
+                st["n"] += 1
+                st["errors"] += 1
+                log("Config {} failed: {}".format(idx, error))
+            else:
+                st["n"] += 1
+                st["turns"] += result["turns"]
+                if results is not None:
+                    results.add_scenario("{}-{}".format(run_prefix, idx), result)
+                if result["correct"] is not None:
+                    st["diagnosed"] += 1
+                    st["correct"] += int(result["correct"])
+        if done % 10 == 0 or done == len(jobs):
+            log("[sweep] {}/{} runs finished".format(done, len(jobs)))
+
+    rows = []
+    for idx, (prof, st) in enumerate(zip(profiles, stats)):
+        row = {"config": idx}
+        for role in roles:
+            row[role] = ",".join(str(prof[role][t]) for t in TRAITS)
+        row["scenarios"] = st["n"]
+        # over the runs that finished, failed ones are counted in "errors"
+        row["accuracy"] = st["correct"] / (st["n"] - st["errors"]) if st["n"] > st["errors"] else 0.0
+        row["diagnosed"] = st["diagnosed"]
+        row["mean_turns"] = st["turns"] / max(st["n"] - st["errors"], 1)
+        row["errors"] = st["errors"]
+        row["skipped"] = st["skipped"]
+        rows.append(row)
+    return rows
+
+
+def print_table(rows):
+    if not rows:
+        return
+    cols = list(rows[0].keys())
+    fmt = lambda v: "{:.3f}".format(v) if isinstance(v, float) else str(v)
+    widths = [max(len(c), *(len(fmt(r[c])) for r in rows)) for c in cols]
+    print("  ".join(c.ljust(w) for c, w in zip(cols, widths)))
+    for r in sorted(rows, key=lambda r: -r["accuracy"]):
+        print("  ".join(fmt(r[c]).ljust(w) for c, w in zip(cols, widths)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Big Five persona sweep over AgentClinic scenarios')
+    parser.add_argument('--openai_api_key', type=str, required=False, help='OpenAI API Key')
+    parser.add_argument('--replicate_api_key', type=str, required=False, help='Replicate API Key')
+    parser.add_argument('--anthropic_api_key', type=str, default=None, required=False, help='Anthropic API key for Claude 3.5 Sonnet')
+    parser.add_argument('--doctor_llm', type=str, default='gpt4')
+    parser.add_argument('--patient_llm', type=str, default='gpt4')
+    parser.add_argument('--measurement_llm', type=str, default='gpt4')
+    parser.add_argument('--moderator_llm', type=str, default='gpt4')
+    parser.add_argument('--agent_dataset', type=str, default='MedQA')
+    parser.add_argument('--num_scenarios', type=int, default=5, help='Scenarios evaluated per configuration')
+    parser.add_argument('--total_inferences', type=int, default=20)
+    parser.add_argument('--roles', type=str, default='doctor', help='Comma separated roles to sweep: ' + ','.join(ROLES))
+    parser.add_argument('--traits', type=str, default='O,C,E,A,N', help='Traits varied per role, others come from the base config')
+    parser.add_argument('--values', type=str, default='20,50,80', help='Grid values (random mode samples between min and max)')
+    parser.add_argument('--mode', type=str, choices=['grid', 'random'], default='grid')
+    parser.add_argument('--samples', type=int, default=10, help='Configurations drawn in random mode')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--base_config', type=str, default='IPIP-BIG5/personalities_config.json')
+    parser.add_argument('--max_workers', type=int, default=8, help='Concurrent scenario simulations')
+    parser.add_argument('--response_cache', type=str, default='', help='SQLite response cache shared by all runs (off by default: repeated runs of a persona would replay the same completions)')
+    parser.add_argument('--hf_max_batch_size', type=int, default=8, help='Max prompts per generate call for local HF_ models')
+    parser.add_argument('--hf_batch_window_ms', type=float, default=20.0, help='How long a local HF_ model waits to fill a batch')
+    parser.add_argument('--hf_max_conversations', type=int, default=0, help='Agent dialogues whose KV cache a local HF_ model keeps between turns (default 0: off, cached dialogues are not batched)')
+    parser.add_argument('--hf_quantize', type=str, choices=['none', 'int8', 'int4'], default='none', help='Weight quantization for local HF_ models on CPU (int4 needs optimum-quanto)')
+    parser.add_argument('--hf_threads', type=int, default=None, help='CPU threads used by local HF_ models')
+    parser.add_argument('--budget', type=float, default=None, help='Skip runs not yet started once the projected spend (USD) reaches this')
+    parser.add_argument('--budget_abort', action='store_true', help='Also abort running scenarios once the budget is spent')
+    parser.add_argument('--price_table', type=str, default=None, help='JSON {model: [usd_per_1M_prompt, usd_per_1M_completion]} overriding the built-in prices')
+    parser.add_argument('--results_db', type=str, default='results.sqlite', help='Run results database, one run per configuration ("" to disable)')
+    parser.add_argument('--metrics_port', type=int, default=None, help='Serve live progress and backend metrics in Prometheus format on this local port')
+    parser.add_argument('--status_file', type=str, default=None, help='JSON file rewritten with the same live metrics every --status_interval seconds')
+    parser.add_argument('--status_interval', type=float, default=15.0)
+    parser.add_argument('--output', type=str, default='big5_sweep.csv', help='Accuracy table (CSV)')
+    args = parser.parse_args()
+
+    roles = [r.strip() for r in args.roles.split(',') if r.strip()]
+    for role in roles:
+        if role not in ROLES:
+            raise Exception("Unknown role {}".format(role))
+    traits = [TRAIT_KEYS[t.strip().upper()] for t in args.traits.split(',') if t.strip()]
+    values = [int(v) for v in args.values.split(',')]
+    with open(args.base_config, 'r') as f:
+        base_profiles = json.load(f)
+
+    base_cfg = ClinicConfig(
+        doctor_llm=args.doctor_llm,
+        patient_llm=args.patient_llm,
+        measurement_llm=args.measurement_llm,
+        moderator_llm=args.moderator_llm,
+        dataset=args.agent_dataset,
+        total_inferences=args.total_inferences,
+        # concurrency is bounded by max_workers, no fixed pause needed
+        turn_delay=0.0,
+    )
+    set_api_keys(base_cfg, args.openai_api_key, args.replicate_api_key, args.anthropic_api_key)
+    if args.response_cache:
+        from utilities.response_cache import ResponseCache
+        set_response_cache(ResponseCache(args.response_cache))
+        print("Replaying cached responses from {}: identical requests are not sampled again".format(args.response_cache))
+    from utilities.cost_tracker import CostTracker
+    cost_tracker = (CostTracker.from_price_table(args.price_table, budget=args.budget, abort_in_flight=args.budget_abort)
+                    if args.price_table else CostTracker(budget=args.budget, abort_in_flight=args.budget_abort))
+    set_cost_tracker(cost_tracker)
+    metrics = start_metrics(args.metrics_port, args.status_file, args.status_interval)
+    if any(llm.startswith("HF_") for llm in (args.doctor_llm, args.patient_llm, args.measurement_llm, args.moderator_llm)):
+        from utilities.local_backend import configure_local_backend
+        configure_local_backend(args.hf_max_batch_size, args.hf_batch_window_ms, args.hf_max_conversations,
+                                args.hf_quantize, args.hf_threads)
+
+    profiles = sweep_profiles(base_profiles, roles, traits, values, args.mode, args.samples, args.seed)
+    if not profiles:
+        parser.error("the sweep settings yield no profiles")
+    loader = get_scenario_loader(args.agent_dataset)
+    scenario_ids = list(range(min(args.num_scenarios, loader.num_scenarios)))
+    print("Sweeping {} configurations x {} scenarios".format(len(profiles), len(scenario_ids)))
+    results = None
+    if args.results_db:
+        from utilities.results_db import ResultsDB
+        results = ResultsDB(args.results_db)
+    run_prefix = new_run_id("sweep")
+    rows = run_sweep(base_cfg, profiles, roles, scenario_ids, args.max_workers, results=results, run_prefix=run_prefix)
+    if metrics is not None:
+        metrics.close()
+    print_table(rows)
+    print("Spent ${:.4f} on {} calls ({} served from cache)".format(
+        cost_tracker.spent, cost_tracker.total["calls"], cost_tracker.total["cached_calls"]))
+    with open(args.output, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+    print("Saved", args.output)
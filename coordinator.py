@@ -0,0 +1,190 @@
+import argparse
+import threading
+import time
+import traceback
+from dataclasses import asdict, replace
+
+from agentclinic import ClinicConfig, run_scenario, set_api_keys
+from big5_sweep import print_table
+from matrix_runner import expand_cells, load_spec
+from utilities.cost_tracker import CostTracker
+from utilities.job_queue import JobQueue, worker_name
+from utilities.results_db import new_run_id
+from utilities.scenario import get_scenario_loader
+from utilities.scheduler import estimate_costs
+from utilities.utility import set_cost_tracker, set_response_cache
+
+# Coordinator/worker execution over a shared job queue.
+#   python coordinator.py submit spec.json --queue /shared/jobs.sqlite --wait
+#   python coordinator.py worker --queue /shared/jobs.sqlite --threads 4 --openai_api_key ...
+#   python coordinator.py collect <run prefix> --queue /shared/jobs.sqlite
+# submit expands a matrix spec (see matrix_runner.py) into one job per
+# (cell, scenario) and, with --wait, collects results into the results
+# database as they arrive. Workers are stateless: each thread leases a job,
+# runs the scenario with the usual agents, renews the lease while it runs and
+# posts the result back. A worker that dies stops renewing, its job's lease
+# expires and another worker picks it up, so slow or rate-limited hosts simply
+# take fewer jobs. `collect` picks up the results of an earlier submission
+# (e.g. when the submitting process died) and waits for its remaining jobs.
+
+
+def submit(queue, spec, results=None, log=print):
+    # concurrency is bounded by the worker threads, no fixed pause needed
+    cells = [(values, replace(cfg, turn_delay=0.0)) for values, cfg in expand_cells(spec)]
+    run_prefix = new_run_id(spec.get("name", "matrix"))
+    num_scenarios = spec.get("num_scenarios")
+    added = 0
+    for idx, (_, cfg) in enumerate(cells):
+        loader = get_scenario_loader(cfg.dataset)
+        scenario_ids = spec.get("scenario_ids") or list(range(min(num_scenarios or loader.num_scenarios, loader.num_scenarios)))
+        run_id = "{}-{}".format(run_prefix, idx)
+        if results is not None:
+            results.add_run(run_id, cfg)
+        # longest expected dialogues are leased first
+        costs = estimate_costs([(cfg, sid) for sid in scenario_ids], {cfg.dataset: loader}, results)
+        added += queue.enqueue(run_id, asdict(cfg), scenario_ids, costs)
+    log("Queued {} jobs for {} cells as {}".format(added, len(cells), run_prefix))
+    return run_prefix, cells
+
+
+def collect(queue, run_prefix, results=None, stats=None):
+    """Moves newly finished results into the results database; returns how many."""
+    stats = stats if stats is not None else {}
+    taken = queue.uncollected(run_prefix)
+    for job_id, run_id, result in taken:
+        if results is not None:
+            results.add_scenario(run_id, result)
+        # only after the write: a collector that dies first leaves the result for the next one
+        queue.mark_collected([job_id])
+        st = stats.setdefault(run_id, {"n": 0, "correct": 0, "diagnosed": 0, "turns": 0})
+        st["n"] += 1
+        st["turns"] += result["turns"]
+        if result["correct"] is not None:
+            st["diagnosed"] += 1
+            st["correct"] += int(result["correct"])
+    return len(taken)
+
+
+def work(queue, threads=1, lease_s=300.0, poll_s=5.0, keep_polling=False, api_keys=(None, None, None), log=print):
+    name = worker_name()
+    log("Worker {} polling {}".format(name, queue.path))
+    done = [0]
+    lock = threading.Lock()
+
+    def _heartbeat(job_id, stop):
+        while not stop.wait(lease_s / 3):
+            if not queue.renew(job_id, name, lease_s):
+                log("Lease on job {} was lost, its result may be discarded".format(job_id))
+                return
+
+    def _loop():
+        while True:
+            job = queue.lease(name, lease_s)
+            if job is None:
+                if not keep_polling and queue.pending() == 0:
+                    return
+                time.sleep(poll_s)
+                continue
+            job_id, run_id, sid, config = job
+            stop = threading.Event()
+            threading.Thread(target=_heartbeat, args=(job_id, stop), daemon=True).start()
+            try:
+                cfg = ClinicConfig(**config)
+                set_api_keys(cfg, *api_keys)
+                result = run_scenario(cfg, sid, get_scenario_loader(cfg.dataset), None, False)
+                queue.complete(job_id, name, result)
+                with lock:
+                    done[0] += 1
+                log("[{}] {} scenario {}: {}".format(name, run_id, sid,
+                                                     "no diagnosis" if result["correct"] is None else
+                                                     "correct" if result["correct"] else "incorrect"))
+            except Exception:
+                log("[{}] {} scenario {} failed".format(name, run_id, sid))
+                queue.fail(job_id, name, traceback.format_exc(limit=5))
+            finally:
+                stop.set()
+
+    workers = [threading.Thread(target=_loop) for _ in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    log("Worker {} finished {} jobs".format(name, done[0]))
+    return done[0]
+
+
+def wait(queue, run_prefix, results=None, poll_s=5.0, log=print):
+    """Collects the submission's results until none of its jobs can finish any more; returns per-run stats."""
+    stats = {}
+    while True:
+        collect(queue, run_prefix, results, stats)
+        counts = queue.counts(run_prefix)
+        log("[coordinator] queued {queued}, running {leased}, done {done}, failed {failed}".format(**counts))
+        if queue.pending(run_prefix) == 0:
+            collect(queue, run_prefix, results, stats)
+            return stats
+        time.sleep(poll_s)
+
+
+def result_rows(run_ids, stats, cells=None):
+    """One row per run; `cells` (from submit) adds the grid values."""
+    rows = []
+    for idx, run_id in enumerate(run_ids):
+        st = stats.get(run_id, {"n": 0, "correct": 0, "diagnosed": 0, "turns": 0})
+        row = {"cell": idx} if cells is not None else {"run_id": run_id}
+        if cells is not None:
+            row.update({k: str(v) for k, v in cells[idx][0].items()})
+        row["scenarios"] = st["n"]
+        row["accuracy"] = st["correct"] / st["n"] if st["n"] else 0.0
+        row["diagnosed"] = st["diagnosed"]
+        row["mean_turns"] = st["turns"] / max(st["n"], 1)
+        rows.append(row)
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Distributed AgentClinic runs over a shared job queue')
+    parser.add_argument('command', choices=['submit', 'worker', 'status', 'collect'])
+    parser.add_argument('spec', type=str, nargs='?', help='Matrix spec (JSON or YAML) for submit, run prefix for collect')
+    parser.add_argument('--queue', type=str, default='jobs.sqlite', help='Job queue file, on storage every worker can reach')
+    parser.add_argument('--results_db', type=str, default='results.sqlite', help='Where submit --wait and collect store results ("" to disable)')
+    parser.add_argument('--wait', action='store_true', help='submit: keep collecting results until every job is finished')
+    parser.add_argument('--poll', type=float, default=5.0, help='Seconds between queue polls')
+    parser.add_argument('--max_attempts', type=int, default=3, help='Deliveries of a job before it is marked failed')
+    parser.add_argument('--threads', type=int, default=1, help='worker: scenarios run concurrently by this worker')
+    parser.add_argument('--lease', type=float, default=300.0, help='worker: lease length in seconds, renewed while the scenario runs')
+    parser.add_argument('--keep_polling', action='store_true', help='worker: wait for new jobs instead of exiting when the queue is drained')
+    parser.add_argument('--response_cache', type=str, default='', help='worker: local SQLite response cache')
+    parser.add_argument('--openai_api_key', type=str, required=False, help='OpenAI API Key')
+    parser.add_argument('--replicate_api_key', type=str, required=False, help='Replicate API Key')
+    parser.add_argument('--anthropic_api_key', type=str, default=None, required=False, help='Anthropic API key for Claude 3.5 Sonnet')
+    args = parser.parse_args()
+
+    queue = JobQueue(args.queue, max_attempts=args.max_attempts)
+    if args.command == 'status':
+        print(queue.counts())
+    elif args.command == 'worker':
+        if args.response_cache:
+            from utilities.response_cache import ResponseCache
+            set_response_cache(ResponseCache(args.response_cache))
+        # per-scenario cost goes back with each result
+        set_cost_tracker(CostTracker())
+        work(queue, args.threads, args.lease, args.poll, args.keep_polling,
+             (args.openai_api_key, args.replicate_api_key, args.anthropic_api_key))
+    else:
+        if not args.spec:
+            parser.error("{} needs a {}".format(args.command, "spec" if args.command == "submit" else "run prefix"))
+        results = None
+        if args.results_db:
+            from utilities.results_db import ResultsDB
+            results = ResultsDB(args.results_db)
+        if args.command == 'collect':
+            # results of an earlier submission, e.g. after the submitting process died
+            run_prefix, cells = args.spec, None
+        else:
+            run_prefix, cells = submit(queue, load_spec(args.spec), results)
+        if args.command == 'collect' or args.wait:
+            stats = wait(queue, run_prefix, results, args.poll)
+            run_ids = queue.run_ids(run_prefix) if cells is None else \
+                ["{}-{}".format(run_prefix, idx) for idx in range(len(cells))]
+            print_table(result_rows(run_ids, stats, cells))
@@ -0,0 +1,222 @@
+import argparse
+import csv
+from dataclasses import replace
+
+from agentclinic import run_scenario, set_api_keys
+from big5_sweep import print_table
+from matrix_runner import expand_cells, load_spec
+from utilities.cost_tracker import BudgetExceeded, CostTracker
+from utilities.metrics import start_metrics
+from utilities.results_db import new_run_id
+from utilities.scenario import get_scenario_loader
+from utilities.scheduler import LongestFirstPool, estimate_costs, makespan_bound
+from utilities.utility import get_cost_tracker, get_metrics, set_cost_tracker, set_response_cache
+
+# Dialogue forking runner.
+# Runs the base configuration of every scenario up to doctor turn `fork_turn`,
+# snapshots the doctor, patient and measurement agents there and continues the
+# dialogue once per variant, each built from the base config with the variant's
+# overrides (a bias, persona or model that only applies from the fork on). The
+# shared opening turns are simulated and paid for once instead of once per
+# variant. A scenario whose baseline dialogue ends before the fork turn gives
+# the same result for every variant.
+# Each variant is stored as its own run in the results database with the full
+# transcript (prefix included) but only the cost of its own turns; the prefixes
+# and their cost go to a separate "<name>-<time>-<id>-prefix" run.
+#
+# Example spec:
+# {
+#   "name": "late-bias",
+#   "base": {"doctor_llm": "gpt4o", "total_inferences": 20},
+#   "fork_turn": 5,
+#   "variants": {"baseline": {}, "recency": {"doctor_bias": "recency"},
+#                "self_diagnosis": {"patient_bias": "self_diagnosis"}},
+#   "num_scenarios": 20
+# }
+
+
+def expand_variants(spec):
+    """Base ClinicConfig and [(variant name, overrides, ClinicConfig)]."""
+    base_args = spec.get("base", {})
+    base = expand_cells({"base": base_args})[0][1]
+    variants = []
+    for name, overrides in spec.get("variants", {}).items():
+        if "dataset" in overrides:
+            raise ValueError("Variant {} changes the dataset, forks must share their scenario".format(name))
+        variants.append((name, overrides, expand_cells({"base": dict(base_args, **overrides)})[0][1]))
+    if not variants:
+        raise ValueError("Spec has no variants")
+    return base, variants
+
+
+def run_forks(base, variants, scenario_ids, fork_turn, max_workers=8, results=None, run_prefix="fork", log=print):
+    loader = get_scenario_loader(base.dataset)
+    prefix_run = "{}-prefix".format(run_prefix)
+    if results is not None:
+        results.add_run(prefix_run, replace(base, total_inferences=fork_turn), kind="prefix")
+        for name, _, cfg in variants:
+            results.add_run("{}-{}".format(run_prefix, name), cfg)
+    # sid -> prefix result, None if the prefix was skipped or failed
+    prefixes = {}
+    stats = [{"n": 0, "correct": 0, "diagnosed": 0, "turns": 0, "errors": 0, "skipped": 0, "forked": 0}
+             for _ in variants]
+    tracker = get_cost_tracker()
+
+    # ("prefix", sid) jobs first, each releases its ("fork", variant index, sid) jobs
+    jobs = [("prefix", sid) for sid in scenario_ids]
+    after = {}
+    for p, sid in enumerate(scenario_ids):
+        after[p] = list(range(len(jobs), len(jobs) + len(variants)))
+        jobs += [("fork", v, sid) for v in range(len(variants))]
+    metrics = get_metrics()
+    if metrics is not None:
+        metrics.add_scenarios(len(jobs))
+
+    full = estimate_costs([(variants[job[1]][2] if job[0] == "fork" else base, job[-1]) for job in jobs],
+                          {base.dataset: loader}, results)
+    costs = [float(min(fork_turn, c)) if job[0] == "prefix" else max(c - fork_turn, 1.0) for job, c in zip(jobs, full)]
+    log("[fork] estimated {:.0f} turns of work, makespan >= {:.0f} turns on {} workers".format(
+        sum(costs), makespan_bound(costs, max_workers), max_workers))
+    for p in after:
+        # a prefix is ranked by the length of the forks waiting on it
+        costs[p] += max(costs[j] for j in after[p])
+
+    def _run(job):
+        sid = job[-1]
+        if job[0] == "fork" and prefixes.get(sid) is None:
+            if metrics is not None:
+                metrics.add_scenarios(-1)
+            if sid not in prefixes:
+                raise RuntimeError("shared prefix of scenario {} failed".format(sid))
+            return None
+        if tracker is not None and tracker.should_stop(in_flight=max_workers - 1):
+            if metrics is not None:
+                metrics.add_scenarios(-1)
+            if job[0] == "prefix":
+                prefixes[sid] = None
+            return None
+        if metrics is not None:
+            metrics.scenario_started()
+        result = None
+        try:
+            if job[0] == "prefix":
+                try:
+                    result = run_scenario(base, sid, loader, None, False, snapshot_at=fork_turn)
+                except BudgetExceeded:
+                    prefixes[sid] = None
+                    raise
+                prefixes[sid] = result
+            elif "snapshot" not in prefixes[sid]:
+                # diagnosed (or out of turns) before the fork, every variant shares the outcome
+                result = dict(prefixes[sid], cost={})
+            else:
+                result = run_scenario(variants[job[1]][2], sid, loader, None, False, fork_from=prefixes[sid]["snapshot"])
+            return result
+        finally:
+            if metrics is not None:
+                metrics.scenario_finished(result)
+
+    def _record(job, result, error):
+        if job[0] == "prefix":
+            # forks of a failed prefix report the error themselves
+            if error is not None and not isinstance(error, BudgetExceeded):
+                log("Prefix of scenario {} failed: {}".format(job[1], error))
+            elif result is not None and results is not None:
+                results.add_scenario(prefix_run, result)
+            return
+        _, v, sid = job
+        st = stats[v]
+        if isinstance(error, BudgetExceeded) or (error is None and result is None):
+            st["skipped"] += 1
+            return
+        if error is not None:
+            st["n"] += 1
+            st["errors"] += 1
+            log("Variant {} scenario {} failed: {}".format(variants[v][0], sid, error))
+            return
+        st["n"] += 1
+        st["turns"] += result["turns"]
+        st["forked"] += int("snapshot" in prefixes[sid])
+        if result["correct"] is not None:
+            st["diagnosed"] += 1
+            st["correct"] += int(result["correct"])
+        if results is not None:
+            results.add_scenario("{}-{}".format(run_prefix, variants[v][0]), result)
+
+    done = 0
+    pool = LongestFirstPool(max_workers)
+    for job, result, error in pool.run(list(range(len(jobs))), costs, lambda i: _run(jobs[i]), after):
+        _record(jobs[job], result, error)
+        done += 1
+        if done % 10 == 0 or done == len(jobs):
+            log("[fork] {}/{} runs finished".format(done, len(jobs)))
+
+    rows = []
+    for (name, overrides, _), st in zip(variants, stats):
+        row = {"variant": name, "overrides": ", ".join("{}={}".format(k, v) for k, v in overrides.items()) or "-"}
+        row["scenarios"] = st["n"]
+        row["accuracy"] = st["correct"] / (st["n"] - st["errors"]) if st["n"] > st["errors"] else 0.0
+        row["diagnosed"] = st["diagnosed"]
+        row["forked"] = st["forked"]
+        row["mean_turns"] = st["turns"] / max(st["n"] - st["errors"], 1)
+        row["errors"] = st["errors"]
+        row["skipped"] = st["skipped"]
+        rows.append(row)
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Fork several AgentClinic variants from a shared dialogue prefix')
+    parser.add_argument('spec', type=str, help='JSON (or YAML) fork spec')
+    parser.add_argument('--fork_turn', type=int, default=None, help='Doctor turns shared by all variants (default: spec)')
+    parser.add_argument('--openai_api_key', type=str, required=False, help='OpenAI API Key')
+    parser.add_argument('--replicate_api_key', type=str, required=False, help='Replicate API Key')
+    parser.add_argument('--anthropic_api_key', type=str, default=None, required=False, help='Anthropic API key for Claude 3.5 Sonnet')
+    parser.add_argument('--max_workers', type=int, default=None, help='Concurrent dialogues (default: spec or 8)')
+    parser.add_argument('--response_cache', type=str, default='response_cache.sqlite', help='SQLite response cache ("" to disable)')
+    parser.add_argument('--results_db', type=str, default='results.sqlite', help='Run results database, one run per variant ("" to disable)')
+    parser.add_argument('--budget', type=float, default=None, help='Skip runs not yet started once the projected spend (USD) reaches this')
+    parser.add_argument('--budget_abort', action='store_true', help='Also abort running scenarios once the budget is spent')
+    parser.add_argument('--metrics_port', type=int, default=None, help='Serve live progress and backend metrics in Prometheus format on this local port')
+    parser.add_argument('--status_file', type=str, default=None, help='JSON file rewritten with the same live metrics every --status_interval seconds')
+    parser.add_argument('--status_interval', type=float, default=15.0)
+    parser.add_argument('--output', type=str, default='forks.csv', help='Accuracy table (CSV)')
+    args = parser.parse_args()
+
+    spec = load_spec(args.spec)
+    fork_turn = args.fork_turn or spec.get("fork_turn")
+    if not fork_turn:
+        parser.error("the spec or --fork_turn must give the fork turn")
+    base, variants = expand_variants(spec)
+    # concurrency is bounded by max_workers, no fixed pause needed
+    base = replace(base, turn_delay=0.0)
+    variants = [(name, overrides, replace(cfg, turn_delay=0.0)) for name, overrides, cfg in variants]
+    for cfg in [base] + [v[2] for v in variants]:
+        set_api_keys(cfg, args.openai_api_key, args.replicate_api_key, args.anthropic_api_key)
+    if args.response_cache:
+        from utilities.response_cache import ResponseCache
+        set_response_cache(ResponseCache(args.response_cache))
+    cost_tracker = CostTracker(budget=args.budget, abort_in_flight=args.budget_abort)
+    set_cost_tracker(cost_tracker)
+    metrics = start_metrics(args.metrics_port, args.status_file, args.status_interval)
+    results = None
+    if args.results_db:
+        from utilities.results_db import ResultsDB
+        results = ResultsDB(args.results_db)
+
+    n = get_scenario_loader(base.dataset).num_scenarios
+    scenario_ids = spec.get("scenario_ids") or list(range(min(spec.get("num_scenarios") or n, n)))
+    run_prefix = new_run_id(spec.get("name", "fork"))
+    print("Forking {} variants of {} scenarios after turn {} as {}".format(len(variants), len(scenario_ids), fork_turn, run_prefix))
+    rows = run_forks(base, variants, scenario_ids, fork_turn, args.max_workers or spec.get("max_workers", 8),
+                     results, run_prefix)
+    if metrics is not None:
+        metrics.close()
+    print_table(rows)
+    print("Spent ${:.4f} on {} calls ({} served from cache)".format(
+        cost_tracker.spent, cost_tracker.total["calls"], cost_tracker.total["cached_calls"]))
+    with open(args.output, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+    print("Saved", args.output)
@@ -0,0 +1,68 @@
+import hashlib, json, os
+
+# Append-only JSONL output for the case generators.
+# Every generated case is written as one line tagged with the id of the source
+# case it came from (MIMIC subject_id, MedQA question hash) and fsync'ed, so a
+# crash loses at most the case in flight. On restart the ids already present
+# in the file are skipped and only the missing cases are sent to the LLM.
+
+
+def medqa_case_id(case):
+    # stable id for a MedQA question (the dataset has no usable id column)
+    blob = case["question"] + "\n" + case["answer"]
+    return hashlib.sha1(blob.encode("utf-8")).hexdigest()[:16]
+
+
+class CaseWriter:
+    def __init__(self, path, id_field="source_id"):
+        self.path = path
+        self.id_field = id_field
+        self.done = set()
+        self._recover()
+        self._f = open(self.path, "a", encoding="utf-8")
+
+    def _recover(self):
+        """Load the ids already written and drop a partially written last line."""
+        if not os.path.exists(self.path):
+            return
+        good_end = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # interrupted write, always the last line
+                    break
+                good_end += len(line)
+                try:
+                    case = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(case, dict) and self.id_field in case:
+                    self.done.add(str(case[self.id_field]))
+        if good_end < os.path.getsize(self.path):
+            print("Truncating incomplete tail of {}".format(self.path))
+            with open(self.path, "rb+") as f:
+                f.truncate(good_end)
+
+    def __contains__(self, case_id):
+        return str(case_id) in self.done
+
+    def __len__(self):
+        return len(self.done)
+
+    def write(self, case_id, case):
+        """Append one case (a dict) and make it durable before returning."""
+        record = {self.id_field: str(case_id)}
+        record.update(case)
+        self._f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self.done.add(str(case_id))
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
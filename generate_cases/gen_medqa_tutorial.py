@@ -1,18 +1,17 @@
-import json, openai, re, time
-from datasets import load_dataset
+import itertools, json, openai
+
+from case_writer import CaseWriter, medqa_case_id
+from generation_pool import GenerationPool
+from medqa_source import load_medqa_cases
+from osce_validation import generate_valid_osce
 
 # Set OpenAI key
 openai.api_key = "insert-openai-api-key-here"
 
-# Extract the testing set for the MedQA dataset
-medqa_test_set = load_dataset("bigbio/med_qa")["test"]
-
-# Extract all case studies from MedQA
-case_studies = [case for case in medqa_test_set if "likely diagnosis?" in case["question"]]
-
-# Randomize cases (optional)
-import random
-random.shuffle(case_studies)
+# Extract the "likely diagnosis?" case studies from the MedQA test set.
+# They are cached in medqa_source.jsonl after the first run (which works
+# offline from then on) and shuffled with a fixed seed for reproducible runs.
+case_studies = load_medqa_cases("medqa_source.jsonl", seed=0)
 
 # How many cases studies to generate
 cases_to_gen = 108 - 78
@@ -72,36 +71,35 @@ Here is an example of the structure:
 }
 """
 
-outp_str = ""
-cases_generated = 0
-for _case in case_studies:
-    messages = [
+def osce_messages(_case):
+    return [
         {"role": "system", "content": "Please generate a sample Objective Structured Clinical Examination (OSCE) for the patient actor and the doctor, including what the correct diagnosis should be as a structured json. Only provide the doctor with the objective and provide \"test results\" as a separate category. Provide these for a primary care doctor exam."},
         {"role": "user", "content": " Generate a OSCE for the following case study {}.".format(_case) + "Please read the \"answer\" category for the correct diagnosis. \n\nHere is an example of correct the OSCE format" + examples + """\n\nPlease create a new one here:\n"""}
     ]
-    # Generate OSCE json
-    response = openai.ChatCompletion.create(
-            model="gpt-4-turbo-preview",
-            messages=messages,
-        )
-    # Remove potential garbage
-    answer = response["choices"][0]["message"]["content"]
-    answer = re.sub("\s+", " ", answer)
-    answer = answer.replace("```json ", "")
-    answer = answer.replace("```", "")
-    try: 
-      # Make sure diagnoses match
-      if _case["answer"].lower() != json.loads(answer)["OSCE_Examination"]["Correct_Diagnosis"].lower():
-         continue
-      
-      outp_str += answer + "\n"
-      # add it to the JSON
-      with open("grounded.jsonl", "w") as f:
-          f.write(outp_str)
-      cases_generated += 1
-    except Exception: 
-      pass
-    # Total number of cases to generate met
-    if cases_generated >= cases_to_gen:
-       exit()
-    time.sleep(1)
+
+# Append-only output keyed by a hash of the MedQA question;
+# rerunning skips cases that were already written
+writer = CaseWriter("grounded.jsonl")
+cases_generated = len(writer)
+pending_cases = [_case for _case in case_studies if medqa_case_id(_case) not in writer]
+
+# Generate OSCE json concurrently, results come back in case order.
+# Each case is validated against the OSCE schema; malformed ones are
+# repaired locally or re-requested before they reach the file.
+# Once the target is met no new cases are submitted, but the ones already in
+# flight (paid for) are still written.
+pool = GenerationPool(model="gpt-4-turbo-preview", max_workers=8)
+jobs = ((_case, osce_messages(_case))
+        for _case in itertools.takewhile(lambda _c: cases_generated < cases_to_gen, pending_cases))
+for _case, case, error in pool.imap(jobs, fn=lambda _m: generate_valid_osce(pool, _m)):
+    if error is not None:
+       print("Case {} failed: {}".format(medqa_case_id(_case), error))
+       continue
+    # Make sure diagnoses match
+    if _case["answer"].lower() != case["OSCE_Examination"]["Correct_Diagnosis"].lower():
+       continue
+
+    # add it to the JSON
+    writer.write(medqa_case_id(_case), case)
+    cases_generated += 1
+writer.close()
@@ -0,0 +1,132 @@
+import threading, time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+
+# Concurrent OSCE generation for the case generators.
+# Requests run on a bounded thread pool, are throttled per model by a
+# requests/min and tokens/min bucket, come back in submission order, and a
+# failing case is reported to the caller instead of stopping the whole run.
+
+# Default provider quotas per model; override via GenerationPool arguments
+MODEL_LIMITS = {
+    "gpt-4-turbo-preview": {"requests_per_min": 500, "tokens_per_min": 300000},
+    "gpt-4o": {"requests_per_min": 500, "tokens_per_min": 300000},
+    "gpt-4o-mini": {"requests_per_min": 500, "tokens_per_min": 200000},
+}
+
+
+def estimate_tokens(messages, max_output_tokens):
+    # ~4 characters per token is close enough for budgeting
+    chars = sum(len(_m["content"]) for _m in messages)
+    return chars // 4 + max_output_tokens
+
+
+class _Bucket:
+    def __init__(self, per_min):
+        self.capacity = float(per_min)
+        self.level = float(per_min)
+        self.rate = per_min / 60.0
+        self.stamp = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait_time(self, amount):
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+
+class RateLimiter:
+    """Token buckets for requests/min and tokens/min, shared by all threads."""
+
+    def __init__(self, requests_per_min=None, tokens_per_min=None):
+        self._lock = threading.Lock()
+        self._requests = _Bucket(requests_per_min) if requests_per_min else None
+        self._tokens = _Bucket(tokens_per_min) if tokens_per_min else None
+
+    def acquire(self, tokens=0):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                wait = 0.0
+                for bucket, amount in ((self._requests, 1), (self._tokens, tokens)):
+                    if bucket is not None:
+                        bucket.refill(now)
+                        wait = max(wait, bucket.wait_time(amount))
+                if wait == 0.0:
+                    if self._requests is not None:
+                        self._requests.level -= 1
+                    if self._tokens is not None:
+                        self._tokens.level -= min(tokens, self._tokens.capacity)
+                    return
+            time.sleep(wait)
+
+    def settle(self, estimated, actual):
+        # correct the token bucket once the real usage is known
+        if self._tokens is not None:
+            with self._lock:
+                self._tokens.level -= actual - estimated
+
+
+class GenerationPool:
+    def __init__(self, model="gpt-4-turbo-preview", max_workers=8, requests_per_min=None,
+                 tokens_per_min=None, max_output_tokens=1500, tries=5, backoff=2.0):
+        limits = MODEL_LIMITS.get(model, {})
+        self.model = model
+        self.max_workers = max_workers
+        self.max_output_tokens = max_output_tokens
+        self.tries = tries
+        self.backoff = backoff
+        self.limiter = RateLimiter(
+            requests_per_min or limits.get("requests_per_min"),
+            tokens_per_min or limits.get("tokens_per_min"))
+
+    def complete(self, messages) -> str:
+        """One chat completion, rate limited and retried with exponential backoff."""
+        estimated = estimate_tokens(messages, self.max_output_tokens)
+        for attempt in range(self.tries):
+            self.limiter.acquire(estimated)
+            try:
+                response = openai.ChatCompletion.create(
+                        model=self.model,
+                        messages=messages,
+                    )
+            except Exception:
+                if attempt == self.tries - 1:
+                    raise
+                time.sleep(self.backoff * (2 ** attempt))
+                continue
+            usage = response.get("usage") or {}
+            if "total_tokens" in usage:
+                self.limiter.settle(estimated, usage["total_tokens"])
+            return response["choices"][0]["message"]["content"]
+
+    def imap(self, jobs, fn=None):
+        """
+        jobs: iterable of (key, messages). Yields (key, result, error) in the
+        order the jobs were given; `error` is the exception for a failed case.
+        `fn(messages)` produces the result (default: self.complete).
+        At most 2 * max_workers jobs are pulled from `jobs` ahead of the consumer.
+        """
+        fn = fn or self.complete
+        ex = ThreadPoolExecutor(max_workers=self.max_workers)
+        pending = deque()
+        try:
+            for key, messages in jobs:
+                pending.append((key, ex.submit(fn, messages)))
+                if len(pending) >= 2 * self.max_workers:
+                    yield self._collect(*pending.popleft())
+            while pending:
+                yield self._collect(*pending.popleft())
+        finally:
+            ex.shutdown(wait=True, cancel_futures=True)
+
+    @staticmethod
+    def _collect(key, future):
+        try:
+            return key, future.result(), None
+        except Exception as e:
+            return key, None, e
@@ -0,0 +1,73 @@
+import hashlib, json, os, random
+
+from case_writer import medqa_case_id
+
+# Prepared-source cache for gen_medqa_tutorial.py.
+# The "likely diagnosis?" cases are extracted from bigbio/med_qa once and
+# stored as JSONL (a metadata line followed by one case per line) together with
+# a content hash. Later runs read the file directly, so they start instantly
+# and work offline. The case order is a seeded shuffle of a canonical order, so
+# the same seed always yields the same sequence of cases.
+
+
+def _content_hash(cases):
+    h = hashlib.sha256()
+    for case in cases:
+        h.update(json.dumps(case, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+        h.update(b"\n")
+    return h.hexdigest()
+
+
+def _extract_cases(split="test"):
+    from datasets import load_dataset
+
+    # Extract the testing set for the MedQA dataset
+    medqa_test_set = load_dataset("bigbio/med_qa")[split]
+    # Extract all case studies from MedQA
+    cases = [dict(case) for case in medqa_test_set if "likely diagnosis?" in case["question"]]
+    # canonical order, independent of how the hub serves the split
+    cases.sort(key=medqa_case_id)
+    return cases
+
+
+def _read(cache_path):
+    with open(cache_path, "r", encoding="utf-8") as f:
+        meta = json.loads(f.readline())["_meta"]
+        cases = [json.loads(line) for line in f]
+    if len(cases) != meta["count"] or _content_hash(cases) != meta["sha256"]:
+        raise ValueError("{} is incomplete or modified".format(cache_path))
+    return meta, cases
+
+
+def _write(cache_path, cases, split):
+    meta = {"source": "bigbio/med_qa", "split": split, "count": len(cases), "sha256": _content_hash(cases)}
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(json.dumps({"_meta": meta}) + "\n")
+        for case in cases:
+            f.write(json.dumps(case, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, cache_path)
+    return meta
+
+
+def load_medqa_cases(cache_path="medqa_source.jsonl", seed=0, split="test", refresh=False):
+    """
+    Returns the filtered MedQA cases in a deterministic, seeded order.
+    The dataset is only downloaded when the cache is missing, invalid, or
+    `refresh` is set.
+    """
+    cases = None
+    if not refresh and os.path.exists(cache_path):
+        try:
+            meta, cases = _read(cache_path)
+            print("Loaded {} MedQA cases from {} (sha256 {})".format(meta["count"], cache_path, meta["sha256"][:12]))
+        except (OSError, ValueError, KeyError) as e:
+            print("Ignoring MedQA cache: {}".format(e))
+            cases = None
+    if cases is None:
+        cases = _extract_cases(split)
+        meta = _write(cache_path, cases, split)
+        print("Prepared {} MedQA cases in {} (sha256 {})".format(meta["count"], cache_path, meta["sha256"][:12]))
+    # Randomize cases reproducibly
+    random.Random(seed).shuffle(cases)
+    return cases
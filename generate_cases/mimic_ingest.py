@@ -0,0 +1,324 @@
+import csv, hashlib, io, json, os
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+# Streaming readers for the MIMIC-IV hosp/ tables used by gen_mimic_tutorial.py.
+# The patient cohort is chosen first (from diagnoses_icd), and every large table
+# is then read in a single pass that only keeps rows for the selected subjects,
+# so memory scales with the cohort rather than with the hospital database.
+# Large tables are split at record boundaries and parsed in a process pool, and
+# the finished per-patient records are cached next to the source tables.
+
+# bump when the record layout or merge rules change
+CACHE_VERSION = 1
+DEFAULT_CHUNK_BYTES = 64 * 1024 * 1024
+
+# table, columns, first value wins (otherwise the last value wins)
+TEST_TABLES = (
+    ("omr", ("subject_id", "result_name", "result_value"), True),
+    ("microbiologyevents", ("subject_id", "test_name", "comments"), False),
+    ("labevents", ("subject_id", "itemid", "value"), True),
+)
+
+
+def table_path(base_str, name):
+    return os.path.join(base_str, "hosp", name + ".csv")
+
+
+def stream_columns(path, fields, subjects=None, subject_field="subject_id"):
+    """
+    Yield a tuple of the requested `fields` for every row of a CSV table.
+    If `subjects` is given, rows whose subject id is not in it are skipped
+    before any other column is touched.
+    """
+    with open(path, "r", newline="") as f:
+        reader = csv.reader(f)
+        labels = next(reader)
+        idx = [labels.index(_field) for _field in fields]
+        subj_idx = labels.index(subject_field) if subjects is not None else None
+        for row in reader:
+            try:
+                if subj_idx is not None and row[subj_idx] not in subjects:
+                    continue
+                yield tuple(row[_i] for _i in idx)
+            except IndexError:
+                # truncated / malformed line
+                continue
+
+
+def load_icd_titles(base_str):
+    # small dimension table: icd_code -> long_title
+    return {code: title for code, title in stream_columns(
+        table_path(base_str, "d_icd_diagnoses"), ("icd_code", "long_title"))}
+
+
+def load_lab_items(base_str):
+    # small dimension table: itemid -> "label fluid"
+    return {itemid: label + " " + fluid for itemid, label, fluid in stream_columns(
+        table_path(base_str, "d_labitems"), ("itemid", "label", "fluid"))}
+
+
+def new_patient_record():
+    return {
+        "tests": dict(),
+        "history": list(),
+        "diagnosis": -1,
+        "diag_imp": 9999,
+        "demographics": dict(),
+    }
+
+
+def select_cohort(base_str, max_patients=300, icd_titles=None):
+    """
+    Single pass over diagnoses_icd. Returns an ordered dict of
+    subject_id -> patient record for the first patients (in file order) that
+    have fewer than two non-history diagnoses.
+    Details are only held for patients still eligible, so memory is bounded by
+    the number of distinct subjects rather than the number of diagnosis rows.
+    """
+    if icd_titles is None:
+        icd_titles = load_icd_titles(base_str)
+    num_diagnoses = {}
+    candidates = {}
+    for pat_id, seq_num, icd_code in stream_columns(
+            table_path(base_str, "diagnoses_icd"), ("subject_id", "seq_num", "icd_code")):
+        if pat_id not in num_diagnoses:
+            num_diagnoses[pat_id] = 0
+            candidates[pat_id] = new_patient_record()
+        diagn = icd_titles.get(icd_code)
+        if diagn is None:
+            continue
+        if "history" in diagn.lower():
+            if pat_id in candidates:
+                candidates[pat_id]["history"].append(diagn)
+            continue
+        num_diagnoses[pat_id] += 1
+        if num_diagnoses[pat_id] >= 2:
+            # no longer eligible, drop its details
+            candidates.pop(pat_id, None)
+            continue
+        try:
+            candidates[pat_id]["diag_imp"] = int(seq_num)
+            candidates[pat_id]["diagnosis"] = diagn
+        except ValueError:
+            pass
+
+    # Choose only cases with diagnoses == 1 (in order of first appearance)
+    cohort = {}
+    for pat_id in candidates:
+        if len(cohort) >= max_patients:
+            break
+        cohort[pat_id] = candidates[pat_id]
+    return cohort
+
+
+def attach_demographics(base_str, patient_info):
+    for pat_id, race in stream_columns(
+            table_path(base_str, "admissions"), ("subject_id", "race"), subjects=patient_info):
+        patient_info[pat_id]["demographics"].setdefault("race", race)
+    for pat_id, gender, anchor_age in stream_columns(
+            table_path(base_str, "patients"), ("subject_id", "gender", "anchor_age"), subjects=patient_info):
+        patient_info[pat_id]["demographics"]["gender"] = gender
+        patient_info[pat_id]["demographics"]["anchor_age"] = anchor_age
+
+
+def _test_entry(table, row, lab_items):
+    # normalise one (subject_id, name, value) row into a tests entry, None to skip
+    pat_id, name, value = row
+    if table == "microbiologyevents":
+        return pat_id, name.lower(), value.lower()
+    if table == "labevents":
+        # ignore empty ones
+        if "_" in value or len(value) == 0:
+            return None
+        test = lab_items.get(name)
+        if test is None:
+            return None
+        return pat_id, test, value
+    return pat_id, name, value
+
+
+def _record_bounds(f, data_start, size, chunk_bytes):
+    """
+    Offsets of record starts roughly `chunk_bytes` apart. The file is scanned
+    once with its quote parity tracked, so a newline inside a quoted multi-line
+    field (e.g. microbiology comments) is never taken as a record boundary.
+    """
+    bounds = [data_start]
+    target = data_start + chunk_bytes
+    inside = False
+    pos = data_start
+    f.seek(data_start)
+    while target < size:
+        block = f.read(1 << 20)
+        if not block:
+            break
+        i = 0
+        while i < len(block):
+            if target - pos > i:
+                # before the next target only the parity matters
+                stop = min(target - pos, len(block))
+                inside ^= block.count(b'"', i, stop) & 1
+                i = stop
+                continue
+            n = block.find(b"\n", i)
+            if n == -1:
+                inside ^= block.count(b'"', i) & 1
+                break
+            q = block.find(b'"', i, n)
+            if q != -1:
+                inside = not inside
+                i = q + 1
+                continue
+            i = n + 1
+            if not inside:
+                bounds.append(pos + i)
+                target = pos + i + chunk_bytes
+        pos += len(block)
+    return bounds
+
+
+def split_chunks(path, chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """
+    Returns (labels, [(start, end), ...]) byte ranges covering the data rows of
+    `path`, each range starting and ending on a record boundary.
+    """
+    with open(path, "rb") as f:
+        header = f.readline()
+        labels = next(csv.reader([header.decode("utf-8")]))
+        data_start = f.tell()
+        size = os.fstat(f.fileno()).st_size
+        bounds = _record_bounds(f, data_start, size, chunk_bytes)
+        bounds.append(size)
+    return labels, [(bounds[_i], bounds[_i + 1]) for _i in range(len(bounds) - 1) if bounds[_i] < bounds[_i + 1]]
+
+
+def _chunk_rows(data, labels, fields, subjects):
+    if pd is not None:
+        # vectorized path: parse only the needed columns and filter with isin;
+        # malformed rows are skipped like in the csv fallback below
+        df = pd.read_csv(io.BytesIO(data), header=None, names=labels, usecols=list(fields),
+                         dtype=str, keep_default_na=False, engine="c", on_bad_lines="skip")
+        df = df[df["subject_id"].isin(subjects)]
+        return df[list(fields)].itertuples(index=False, name=None)
+    subj_idx = labels.index("subject_id")
+    idx = [labels.index(_field) for _field in fields]
+    rows = []
+    for row in csv.reader(io.StringIO(data.decode("utf-8", errors="replace"))):
+        try:
+            if row[subj_idx] in subjects:
+                rows.append(tuple(row[_i] for _i in idx))
+        except IndexError:
+            continue
+    return rows
+
+
+def _parse_chunk(path, start, end, labels, table, fields, first_wins, subjects, lab_items):
+    """Worker: parse one byte range and reduce it to {subject_id: {test: value}}."""
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    tests = {}
+    for row in _chunk_rows(data, labels, fields, subjects):
+        entry = _test_entry(table, row, lab_items)
+        if entry is None:
+            continue
+        pat_id, test, value = entry
+        pat_tests = tests.setdefault(pat_id, {})
+        if first_wins:
+            pat_tests.setdefault(test, value)
+        else:
+            pat_tests[test] = value
+    return tests
+
+
+def attach_tests(base_str, patient_info, lab_items=None, workers=None, chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """
+    Fill patient_info[...]["tests"] from omr, microbiologyevents and labevents.
+    Chunk results are merged in file order, so the outcome does not depend on
+    which worker finishes first.
+    """
+    if lab_items is None:
+        lab_items = load_lab_items(base_str)
+    subjects = frozenset(patient_info)
+    pool = ProcessPoolExecutor(max_workers=workers) if workers != 1 else None
+    try:
+        for table, fields, first_wins in TEST_TABLES:
+            path = table_path(base_str, table)
+            labels, chunks = split_chunks(path, chunk_bytes)
+            args = (labels, table, fields, first_wins, subjects, lab_items)
+            if pool is None or len(chunks) < 2:
+                results = (_parse_chunk(path, start, end, *args) for start, end in chunks)
+            else:
+                futures = [pool.submit(_parse_chunk, path, start, end, *args) for start, end in chunks]
+                results = (_future.result() for _future in futures)
+            for chunk_tests in results:
+                for pat_id, entries in chunk_tests.items():
+                    tests = patient_info[pat_id]["tests"]
+                    if first_wins:
+                        for test, value in entries.items():
+                            tests.setdefault(test, value)
+                    else:
+                        tests.update(entries)
+            print("Done", table)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+
+def _cache_key(base_str, max_patients):
+    names = ["d_icd_diagnoses", "diagnoses_icd", "admissions", "patients", "d_labitems"]
+    names += [_table for _table, _, _ in TEST_TABLES]
+    stats = []
+    for name in names:
+        st = os.stat(table_path(base_str, name))
+        stats.append([name, st.st_size, int(st.st_mtime)])
+    blob = json.dumps({"version": CACHE_VERSION, "max_patients": max_patients, "tables": stats})
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+def load_cached_patients(cache_path, key):
+    try:
+        with open(cache_path, "r") as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cached.get("key") != key:
+        return None
+    return cached["patients"]
+
+
+def save_cached_patients(cache_path, key, patient_info):
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"key": key, "patients": patient_info}, f)
+    os.replace(tmp_path, cache_path)
+
+
+def build_patient_info(base_str, max_patients=300, workers=None, chunk_bytes=DEFAULT_CHUNK_BYTES,
+                       cache_path=None, use_cache=True):
+    """
+    Build the per-patient records for the cohort. The result is cached in
+    `cache_path` (default: hosp/patient_info_cache.json) and reused while the
+    source tables are unchanged, so later OSCE generations skip CSV parsing.
+    """
+    if cache_path is None:
+        cache_path = os.path.join(base_str, "hosp", "patient_info_cache.json")
+    key = _cache_key(base_str, max_patients)
+    if use_cache:
+        patient_info = load_cached_patients(cache_path, key)
+        if patient_info is not None:
+            print("Loaded {} patients from {}".format(len(patient_info), cache_path))
+            return patient_info
+    patient_info = select_cohort(base_str, max_patients=max_patients)
+    print("Selected {} patients".format(len(patient_info)))
+    attach_demographics(base_str, patient_info)
+    print("Done")
+    attach_tests(base_str, patient_info, workers=workers, chunk_bytes=chunk_bytes)
+    if use_cache:
+        save_cached_patients(cache_path, key, patient_info)
+    return patient_info
@@ -0,0 +1,118 @@
+import json, re
+
+# Validation and repair of generated OSCE cases.
+# A case is checked against the fields the ScenarioLoaders read
+# (utilities/scenario.py). Cheap syntax problems (code fences, trailing commas,
+# truncated braces) are fixed locally; only cases that still fail are sent back
+# to the model, with a prompt that names the problems.
+
+# fields read by ScenarioMedQA / ScenarioMIMICIVQA
+REQUIRED_FIELDS = (
+    "Objective_for_Doctor",
+    "Patient_Actor",
+    "Physical_Examination_Findings",
+    "Test_Results",
+    "Correct_Diagnosis",
+)
+
+
+class OsceValidationError(Exception):
+    def __init__(self, problems, answer=None):
+        super().__init__("; ".join(problems))
+        self.problems = problems
+        self.answer = answer
+
+
+def clean_answer(answer):
+    # Remove potential garbage
+    answer = re.sub(r"\s+", " ", answer)
+    answer = answer.replace("```json ", "")
+    answer = answer.replace("```", "")
+    return answer.strip()
+
+
+def repair_json(text):
+    """Best-effort local fix of near-JSON model output. Returns a string."""
+    start = text.find("{")
+    if start > 0:
+        text = text[start:]
+    # drop trailing commas before a closing bracket
+    text = re.sub(r",\s*([}\]])", r"\1", text)
+    # close an unterminated string and any unbalanced brackets
+    stack, in_str, escaped = [], False, False
+    for ch in text:
+        if in_str:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_str = False
+        elif ch == '"':
+            in_str = True
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+        elif ch in "}]" and stack:
+            stack.pop()
+    if in_str:
+        text += '"'
+    text = re.sub(r",\s*$", "", text)
+    return text + "".join(reversed(stack))
+
+
+def _decode(text):
+    # ignores model chatter after the top-level object
+    return json.JSONDecoder().raw_decode(text[max(text.find("{"), 0):])[0]
+
+
+def schema_problems(case):
+    if not isinstance(case, dict) or not isinstance(case.get("OSCE_Examination"), dict):
+        return ["missing top-level \"OSCE_Examination\" object"]
+    osce = case["OSCE_Examination"]
+    problems = ["missing \"{}\"".format(_field) for _field in REQUIRED_FIELDS if _field not in osce]
+    diagnosis = osce.get("Correct_Diagnosis")
+    if "Correct_Diagnosis" in osce and (not isinstance(diagnosis, str) or not diagnosis.strip()):
+        problems.append("\"Correct_Diagnosis\" must be a non-empty string")
+    if "Test_Results" in osce and not osce["Test_Results"]:
+        problems.append("\"Test_Results\" is empty")
+    return problems
+
+
+def parse_osce(answer):
+    """Returns (case or None, problems). Applies local repairs before giving up."""
+    answer = clean_answer(answer)
+    try:
+        case = _decode(answer)
+    except ValueError:
+        try:
+            case = _decode(repair_json(answer))
+        except ValueError as e:
+            return None, ["invalid JSON ({})".format(e)]
+    return case, schema_problems(case)
+
+
+def repair_messages(messages, answer, problems):
+    """Targeted follow-up for a case that failed validation."""
+    note = ("Your OSCE had these problems: " + "; ".join(problems) + ". "
+            "Return only the corrected, complete OSCE as a single JSON object with the keys "
+            + ", ".join(REQUIRED_FIELDS) + " inside \"OSCE_Examination\".")
+    if all(_p.startswith("invalid JSON") for _p in problems):
+        # syntax only: no need to resend the case and the template
+        return [messages[0], {"role": "user", "content": "Fix this JSON: " + answer + "\n\n" + note}]
+    return list(messages) + [{"role": "assistant", "content": answer}, {"role": "user", "content": note}]
+
+
+def generate_valid_osce(pool, messages, max_repairs=2):
+    """
+    Generate one case with `pool` (a GenerationPool) and re-request it with a
+    targeted prompt while it fails validation. Returns the parsed case dict.
+    """
+    answer = pool.complete(messages)
+    for attempt in range(max_repairs + 1):
+        case, problems = parse_osce(answer)
+        if not problems:
+            return case
+        if attempt == max_repairs:
+            break
+        answer = pool.complete(repair_messages(messages, clean_answer(answer), problems))
+    raise OsceValidationError(problems, answer)
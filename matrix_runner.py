@@ -0,0 +1,222 @@
+import argparse
+import csv
+import itertools
+import json
+from dataclasses import fields, replace
+
+from agentclinic import ClinicConfig, run_scenario, set_api_keys
+from big5_sweep import print_table
+from utilities.cost_tracker import BudgetExceeded, CostTracker
+from utilities.metrics import start_metrics
+from utilities.results_db import new_run_id
+from utilities.scenario import get_scenario_loader
+from utilities.scheduler import LongestFirstPool, estimate_costs, makespan_bound
+from utilities.utility import get_cost_tracker, get_metrics, load_personalities, set_cost_tracker, set_response_cache
+
+# Experiment matrix runner.
+# Expands a JSON/YAML spec into the cross product of its grid and runs every
+# (cell, scenario) pair in one process: scenarios are loaded once per dataset,
+# backend clients and the response cache are shared, and results go to the
+# results database as one run per cell.
+# Work is ordered for cache hits: jobs whose dialogues start identically (same
+# scenario and doctor setup) form a group, one job per group runs first and
+# fills the response cache, and the rest of the group is released once it is
+# done, so their shared opening turns are served from the cache. Groups with
+# the longest expected dialogues are started first (see utilities/scheduler.py).
+#
+# Example spec:
+# {
+#   "name": "bias-grid",
+#   "base": {"total_inferences": 20, "moderator_llm": "gpt4o"},
+#   "grid": {"doctor_llm": ["gpt4o", "gpt-4o-mini"], "doctor_bias": ["None", "recency"],
+#            "patient_bias": ["None", "self_diagnosis"], "dataset": ["MedQA"]},
+#   "num_scenarios": 20
+# }
+
+# ClinicConfig fields that shape the doctor's opening turns
+PREFIX_FIELDS = ["dataset", "inf_type", "doctor_llm", "doctor_bias", "total_inferences", "img_request",
+                 "doctor_persona_json", "enable_big5"]
+
+
+def load_spec(path):
+    with open(path, "r") as f:
+        if path.endswith((".yaml", ".yml")):
+            import yaml
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+def expand_cells(spec):
+    known = {f.name for f in fields(ClinicConfig)}
+    base_args = dict(spec.get("base", {}))
+    grid = spec.get("grid", {})
+    for key in list(base_args) + list(grid):
+        if key not in known:
+            raise ValueError("Unknown ClinicConfig field in spec: {}".format(key))
+    base = ClinicConfig(**base_args)
+    if base.enable_big5 and not base.personalities:
+        base = replace(base, personalities=load_personalities())
+    keys = list(grid)
+    cells = []
+    for values in itertools.product(*(grid[k] for k in keys)):
+        cells.append((dict(zip(keys, values)), replace(base, **dict(zip(keys, values)))))
+    return cells
+
+
+def prefix_key(cfg, scenario_id):
+    doctor_personality = cfg.personalities.get("doctor", "") if cfg.enable_big5 else ""
+    return tuple(str(getattr(cfg, f)) for f in PREFIX_FIELDS) + (doctor_personality, scenario_id)
+
+
+def order_jobs(cells, scenario_ids):
+    """Groups of job indices sharing a dialogue prefix; related cells sorted next to each other."""
+    jobs = [(idx, cfg, sid) for idx, (_, cfg) in enumerate(cells) for sid in scenario_ids[cfg.dataset]]
+    groups = {}
+    for job in jobs:
+        groups.setdefault(prefix_key(job[1], job[2]), []).append(job)
+    ordered = []
+    for key in sorted(groups):
+        # patient setup next, so followers that also share patient turns stay adjacent
+        ordered.append(sorted(groups[key], key=lambda j: (j[1].patient_llm, str(j[1].patient_bias), j[0])))
+    return ordered
+
+
+def run_matrix(cells, scenario_ids, max_workers=8, results=None, run_prefix="matrix", log=print):
+    groups = order_jobs(cells, scenario_ids)
+    if results is not None:
+        for idx, (_, cfg) in enumerate(cells):
+            results.add_run("{}-{}".format(run_prefix, idx), cfg)
+    loaders = {ds: get_scenario_loader(ds) for ds in scenario_ids}
+    stats = [{"n": 0, "correct": 0, "diagnosed": 0, "turns": 0, "errors": 0, "skipped": 0} for _ in cells]
+    total = sum(len(g) for g in groups)
+    done = 0
+    tracker = get_cost_tracker()
+
+    metrics = get_metrics()
+    if metrics is not None:
+        metrics.add_scenarios(total)
+
+    def _run(job):
+        # over budget: jobs not started yet are skipped (assuming the other workers are busy)
+        if tracker is not None and tracker.should_stop(in_flight=max_workers - 1):
+            if metrics is not None:
+                metrics.add_scenarios(-1)
+            return None
+        if metrics is not None:
+            metrics.scenario_started()
+        result = None
+        try:
+            result = run_scenario(job[1], job[2], loaders[job[1].dataset], None, False)
+            return result
+        finally:
+            if metrics is not None:
+                metrics.scenario_finished(result)
+
+    def _record(job, result, error):
+        idx, cfg, sid = job
+        st = stats[idx]
+        if isinstance(error, BudgetExceeded):
+            st["skipped"] += 1
+            return
+        if error is not None:
+            st["n"] += 1
+            st["errors"] += 1
+            log("Cell {} scenario {} failed: {}".format(idx, sid, error))
+            return
+        if result is None:
+            st["skipped"] += 1
+            return
+        st["n"] += 1
+        st["turns"] += result["turns"]
+        if result["correct"] is not None:
+            st["diagnosed"] += 1
+            st["correct"] += int(result["correct"])
+        if results is not None:
+            results.add_scenario("{}-{}".format(run_prefix, idx), result)
+
+    jobs = [job for group in groups for job in group]
+    costs = estimate_costs([(cfg, sid) for _, cfg, sid in jobs], loaders, results)
+    log("[matrix] estimated {:.0f} turns of work, makespan >= {:.0f} turns on {} workers".format(
+        sum(costs), makespan_bound(costs, max_workers), max_workers))
+    # each group's followers wait for their leader; a leader is ranked by the
+    # length of its whole chain so long groups are started first
+    after, start = {}, 0
+    for group in groups:
+        after[start] = list(range(start + 1, start + len(group)))
+        if len(group) > 1:
+            costs[start] += max(costs[start + 1:start + len(group)])
+        start += len(group)
+    pool = LongestFirstPool(max_workers)
+    for job, result, error in pool.run(list(range(len(jobs))), costs, lambda i: _run(jobs[i]), after):
+        _record(jobs[job], result, error)
+        done += 1
+        if done % 10 == 0 or done == total:
+            log("[matrix] {}/{} runs finished".format(done, total))
+
+    rows = []
+    for idx, ((values, _), st) in enumerate(zip(cells, stats)):
+        row = {"cell": idx}
+        row.update({k: str(v) for k, v in values.items()})
+        row["scenarios"] = st["n"]
+        row["accuracy"] = st["correct"] / (st["n"] - st["errors"]) if st["n"] > st["errors"] else 0.0
+        row["diagnosed"] = st["diagnosed"]
+        row["mean_turns"] = st["turns"] / max(st["n"] - st["errors"], 1)
+        row["errors"] = st["errors"]
+        row["skipped"] = st["skipped"]
+        rows.append(row)
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run a grid of AgentClinic configurations in one process')
+    parser.add_argument('spec', type=str, help='JSON (or YAML) matrix spec')
+    parser.add_argument('--openai_api_key', type=str, required=False, help='OpenAI API Key')
+    parser.add_argument('--replicate_api_key', type=str, required=False, help='Replicate API Key')
+    parser.add_argument('--anthropic_api_key', type=str, default=None, required=False, help='Anthropic API key for Claude 3.5 Sonnet')
+    parser.add_argument('--max_workers', type=int, default=None, help='Concurrent scenario simulations (default: spec or 8)')
+    parser.add_argument('--response_cache', type=str, default='response_cache.sqlite', help='SQLite response cache shared by all cells ("" to disable)')
+    parser.add_argument('--results_db', type=str, default='results.sqlite', help='Run results database, one run per cell ("" to disable)')
+    parser.add_argument('--budget', type=float, default=None, help='Skip runs not yet started once the projected spend (USD) reaches this')
+    parser.add_argument('--budget_abort', action='store_true', help='Also abort running scenarios once the budget is spent')
+    parser.add_argument('--metrics_port', type=int, default=None, help='Serve live progress and backend metrics in Prometheus format on this local port')
+    parser.add_argument('--status_file', type=str, default=None, help='JSON file rewritten with the same live metrics every --status_interval seconds')
+    parser.add_argument('--status_interval', type=float, default=15.0)
+    parser.add_argument('--output', type=str, default='matrix.csv', help='Accuracy table (CSV)')
+    args = parser.parse_args()
+
+    spec = load_spec(args.spec)
+    cells = expand_cells(spec)
+    # concurrency is bounded by max_workers, no fixed pause needed
+    cells = [(values, replace(cfg, turn_delay=0.0)) for values, cfg in cells]
+    for _, cfg in cells:
+        set_api_keys(cfg, args.openai_api_key, args.replicate_api_key, args.anthropic_api_key)
+    if args.response_cache:
+        from utilities.response_cache import ResponseCache
+        set_response_cache(ResponseCache(args.response_cache))
+    cost_tracker = CostTracker(budget=args.budget, abort_in_flight=args.budget_abort)
+    set_cost_tracker(cost_tracker)
+    metrics = start_metrics(args.metrics_port, args.status_file, args.status_interval)
+    results = None
+    if args.results_db:
+        from utilities.results_db import ResultsDB
+        results = ResultsDB(args.results_db)
+
+    num_scenarios = spec.get("num_scenarios")
+    scenario_ids = {}
+    for _, cfg in cells:
+        if cfg.dataset not in scenario_ids:
+            n = get_scenario_loader(cfg.dataset).num_scenarios
+            scenario_ids[cfg.dataset] = spec.get("scenario_ids") or list(range(min(num_scenarios or n, n)))
+    run_prefix = new_run_id(spec.get("name", "matrix"))
+    print("Running {} cells x {} scenarios as {}".format(len(cells), sum(len(v) for v in scenario_ids.values()), run_prefix))
+    rows = run_matrix(cells, scenario_ids, args.max_workers or spec.get("max_workers", 8), results, run_prefix)
+    if metrics is not None:
+        metrics.close()
+    print_table(rows)
+    print("Spent ${:.4f} on {} calls ({} served from cache)".format(
+        cost_tracker.spent, cost_tracker.total["calls"], cost_tracker.total["cached_calls"]))
+    with open(args.output, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+    print("Saved", args.output)
@@ -0,0 +1,73 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from agentclinic import ClinicConfig, set_api_keys
+from agents.SoapAgent import QueryModelChatClient, SoapAgent, SoapAgentConfig
+from utilities.note_store import NoteStore
+from utilities.utility import set_response_cache
+
+# Offline SOAP generation.
+# Replays transcripts saved by `agentclinic.py --save_transcripts` through
+# SoapAgent and writes the notes into the same note store, so a new SOAP prompt
+# or soap_llm can be evaluated without re-simulating any dialogue. Notes already
+# present for the output run are skipped, so an interrupted batch resumes.
+
+
+def note_for_transcript(transcript, soap_cfg, soap_llm, enable_big5=False):
+    agent = SoapAgent(llm_client=QueryModelChatClient(soap_llm), scenario=None, config=soap_cfg,
+                      enable_big5=enable_big5)
+    agent.objective_cache = transcript["objective_cache"]
+    for turn, role, text in transcript["lines"]:
+        agent.observe(role, text, turn)
+    last_turn = transcript["lines"][-1][0]
+    return agent.generate((1, last_turn))
+
+
+def run_batch(store, source_run, out_run, soap_llm, soap_cfg, max_workers=4, enable_big5=False, log=print):
+    pending = [t for t in store.transcripts(source_run)
+               if t["lines"] and not store.has_note(out_run, t["scenario_id"])]
+    log("[soap_batch] {} transcripts to process for run {}".format(len(pending), out_run))
+    failed = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        futures = {ex.submit(note_for_transcript, t, soap_cfg, soap_llm, enable_big5): t for t in pending}
+        for done, future in enumerate(as_completed(futures), 1):
+            t = futures[future]
+            try:
+                note = future.result()
+            except Exception as e:
+                failed += 1
+                log("Scenario {} failed: {}".format(t["scenario_id"], e))
+                continue
+            # written as soon as it completes, so a restart only redoes unfinished scenarios
+            store.add(note, run_id=out_run, scenario_id=t["scenario_id"], dataset=t["dataset"],
+                      doctor_llm=t["doctor_llm"], soap_llm=soap_llm)
+            log("[soap_batch] {}/{} scenario {} -> {}".format(done, len(pending), t["scenario_id"], note.diagnosis.final))
+    return len(pending) - failed, failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generate SOAP notes from saved AgentClinic transcripts')
+    parser.add_argument('--openai_api_key', type=str, required=False, help='OpenAI API Key')
+    parser.add_argument('--replicate_api_key', type=str, required=False, help='Replicate API Key')
+    parser.add_argument('--anthropic_api_key', type=str, default=None, required=False, help='Anthropic API key for Claude 3.5 Sonnet')
+    parser.add_argument('--store', type=str, default='soap_notes/notes.sqlite', help='Note store holding the transcripts')
+    parser.add_argument('--run_id', type=str, required=True, help='Run whose transcripts are replayed')
+    parser.add_argument('--out_run_id', type=str, default=None, help='Run id for the new notes (default: <run_id>/<soap_llm>); existing notes are skipped')
+    parser.add_argument('--soap_llm', type=str, default='gpt4', help='LLM backend for SOAP note generation')
+    parser.add_argument('--soap_incremental', action='store_true', help='Replay through the incremental drafter and only finalize A/P')
+    parser.add_argument('--enable_big5', type=bool, default=False, required=False, help='Add the doctor persona card to the SOAP prompt')
+    parser.add_argument('--max_workers', type=int, default=4, help='Concurrent SOAP generations')
+    parser.add_argument('--response_cache', type=str, default='response_cache.sqlite', help='SQLite response cache ("" to disable)')
+    args = parser.parse_args()
+
+    set_api_keys(ClinicConfig(generate_soap_note=True, soap_llm=args.soap_llm),
+                 args.openai_api_key, args.replicate_api_key, args.anthropic_api_key)
+    if args.response_cache:
+        from utilities.response_cache import ResponseCache
+        set_response_cache(ResponseCache(args.response_cache))
+
+    store = NoteStore(args.store)
+    out_run = args.out_run_id or "{}/{}".format(args.run_id, args.soap_llm)
+    soap_cfg = SoapAgentConfig(incremental=args.soap_incremental, structured=True)
+    written, failed = run_batch(store, args.run_id, out_run, args.soap_llm, soap_cfg, args.max_workers, args.enable_big5)
+    print("Wrote {} notes to {} (run {}), {} failed".format(written, store.path, out_run, failed))
@@ -0,0 +1,7 @@
+import os, sys
+
+# the repo root for `utilities`, generate_cases for the generators' flat imports
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (ROOT, os.path.join(ROOT, "generate_cases")):
+    if path not in sys.path:
+        sys.path.insert(0, path)
@@ -0,0 +1,44 @@
+import json
+
+from case_writer import CaseWriter, medqa_case_id
+
+
+def _lines(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_written_cases_are_skipped_on_restart(tmp_path):
+    path = str(tmp_path / "cases.jsonl")
+    with CaseWriter(path) as writer:
+        writer.write("a", {"OSCE_Examination": {"Correct_Diagnosis": "Appendicitis"}})
+        writer.write(7, {"OSCE_Examination": {"Correct_Diagnosis": "Gout"}})
+    with CaseWriter(path) as writer:
+        assert len(writer) == 2
+        assert "a" in writer and 7 in writer and "b" not in writer
+        writer.write("b", {"OSCE_Examination": {}})
+    assert [case["source_id"] for case in _lines(path)] == ["a", "7", "b"]
+
+
+def test_truncated_last_line_is_dropped(tmp_path):
+    path = tmp_path / "cases.jsonl"
+    path.write_text('{"source_id": "a", "x": 1}\n{"source_id": "b", "x"', encoding="utf-8")
+    with CaseWriter(str(path)) as writer:
+        assert "a" in writer and "b" not in writer
+        writer.write("b", {"x": 2})
+    assert _lines(str(path)) == [{"source_id": "a", "x": 1}, {"source_id": "b", "x": 2}]
+
+
+def test_custom_id_field(tmp_path):
+    path = str(tmp_path / "cases.jsonl")
+    with CaseWriter(path, id_field="subject_id") as writer:
+        writer.write(10001, {"x": 1})
+    assert 10001 in CaseWriter(path, id_field="subject_id")
+    assert len(CaseWriter(path)) == 0
+
+
+def test_medqa_case_id_is_stable():
+    case = {"question": "A 30-year-old woman ...", "answer": "Appendicitis"}
+    assert medqa_case_id(case) == medqa_case_id(dict(case))
+    assert medqa_case_id(case) != medqa_case_id(dict(case, answer="Cholecystitis"))
+    assert len(medqa_case_id(case)) == 16
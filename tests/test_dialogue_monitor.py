@@ -0,0 +1,51 @@
+from utilities import dialogue_monitor
+from utilities.dialogue_monitor import DialogueMonitor, ngrams, similarity
+
+
+def test_similarity_of_repeated_questions():
+    a = ngrams("Can you tell me more about the pain in your chest?")
+    b = ngrams("can you tell me more about the pain in your chest")
+    assert similarity(a, b) == 1.0
+    assert similarity(a, ngrams("Do you have a family history of diabetes?")) == 0.0
+    assert similarity(set(), a) == 0.0
+
+
+def test_test_key_normalizes_names():
+    # imported through the module so pytest does not collect test_key as a test
+    assert dialogue_monitor.test_key("Chest_X-Ray") == dialogue_monitor.test_key("chest x ray") == "chest x ray"
+
+
+def test_stall_after_patience_repeats_in_a_row():
+    monitor = DialogueMonitor(patience=2)
+    question = "Can you describe when the pain started and how it has changed?"
+    assert not monitor.observe_doctor(question)
+    assert not monitor.observe_doctor(question)
+    assert monitor.observe_doctor(question)
+    assert monitor.stall_events == 1
+    # the counter starts over after a stall
+    assert not monitor.observe_doctor(question)
+
+
+def test_new_question_resets_the_repeat_count():
+    monitor = DialogueMonitor(patience=2)
+    question = "Can you describe when the pain started and how it has changed?"
+    monitor.observe_doctor(question)
+    monitor.observe_doctor(question)
+    assert not monitor.observe_doctor("Have you noticed any fever, chills or night sweats recently?")
+    assert not monitor.observe_doctor(question)
+    assert monitor.stall_events == 0
+
+
+def test_re_requesting_answered_tests_counts_as_a_repeat():
+    monitor = DialogueMonitor(patience=1)
+    monitor.record_test("REQUEST TEST: Chest_X-Ray", "RESULTS: normal chest x-ray")
+    assert monitor.observe_doctor("I would like to see the imaging. REQUEST TEST: chest x-ray")
+
+
+def test_cached_result_only_when_every_test_was_answered():
+    monitor = DialogueMonitor()
+    monitor.record_test("REQUEST TEST: Complete_Blood_Count", "RESULTS: WBC 14")
+    assert monitor.cached_result("REQUEST TEST: complete blood count") == "RESULTS: WBC 14"
+    assert monitor.cached_result("REQUEST TEST: Lipase") is None
+    assert monitor.cached_result("What brings you in today?") is None
+    assert monitor.tests_reused == 1
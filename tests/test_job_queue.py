@@ -0,0 +1,120 @@
+import time
+
+import pytest
+
+from utilities.job_queue import JobQueue
+
+
+@pytest.fixture
+def queue(tmp_path):
+    q = JobQueue(str(tmp_path / "jobs.sqlite"), max_attempts=2)
+    yield q
+    q.close()
+
+
+def _expire(queue, job_id):
+    queue._conn.execute("UPDATE jobs SET lease_expires = ? WHERE job_id = ?", (time.time() - 1, job_id))
+
+
+def test_enqueue_is_idempotent_and_leases_by_priority(queue):
+    assert queue.enqueue("run-0", {"doctor_llm": "gpt4"}, [0, 1, 2], [1.0, 5.0, 3.0]) == 3
+    assert queue.enqueue("run-0", {"doctor_llm": "gpt4"}, [0, 1, 2]) == 0
+    leased = [queue.lease("w")[2] for _ in range(3)]
+    assert leased == [1, 2, 0]
+    assert queue.lease("w") is None
+    assert queue.counts() == {"queued": 0, "leased": 3, "done": 0, "failed": 0}
+
+
+def test_lease_returns_the_config(queue):
+    queue.enqueue("run-0", {"doctor_llm": "gpt4", "total_inferences": 20}, [7])
+    job_id, run_id, sid, config = queue.lease("w")
+    assert (run_id, sid, config) == ("run-0", 7, {"doctor_llm": "gpt4", "total_inferences": 20})
+
+
+def test_expired_lease_is_delivered_again(queue):
+    queue.enqueue("run-0", {}, [0])
+    job_id = queue.lease("w1", lease_s=60)[0]
+    # still held by w1
+    assert queue.lease("w2") is None
+    _expire(queue, job_id)
+    assert queue.lease("w2")[0] == job_id
+    # w1 lost the job and can no longer renew it
+    assert not queue.renew(job_id, "w1")
+    assert queue.renew(job_id, "w2")
+
+
+def test_expired_lease_fails_after_max_attempts(queue):
+    queue.enqueue("run-0", {}, [0])
+    for _ in range(2):
+        job_id = queue.lease("w", lease_s=60)[0]
+        _expire(queue, job_id)
+    assert queue.lease("w") is None
+    assert queue.counts()["failed"] == 1
+    assert queue.pending() == 0
+
+
+def test_fail_requeues_until_max_attempts(queue):
+    queue.enqueue("run-0", {}, [0])
+    job_id = queue.lease("w")[0]
+    queue.fail(job_id, "w", "rate limited")
+    assert queue.counts()["queued"] == 1
+    assert queue.lease("w")[0] == job_id
+    queue.fail(job_id, "w", "rate limited again")
+    assert queue.counts()["failed"] == 1
+    assert queue.lease("w") is None
+
+
+def test_fail_from_a_stale_worker_is_ignored(queue):
+    queue.enqueue("run-0", {}, [0])
+    job_id = queue.lease("w1", lease_s=60)[0]
+    _expire(queue, job_id)
+    queue.lease("w2")
+    queue.fail(job_id, "w1", "too late")
+    assert queue.counts()["leased"] == 1
+
+
+def test_first_result_wins(queue):
+    queue.enqueue("run-0", {}, [0])
+    job_id = queue.lease("w1", lease_s=60)[0]
+    _expire(queue, job_id)
+    queue.lease("w2")
+    queue.complete(job_id, "w2", {"scenario_id": 0, "correct": True})
+    queue.complete(job_id, "w1", {"scenario_id": 0, "correct": False})
+    assert queue.uncollected() == [(job_id, "run-0", {"scenario_id": 0, "correct": True})]
+
+
+def test_results_stay_uncollected_until_marked(queue):
+    queue.enqueue("a-0", {}, [0])
+    queue.enqueue("b-0", {}, [0])
+    for _ in range(2):
+        job_id, run_id, sid, _ = queue.lease("w")
+        queue.complete(job_id, "w", {"run": run_id})
+    (job_id, run_id, result), = queue.uncollected("a")
+    assert (run_id, result) == ("a-0", {"run": "a-0"})
+    # a collector that died before storing it sees the result again
+    assert len(queue.uncollected("a")) == 1
+    queue.mark_collected([job_id])
+    assert queue.uncollected("a") == []
+    assert [r[1] for r in queue.uncollected()] == ["b-0"]
+
+
+def test_run_prefix_matches_whole_name_components(queue):
+    for run_id in ("exp_1-0", "exp_1-10", "expX1-0", "exp_10-0", "exp%1-0"):
+        queue.enqueue(run_id, {}, [0])
+    # "_" and "%" are not wildcards, "exp_1" does not cover "exp_10"
+    assert queue.run_ids("exp_1") == ["exp_1-0", "exp_1-10"]
+    assert queue.run_ids("exp%1") == ["exp%1-0"]
+    assert queue.run_ids("exp_1-1") == []
+    assert queue.run_ids("exp_1-10") == ["exp_1-10"]
+    assert queue.counts("exp_1")["queued"] == 2
+    assert queue.pending("exp_10") == 1
+
+
+def test_pending_is_scoped_to_the_run(queue):
+    queue.enqueue("a-0", {}, [0, 1])
+    queue.enqueue("b-0", {}, [0])
+    job_id = queue.lease("w")[0]
+    queue.complete(job_id, "w", {})
+    assert queue.pending() == 2
+    assert queue.pending("a") + queue.pending("b") == 2
+    assert queue.run_ids("a") == ["a-0"]
@@ -0,0 +1,73 @@
+import json
+
+import pytest
+
+from osce_validation import (REQUIRED_FIELDS, OsceValidationError, generate_valid_osce, parse_osce,
+                             repair_json, repair_messages, schema_problems)
+
+VALID = {"OSCE_Examination": {
+    "Objective_for_Doctor": "Assess the patient.",
+    "Patient_Actor": {"Demographics": "30-year-old female"},
+    "Physical_Examination_Findings": {"Abdominal_Examination": "RLQ tenderness"},
+    "Test_Results": {"Complete_Blood_Count": {"WBC": "14,000"}},
+    "Correct_Diagnosis": "Appendicitis",
+}}
+
+
+class FakePool:
+    def __init__(self, answers):
+        self.answers = list(answers)
+        self.requests = []
+
+    def complete(self, messages):
+        self.requests.append(messages)
+        return self.answers.pop(0)
+
+
+def test_valid_case_has_no_problems():
+    case, problems = parse_osce("```json " + json.dumps(VALID) + "```")
+    assert case == VALID and problems == []
+
+
+def test_schema_problems():
+    assert schema_problems([]) == ["missing top-level \"OSCE_Examination\" object"]
+    osce = dict(VALID["OSCE_Examination"], Correct_Diagnosis=" ", Test_Results={})
+    del osce["Patient_Actor"]
+    assert schema_problems({"OSCE_Examination": osce}) == [
+        "missing \"Patient_Actor\"", "\"Correct_Diagnosis\" must be a non-empty string", "\"Test_Results\" is empty"]
+
+
+def test_local_repair_of_near_json():
+    text = json.dumps(VALID)
+    # trailing comma, chatter before the object, truncated closing braces
+    broken = "Here is the case: " + text[:-2].replace('"Appendicitis"', '"Appendicitis",')
+    assert json.loads(repair_json(broken)) == VALID
+    case, problems = parse_osce(broken)
+    assert case == VALID and problems == []
+
+
+def test_unrepairable_json_is_reported():
+    case, problems = parse_osce("no json here")
+    assert case is None and problems[0].startswith("invalid JSON")
+
+
+def test_repair_messages_are_targeted():
+    messages = [{"role": "system", "content": "s"}, {"role": "user", "content": "template and case"}]
+    syntax = repair_messages(messages, "{bad", ["invalid JSON (x)"])
+    assert len(syntax) == 2 and syntax[1]["content"].startswith("Fix this JSON: {bad")
+    schema = repair_messages(messages, "{}", ["missing \"Test_Results\""])
+    assert schema[:2] == messages and schema[2] == {"role": "assistant", "content": "{}"}
+    assert all(field in schema[3]["content"] for field in REQUIRED_FIELDS)
+
+
+def test_generate_valid_osce_repairs_then_gives_up():
+    missing = {"OSCE_Examination": {k: v for k, v in VALID["OSCE_Examination"].items() if k != "Test_Results"}}
+    pool = FakePool([json.dumps(missing), json.dumps(VALID)])
+    assert generate_valid_osce(pool, [{"role": "user", "content": "case"}]) == VALID
+    assert len(pool.requests) == 2
+
+    pool = FakePool([json.dumps(missing)] * 3)
+    with pytest.raises(OsceValidationError) as err:
+        generate_valid_osce(pool, [{"role": "user", "content": "case"}], max_repairs=2)
+    assert err.value.problems == ["missing \"Test_Results\""]
+    assert len(pool.requests) == 3
@@ -0,0 +1,60 @@
+import sqlite3
+
+import pytest
+
+from utilities.results_db import ResultsDB
+
+CFG = {"dataset": "MedQA", "doctor_llm": "gpt4", "doctor_bias": "None"}
+TRANSCRIPT = [[1, "Doctor", "REQUEST TEST: Complete_Blood_Count"]]
+
+
+def _result(correct, turns):
+    return {"scenario_id": 0, "correct": correct, "turns": turns, "transcript": TRANSCRIPT,
+            "cost": {"doctor": {"calls": 1, "cached_calls": 0, "prompt_tokens": 10, "completion_tokens": 5,
+                                "cost_usd": 0.5}}}
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = ResultsDB(str(tmp_path / "results.sqlite"))
+    yield db
+    db.close()
+
+
+def test_run_ids_are_not_replaced(db):
+    db.add_run("run-0", CFG)
+    with pytest.raises(ValueError):
+        db.add_run("run-0", CFG)
+
+
+def test_prefix_runs_only_count_towards_spend(db):
+    db.add_run("fork-prefix", CFG, kind="prefix")
+    db.add_run("fork-a", CFG)
+    db.add_scenario("fork-prefix", _result(None, 3))
+    db.add_scenario("fork-a", _result(True, 9))
+    assert db.accuracy([]) == [{"scenarios": 1, "diagnosed": 1, "accuracy": 1.0}]
+    assert db.turns_to_diagnosis([])[0]["mean_turns"] == 9
+    assert db.top_tests() == [{"test": "Complete_Blood_Count", "requests": 1, "scenarios": 1}]
+    assert db.scenario_history("MedQA")[0]["turns"] == 9
+    assert db.costs([])[0]["cost_usd"] == 1.0
+
+
+def test_unknown_kind_is_rejected(db):
+    with pytest.raises(ValueError):
+        db.add_run("run-0", CFG, kind="partial")
+
+
+def test_databases_without_run_kinds_are_migrated(tmp_path):
+    path = str(tmp_path / "old.sqlite")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE runs (run_id TEXT PRIMARY KEY, started REAL, dataset TEXT, doctor_llm TEXT, "
+                 "patient_llm TEXT, measurement_llm TEXT, moderator_llm TEXT, doctor_bias TEXT, patient_bias TEXT, "
+                 "total_inferences INTEGER, config TEXT)")
+    conn.execute("INSERT INTO runs (run_id, dataset, doctor_llm) VALUES ('old', 'MedQA', 'gpt4')")
+    conn.commit()
+    conn.close()
+    db = ResultsDB(path)
+    db.add_scenario("old", _result(False, 4))
+    assert db.execute("SELECT kind FROM runs") == [{"kind": "full"}]
+    assert db.accuracy(["doctor_llm"]) == [{"doctor_llm": "gpt4", "scenarios": 1, "diagnosed": 1, "accuracy": 0.0}]
+    db.close()
@@ -0,0 +1,140 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from utilities.scheduler import LongestFirstPool, estimate_costs, makespan_bound
+
+
+class FakeLoader:
+    def __init__(self, sizes):
+        self.scenarios = [SimpleNamespace(scenario_dict={"text": "x" * size}) for size in sizes]
+        self.num_scenarios = len(sizes)
+
+    def get_scenario(self, id):
+        return self.scenarios[id]
+
+
+class FakeResults:
+    def __init__(self, by_model, everything):
+        self.by_model = by_model
+        self.everything = everything
+
+    def scenario_history(self, dataset, doctor_llm=None):
+        return self.by_model.get(doctor_llm, {}) if doctor_llm is not None else self.everything
+
+
+def _cfg(doctor_llm="gpt4", total_inferences=20):
+    return SimpleNamespace(dataset="MedQA", doctor_llm=doctor_llm, total_inferences=total_inferences)
+
+
+def test_makespan_bound():
+    assert makespan_bound([], 4) == 0.0
+    assert makespan_bound([10.0, 1.0, 1.0], 4) == 10.0
+    assert makespan_bound([4.0, 4.0, 4.0, 4.0], 2) == 8.0
+
+
+def test_estimate_costs_without_history_scales_with_case_size():
+    loader = FakeLoader([100, 300])
+    costs = estimate_costs([(_cfg(), 0), (_cfg(), 1)], {"MedQA": loader})
+    # no history: half of total_inferences, scaled by size relative to the dataset mean
+    sizes = [len('{"text": "' + "x" * n + '"}') for n in (100, 300)]
+    mean = sum(sizes) / 2
+    assert costs == pytest.approx([10 * sizes[0] / mean, 10 * sizes[1] / mean])
+
+
+def test_estimate_costs_prefers_same_model_history():
+    loader = FakeLoader([100, 100, 100])
+    results = FakeResults(
+        by_model={"gpt4": {0: {"turns": 12, "tokens": None}}},
+        everything={0: {"turns": 4, "tokens": None}, 1: {"turns": 6, "tokens": None}})
+    costs = estimate_costs([(_cfg(), 0), (_cfg(), 1), (_cfg(), 2)], {"MedQA": loader}, results)
+    assert costs[0] == 12.0
+    # other models' runs of the same scenario
+    assert costs[1] == 6.0
+    # never run: the dataset's mean turns
+    assert costs[2] == pytest.approx(5.0)
+
+
+def test_estimate_costs_weights_by_tokens_and_floors_at_one():
+    loader = FakeLoader([100, 100])
+    history = {0: {"turns": 10, "tokens": 2000}, 1: {"turns": 10, "tokens": 1000}}
+    results = FakeResults({"gpt4": history}, history)
+    costs = estimate_costs([(_cfg(), 0), (_cfg(), 1)], {"MedQA": loader}, results)
+    # 150 tokens per turn on average
+    assert costs == pytest.approx([2000 / 150, 1000 / 150])
+    results = FakeResults({}, {0: {"turns": 0.2, "tokens": None}})
+    assert estimate_costs([(_cfg(), 0)], {"MedQA": loader}, results) == [1.0]
+
+
+def test_pool_runs_longest_first_on_one_worker():
+    order = []
+    pool = LongestFirstPool(max_workers=1)
+    jobs = ["a", "b", "c", "d"]
+    done = list(pool.run(jobs, [1.0, 5.0, 3.0, 4.0], lambda j: order.append(j) or j.upper()))
+    assert order == ["b", "d", "c", "a"]
+    assert [(job, result, error) for job, result, error in done] == [
+        ("b", "B", None), ("d", "D", None), ("c", "C", None), ("a", "A", None)]
+
+
+def test_pool_reports_errors_and_keeps_going():
+    def fn(job):
+        if job == 1:
+            raise ZeroDivisionError("boom")
+        return job * 10
+
+    done = {job: (result, error) for job, result, error in LongestFirstPool(2).run([0, 1, 2], [1, 2, 3], fn)}
+    assert done[0] == (0, None) and done[2] == (20, None)
+    assert done[1][0] is None and isinstance(done[1][1], ZeroDivisionError)
+
+
+def test_pool_holds_dependents_until_their_job_returns():
+    finished = set()
+    lock = threading.Lock()
+    started_before = {}
+
+    def fn(job):
+        with lock:
+            started_before[job] = set(finished)
+        if job == 0:
+            time.sleep(0.05)
+        with lock:
+            finished.add(job)
+        return job
+
+    # 2 and 3 wait for 0 even though they are the longest jobs
+    pool = LongestFirstPool(max_workers=3)
+    done = [job for job, _, error in pool.run([0, 1, 2, 3], [1.0, 1.0, 9.0, 8.0], fn, after={0: [2, 3]})]
+    assert sorted(done) == [0, 1, 2, 3]
+    assert 0 in started_before[2] and 0 in started_before[3]
+    assert 0 not in started_before[1]
+
+
+def test_pool_releases_dependents_of_a_failed_job():
+    def fn(job):
+        if job == 0:
+            raise RuntimeError("leader failed")
+        return job
+
+    done = {job: error for job, _, error in LongestFirstPool(2).run([0, 1], [1.0, 1.0], fn, after={0: [1]})}
+    assert isinstance(done[0], RuntimeError)
+    assert done[1] is None
+
+
+def test_pool_steals_from_a_busy_worker():
+    pool = LongestFirstPool(max_workers=2)
+    gate = threading.Event()
+
+    def fn(job):
+        if job == 0:
+            # worker 0 is stuck on its first job while its queue still holds work
+            gate.wait(5)
+        elif job == 3:
+            gate.set()
+        return job
+
+    # dealt as worker 0: [0, 3], worker 1: [1, 2]
+    done = sorted(job for job, _, _ in pool.run([0, 1, 2, 3], [10.0, 9.0, 2.0, 1.0], fn))
+    assert done == [0, 1, 2, 3]
+    assert pool.steals >= 1
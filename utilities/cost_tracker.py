@@ -0,0 +1,137 @@
+import contextvars, json, os, threading
+
+# Token and cost accounting for query_model.
+# Every backend call is recorded with its prompt/completion tokens (provider
+# usage when the response has it, otherwise ~4 characters per token) and
+# priced from PRICES. Totals are kept per run, per role and, through a
+# context-local scope opened by run_scenario, per scenario (worker threads
+# started with a copy of the scenario's context, like the SOAP agent's delta
+# calls, are counted in the same scope). A budget makes
+# should_stop() true once the projected spend would cross it, and with
+# abort_in_flight query_model refuses new calls once it is spent.
+
+# USD per 1M (prompt, completion) tokens; override with a JSON file of the same shape
+PRICES = {
+    "gpt4": (10.0, 30.0),
+    "gpt4v": (10.0, 30.0),
+    "gpt4o": (5.0, 15.0),
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt3.5": (0.50, 1.50),
+    "o1-preview": (15.0, 60.0),
+    "claude3.5sonnet": (3.0, 15.0),
+    "llama-3-70b-instruct": (0.65, 2.75),
+    "llama-2-70b-chat": (0.65, 2.75),
+    "mixtral-8x7b": (0.30, 1.00),
+}
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text or "") // 4)
+
+
+def _empty():
+    return {"calls": 0, "cached_calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0}
+
+
+def _add(bucket, calls, cached, prompt_tokens, completion_tokens, cost):
+    bucket["calls"] += calls
+    bucket["cached_calls"] += cached
+    bucket["prompt_tokens"] += prompt_tokens
+    bucket["completion_tokens"] += completion_tokens
+    bucket["cost_usd"] += cost
+
+
+class CostTracker:
+    def __init__(self, budget=None, abort_in_flight=False, prices=None):
+        self.budget = budget
+        self.abort_in_flight = abort_in_flight
+        self.prices = dict(PRICES)
+        if prices:
+            self.prices.update({k: tuple(v) for k, v in prices.items()})
+        self.total = _empty()
+        self.by_role = {}
+        self.by_model = {}
+        self.scenarios_finished = 0
+        self.scenario_cost = 0.0
+        self._lock = threading.Lock()
+        self._scope = contextvars.ContextVar("cost_scope_{}".format(id(self)), default=None)
+
+    @classmethod
+    def from_price_table(cls, path, **kwargs):
+        with open(path, "r") as f:
+            return cls(prices=json.load(f), **kwargs)
+
+    def price(self, model_str, prompt_tokens, completion_tokens) -> float:
+        # local HF_ models and unknown backends are free
+        p_in, p_out = self.prices.get(model_str, (0.0, 0.0))
+        return (prompt_tokens * p_in + completion_tokens * p_out) / 1e6
+
+    def record(self, model_str, prompt_tokens, completion_tokens, role=None, cached=False) -> float:
+        if cached:
+            prompt_tokens = completion_tokens = 0
+        cost = self.price(model_str, prompt_tokens, completion_tokens)
+        calls, hits = (0, 1) if cached else (1, 0)
+        role = role or "other"
+        with self._lock:
+            _add(self.total, calls, hits, prompt_tokens, completion_tokens, cost)
+            _add(self.by_role.setdefault(role, _empty()), calls, hits, prompt_tokens, completion_tokens, cost)
+            _add(self.by_model.setdefault(model_str, _empty()), calls, hits, prompt_tokens, completion_tokens, cost)
+            scope = self._scope.get()
+            if scope is not None:
+                _add(scope.setdefault(role, _empty()), calls, hits, prompt_tokens, completion_tokens, cost)
+        return cost
+
+    @property
+    def spent(self) -> float:
+        return self.total["cost_usd"]
+
+    def check(self) -> None:
+        """Called before each backend call; raises once the budget is spent and aborting is enabled."""
+        if self.abort_in_flight and self.budget is not None and self.spent >= self.budget:
+            raise BudgetExceeded("Budget of ${:.2f} spent (${:.2f})".format(self.budget, self.spent))
+
+    def should_stop(self, in_flight=0) -> bool:
+        """True if starting another scenario would likely cross the budget."""
+        if self.budget is None:
+            return False
+        with self._lock:
+            mean = self.scenario_cost / self.scenarios_finished if self.scenarios_finished else 0.0
+            projected = self.spent + mean * (in_flight + 1)
+        return projected >= self.budget
+
+    def start_scope(self) -> None:
+        # each thread has its own context, so concurrent scenarios are attributed separately
+        self._scope.set({})
+
+    def end_scope(self) -> dict:
+        """Per-role usage since start_scope(), counted as one finished scenario."""
+        scope = self._scope.get() or {}
+        self._scope.set(None)
+        with self._lock:
+            scope = {role: dict(usage) for role, usage in scope.items()}
+            self.scenarios_finished += 1
+            self.scenario_cost += sum(u["cost_usd"] for u in scope.values())
+        return scope
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {
+                "budget_usd": self.budget,
+                "spent_usd": self.spent,
+                "scenarios_finished": self.scenarios_finished,
+                "total": dict(self.total),
+                "by_role": {k: dict(v) for k, v in self.by_role.items()},
+                "by_model": {k: dict(v) for k, v in self.by_model.items()},
+            }
+
+    def write_report(self, path, **extra) -> None:
+        report = self.summary()
+        report.update(extra)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(report, f, indent=2)
+        os.replace(tmp_path, path)
@@ -0,0 +1,79 @@
+import re
+
+from utilities.results_db import requested_tests
+
+# Cheap local stall/loop detection for the doctor-patient dialogue.
+# A doctor turn counts as repeated when its word n-grams overlap strongly with
+# one of the recent doctor turns, or when it only re-requests tests that were
+# already answered. After `patience` repeated turns in a row the dialogue is
+# considered stalled and run_scenario applies ClinicConfig.stall_action.
+# Test results are remembered by normalized test name so repeated requests
+# can be answered without another measurement call.
+
+NUDGE_PROMPT = ("You are repeating earlier questions. If you have enough information, "
+                "please provide your diagnosis now with \"DIAGNOSIS READY: [diagnosis here]\".\n")
+
+
+def _normalize(text: str) -> list:
+    return re.sub(r"[^a-z0-9 ]+", " ", (text or "").lower()).split()
+
+
+def ngrams(text: str, n: int = 3) -> set:
+    words = _normalize(text)
+    if len(words) < n:
+        return {tuple(words)} if words else set()
+    return {tuple(words[i:i + n]) for i in range(len(words) - n + 1)}
+
+
+def similarity(a: set, b: set) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def test_key(name: str) -> str:
+    return " ".join(_normalize(name.replace("_", " ")))
+
+
+class DialogueMonitor:
+    def __init__(self, threshold=0.6, window=4, patience=2, n=3):
+        self.threshold = threshold
+        self.window = window
+        self.patience = patience
+        self.n = n
+        self.repeats = 0
+        self.stall_events = 0
+        self.tests_reused = 0
+        self._recent = []
+        self._tests = {}
+
+    def observe_doctor(self, text: str) -> bool:
+        """Record a doctor turn, returns True when the dialogue is stalled."""
+        grams = ngrams(text, self.n)
+        tests = [test_key(t) for t in requested_tests(text)]
+        repeated = any(similarity(grams, prev) >= self.threshold for prev in self._recent)
+        if tests and all(t in self._tests for t in tests):
+            repeated = True
+        self._recent = (self._recent + [grams])[-self.window:]
+        self.repeats = self.repeats + 1 if repeated else 0
+        if self.repeats >= self.patience:
+            self.stall_events += 1
+            self.repeats = 0
+            return True
+        return False
+
+    def cached_result(self, doctor_text: str):
+        """Earlier measurement result if every test in this request was already answered."""
+        tests = [test_key(t) for t in requested_tests(doctor_text)]
+        if not tests or any(t not in self._tests for t in tests):
+            return None
+        self.tests_reused += 1
+        results = []
+        for t in tests:
+            if self._tests[t] not in results:
+                results.append(self._tests[t])
+        return "\n".join(results)
+
+    def record_test(self, doctor_text: str, result: str) -> None:
+        for t in requested_tests(doctor_text):
+            self._tests[test_key(t)] = result
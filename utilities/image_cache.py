@@ -0,0 +1,190 @@
+import base64, glob, hashlib, io, os, sqlite3, threading, time
+import urllib.parse, urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+# Local cache of scenario images (NEJM).
+# Every image is downloaded once, stored under its content hash and indexed by
+# URL in <dir>/images.sqlite; query_model then sends it inline as a base64
+# data URL instead of making the provider fetch the remote URL on every image
+# turn. A download that is not a JPEG, PNG, GIF or WebP file (an error or
+# login page) is not cached and the remote URL is sent instead. Images are optionally downscaled to what the target model actually
+# looks at (needs Pillow, otherwise the original is sent). In offline mode
+# nothing is downloaded: images come from a local directory, either an earlier
+# cache directory or files named after the NEJM image id (IC20240111.jpg).
+
+# (long side, short side) a model's vision input is resized to anyway;
+# OpenAI "high" detail fits 2048x2048 and then scales the short side to 768
+IMAGE_LIMITS = {
+    "gpt4v": (2048, 768),
+    "gpt4": (2048, 768),
+    "gpt4o": (2048, 768),
+    "gpt-4o-mini": (2048, 768),
+}
+
+_MAGIC = [(b"\xff\xd8\xff", "image/jpeg"), (b"\x89PNG", "image/png"), (b"GIF8", "image/gif")]
+_EXT = {"image/jpeg": "jpg", "image/png": "png", "image/gif": "gif", "image/webp": "webp"}
+
+
+def sniff_mime(data: bytes):
+    """Image type from the leading bytes, None if they are not a known image format."""
+    for magic, mime in _MAGIC:
+        if data.startswith(magic):
+            return mime
+    if data.startswith(b"RIFF") and data[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+def image_id(url: str) -> str:
+    """NEJM image id (the `id` query parameter), else the last path component."""
+    parsed = urllib.parse.urlparse(url)
+    ids = urllib.parse.parse_qs(parsed.query).get("id")
+    return ids[0] if ids else os.path.splitext(os.path.basename(parsed.path))[0]
+
+
+class ImageCache:
+    def __init__(self, directory="image_cache", offline_dir=None, max_side=None, timeout=30.0):
+        """`max_side` overrides the long-side limit for every model (0 sends originals)."""
+        self.directory = directory
+        self.offline_dir = offline_dir
+        self.max_side = max_side
+        self.timeout = timeout
+        self.downloads = 0
+        self._data_urls = {}
+        self._warned_pil = False
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(directory, "images.sqlite"), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS images ("
+            "url TEXT PRIMARY KEY, sha256 TEXT, mime TEXT, bytes INTEGER, fetched REAL)")
+        self._conn.commit()
+
+    def _lookup(self, url):
+        with self._lock:
+            return self._conn.execute("SELECT sha256, mime FROM images WHERE url = ?", (url,)).fetchone()
+
+    def _blob_path(self, sha, mime, directory=None):
+        return os.path.join(directory or self.directory, "{}.{}".format(sha, _EXT.get(mime, "img")))
+
+    def _store(self, url, data, content_type=None) -> str:
+        # an error page or a login redirect is not cached, so the caller falls back to the remote URL
+        mime = sniff_mime(data)
+        if mime is None:
+            raise ValueError("{} is not a JPEG, PNG, GIF or WebP image (got {})".format(
+                url, content_type or "{} unknown bytes".format(len(data))))
+        sha = hashlib.sha256(data).hexdigest()
+        path = self._blob_path(sha, mime)
+        if not os.path.exists(path):
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO images (url, sha256, mime, bytes, fetched) VALUES (?, ?, ?, ?, ?)",
+                               (url, sha, mime, len(data), time.time()))
+            self._conn.commit()
+        return path
+
+    def _read_offline(self, url) -> bytes:
+        index = os.path.join(self.offline_dir, "images.sqlite")
+        if os.path.exists(index):
+            conn = sqlite3.connect(index)
+            try:
+                row = conn.execute("SELECT sha256, mime FROM images WHERE url = ?", (url,)).fetchone()
+            finally:
+                conn.close()
+            if row is not None and os.path.exists(self._blob_path(row[0], row[1], self.offline_dir)):
+                with open(self._blob_path(row[0], row[1], self.offline_dir), "rb") as f:
+                    return f.read()
+        matches = sorted(glob.glob(os.path.join(self.offline_dir, glob.escape(image_id(url)) + ".*")))
+        if not matches:
+            raise FileNotFoundError("No offline image for {} in {}".format(url, self.offline_dir))
+        with open(matches[0], "rb") as f:
+            return f.read()
+
+    def fetch(self, url) -> str:
+        """Local path of the original image, downloading (or copying from the offline dir) on first use."""
+        row = self._lookup(url)
+        if row is not None and os.path.exists(self._blob_path(*row)):
+            return self._blob_path(*row)
+        if self.offline_dir:
+            return self._store(url, self._read_offline(url))
+        request = urllib.request.Request(url, headers={"User-Agent": "Mozilla/5.0 (AgentClinic image prefetch)"})
+        with urllib.request.urlopen(request, timeout=self.timeout) as resp:
+            data = resp.read()
+            content_type = resp.headers.get_content_type()
+        with self._lock:
+            self.downloads += 1
+        return self._store(url, data, content_type)
+
+    def prefetch(self, urls, max_workers=8, log=print) -> int:
+        """Fetches every distinct URL once; returns how many failed (they fall back to the remote URL)."""
+        urls = sorted({u for u in urls if u})
+        failed = 0
+        with ThreadPoolExecutor(max_workers=max_workers) as ex:
+            for url, future in [(u, ex.submit(self.fetch, u)) for u in urls]:
+                try:
+                    future.result()
+                except Exception as e:
+                    failed += 1
+                    log("Image prefetch failed for {}: {}".format(url, e))
+        log("Image cache: {} images ready in {} ({} downloaded)".format(len(urls) - failed, self.directory, self.downloads))
+        return failed
+
+    def _limits(self, model_str):
+        long_side, short_side = IMAGE_LIMITS.get(model_str, (None, None))
+        if self.max_side is not None:
+            long_side = self.max_side or None
+            short_side = min(short_side, long_side) if short_side and long_side else None
+        return long_side, short_side
+
+    def _resized(self, path, mime, long_side, short_side):
+        """Path of a JPEG variant fitting the limits, or the original when it already fits or Pillow is missing."""
+        try:
+            from PIL import Image
+        except ImportError:
+            if not self._warned_pil:
+                self._warned_pil = True
+                print("Pillow is not installed, sending images at their original size")
+            return path, mime
+        variant = "{}_{}x{}.jpg".format(os.path.splitext(path)[0], long_side, short_side or 0)
+        if os.path.exists(variant):
+            return variant, "image/jpeg"
+        with Image.open(path) as img:
+            w, h = img.size
+            scale = min(1.0, long_side / max(w, h))
+            if short_side:
+                scale = min(scale, short_side / min(w, h))
+            if scale >= 1.0:
+                return path, mime
+            img = img.convert("RGB").resize((max(1, round(w * scale)), max(1, round(h * scale))), Image.LANCZOS)
+            buf = io.BytesIO()
+            img.save(buf, format="JPEG", quality=90)
+        tmp_path = variant + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(buf.getvalue())
+        os.replace(tmp_path, variant)
+        return variant, "image/jpeg"
+
+    def data_url(self, url, model_str) -> str:
+        """Inline base64 data URL of the cached (and resized for `model_str`) image."""
+        long_side, short_side = self._limits(model_str)
+        key = (url, long_side, short_side)
+        with self._lock:
+            if key in self._data_urls:
+                return self._data_urls[key]
+        path = self.fetch(url)
+        mime = self._lookup(url)[1]
+        if long_side:
+            path, mime = self._resized(path, mime, long_side, short_side)
+        with open(path, "rb") as f:
+            encoded = "data:{};base64,{}".format(mime, base64.b64encode(f.read()).decode("ascii"))
+        with self._lock:
+            self._data_urls[key] = encoded
+        return encoded
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,160 @@
+import json, os, socket, sqlite3, threading, time, uuid
+
+# Durable job queue for distributed runs (coordinator.py).
+# One SQLite file holds a job per (run, config, scenario). Workers on any host
+# that can open the file lease one job at a time; a lease expires unless the
+# worker keeps renewing it, so the jobs of a crashed or stuck worker are
+# delivered again to someone else. Results are posted back into the same row.
+# The file uses the rollback journal rather than WAL so that it can live on a
+# network filesystem shared by several hosts (that filesystem must support
+# POSIX locks, as NFSv4 does).
+# Higher priority (the estimated cost in turns) is leased first.
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id TEXT NOT NULL,
+    scenario_id INTEGER NOT NULL,
+    config TEXT NOT NULL,
+    priority REAL DEFAULT 0,
+    state TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER DEFAULT 0,
+    worker TEXT,
+    lease_expires REAL,
+    enqueued REAL,
+    finished REAL,
+    result TEXT,
+    error TEXT,
+    collected INTEGER DEFAULT 0,
+    UNIQUE (run_id, scenario_id)
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, priority);
+"""
+
+
+def _run_filter(run_prefix: str):
+    """SQL condition and parameters for the jobs of run `run_prefix` and of runs named `<run_prefix>-...`."""
+    if not run_prefix:
+        return "1", []
+    escaped = run_prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return "(run_id = ? OR run_id LIKE ? ESCAPE '\\')", [run_prefix, escaped + "-%"]
+
+
+def worker_name() -> str:
+    return "{}:{}:{}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:6])
+
+
+class JobQueue:
+    def __init__(self, path="jobs.sqlite", max_attempts=3):
+        self.path = path
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        # autocommit mode, leases take the write lock explicitly
+        self._conn = sqlite3.connect(path, timeout=60.0, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=DELETE")
+        self._conn.executescript(_SCHEMA)
+
+    def enqueue(self, run_id: str, config: dict, scenario_ids, priorities=None) -> int:
+        """Adds one job per scenario; jobs already in the queue for this run are left alone."""
+        priorities = priorities or [0.0] * len(scenario_ids)
+        now = time.time()
+        blob = json.dumps(config, default=str)
+        with self._lock:
+            cur = self._conn.executemany(
+                "INSERT OR IGNORE INTO jobs (run_id, scenario_id, config, priority, enqueued) VALUES (?, ?, ?, ?, ?)",
+                [(run_id, sid, blob, p, now) for sid, p in zip(scenario_ids, priorities)])
+            return cur.rowcount
+
+    def lease(self, worker: str, lease_s: float = 300.0):
+        """Next job as (job_id, run_id, scenario_id, config dict), or None when nothing is available."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT job_id, run_id, scenario_id, config FROM jobs "
+                    "WHERE (state = 'queued' OR (state = 'leased' AND lease_expires < ?)) AND attempts < ? "
+                    "ORDER BY priority DESC, job_id LIMIT 1", (now, self.max_attempts)).fetchone()
+                if row is not None:
+                    self._conn.execute(
+                        "UPDATE jobs SET state = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1 "
+                        "WHERE job_id = ?", (worker, now + lease_s, row[0]))
+                # expired leases that used up their attempts will not be delivered again
+                self._conn.execute(
+                    "UPDATE jobs SET state = 'failed', error = COALESCE(error, 'lease expired') "
+                    "WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?", (now, self.max_attempts))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        return row[0], row[1], row[2], json.loads(row[3])
+
+    def renew(self, job_id: int, worker: str, lease_s: float = 300.0) -> bool:
+        """Extends a lease; False if the job was given to another worker in the meantime."""
+        with self._lock:
+            cur = self._conn.execute(
+                "UPDATE jobs SET lease_expires = ? WHERE job_id = ? AND worker = ? AND state = 'leased'",
+                (time.time() + lease_s, job_id, worker))
+            return cur.rowcount == 1
+
+    def complete(self, job_id: int, worker: str, result: dict) -> None:
+        # the first result wins, also when the lease had expired and the job was handed out again
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET state = 'done', worker = ?, finished = ?, result = ?, error = NULL "
+                "WHERE job_id = ? AND state != 'done'",
+                (worker, time.time(), json.dumps(result, default=str), job_id))
+
+    def fail(self, job_id: int, worker: str, error: str) -> None:
+        """Gives the job back for another attempt, or marks it failed after max_attempts."""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, "
+                "error = ?, lease_expires = NULL WHERE job_id = ? AND worker = ? AND state = 'leased'",
+                (self.max_attempts, error, job_id, worker))
+
+    def counts(self, run_prefix: str = "") -> dict:
+        where, params = _run_filter(run_prefix)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT state, COUNT(*) FROM jobs WHERE {} GROUP BY state".format(where), params).fetchall()
+        counts = {"queued": 0, "leased": 0, "done": 0, "failed": 0}
+        counts.update(dict(rows))
+        return counts
+
+    def pending(self, run_prefix: str = "") -> int:
+        """Jobs (of the runs under `run_prefix`) that are queued or leased and may still produce a result."""
+        where, params = _run_filter(run_prefix)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE {} AND (state = 'queued' "
+                "OR (state = 'leased' AND (lease_expires >= ? OR attempts < ?)))".format(where),
+                params + [time.time(), self.max_attempts]).fetchone()
+        return row[0]
+
+    def run_ids(self, run_prefix: str):
+        where, params = _run_filter(run_prefix)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT DISTINCT run_id FROM jobs WHERE {} ORDER BY LENGTH(run_id), run_id".format(where), params).fetchall()
+        return [r[0] for r in rows]
+
+    def uncollected(self, run_prefix: str = ""):
+        """(job_id, run_id, result dict) of finished jobs not yet passed to mark_collected()."""
+        where, params = _run_filter(run_prefix)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT job_id, run_id, result FROM jobs WHERE state = 'done' AND collected = 0 AND {} "
+                "ORDER BY job_id".format(where), params).fetchall()
+        return [(job_id, run_id, json.loads(result)) for job_id, run_id, result in rows]
+
+    def mark_collected(self, job_ids) -> None:
+        """Call once the results are stored, so a collector that dies in between hands them out again."""
+        with self._lock:
+            self._conn.executemany("UPDATE jobs SET collected = 1 WHERE job_id = ?", [(j,) for j in job_ids])
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
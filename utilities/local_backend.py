@@ -0,0 +1,258 @@
+import queue, threading, time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+# Local Hugging Face backend for query_model ("HF_<model name>").
+# Each model is loaded once per process and served by a single worker thread.
+# Callers enqueue requests; the worker collects whatever is pending (up to
+# max_batch_size, waiting at most batch_window_ms for more to arrive) and runs
+# them through one left-padded `generate` call, so concurrent scenarios share
+# the forward passes instead of queueing behind each other.
+# Optionally (max_conversations > 0) requests that carry a conversation key
+# (one per agent and scenario) instead keep that conversation's key/value cache
+# between turns: the cache is cropped to the longest token prefix shared with
+# the new prompt, so a turn only processes the tokens appended since the
+# previous one. Cached conversations are bounded by an LRU and dropped when
+# their scenario finishes. They are generated one at a time, outside the
+# batched call, so reuse is off by default: it pays off for a few long
+# dialogues, batching for many concurrent scenarios.
+# For CPU-only machines models can be loaded with int8 (dynamic quantization of
+# the linear layers) or int4 (weight-only, via optimum-quanto) weights; the
+# measured decode speed is printed when a model is loaded.
+
+DEFAULT_MAX_BATCH_SIZE = 8
+DEFAULT_BATCH_WINDOW_MS = 20.0
+DEFAULT_MAX_CONVERSATIONS = 0
+QUANTIZATION_MODES = ["none", "int8", "int4"]
+
+_settings = {"max_batch_size": DEFAULT_MAX_BATCH_SIZE, "batch_window_ms": DEFAULT_BATCH_WINDOW_MS,
+             "max_conversations": DEFAULT_MAX_CONVERSATIONS, "quantize": "none"}
+_servers = {}
+_servers_lock = threading.Lock()
+
+
+def configure_local_backend(max_batch_size=None, batch_window_ms=None, max_conversations=None, quantize=None,
+                            threads=None):
+    """Batching, KV-cache and quantization settings for servers started after this call."""
+    if max_batch_size is not None:
+        _settings["max_batch_size"] = max(1, int(max_batch_size))
+    if batch_window_ms is not None:
+        _settings["batch_window_ms"] = max(0.0, float(batch_window_ms))
+    if max_conversations is not None:
+        _settings["max_conversations"] = max(0, int(max_conversations))
+    if quantize is not None:
+        if quantize not in QUANTIZATION_MODES:
+            raise ValueError("quantize must be one of {}".format(QUANTIZATION_MODES))
+        _settings["quantize"] = quantize
+    if threads:
+        torch.set_num_threads(int(threads))
+
+
+def kv_reuse_enabled() -> bool:
+    return _settings["max_conversations"] > 0
+
+
+def load_causal_lm(model_name, quantize="none"):
+    if quantize == "int8":
+        # dynamic int8 matmuls are a CPU kernel, keep the model on CPU in fp32
+        model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=torch.float32)
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    if quantize == "int4":
+        from transformers import QuantoConfig
+        return AutoModelForCausalLM.from_pretrained(model_name, device_map="cpu",
+                                                    quantization_config=QuantoConfig(weights="int4"))
+    return AutoModelForCausalLM.from_pretrained(model_name, device_map="auto", torch_dtype="auto")
+
+
+def _common_prefix(a, b) -> int:
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+
+class LocalModelServer:
+    def __init__(self, model_name, max_batch_size=DEFAULT_MAX_BATCH_SIZE, batch_window_ms=DEFAULT_BATCH_WINDOW_MS,
+                 max_conversations=DEFAULT_MAX_CONVERSATIONS, quantize="none", report_speed=True):
+        self.model_name = model_name
+        self.quantize = quantize
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window_ms / 1000.0
+        self.max_conversations = max_conversations
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.model = load_causal_lm(model_name, quantize)
+        self.model.eval()
+        self.batches = 0
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.reused_tokens = 0
+        # conversation key -> (token ids covered by the cache, cache)
+        self._conversations = OrderedDict()
+        self._conv_lock = threading.Lock()
+        self._queue = queue.Queue()
+        self.tokens_per_sec = self.measure_speed() if report_speed else None
+        if report_speed:
+            print("[HF] {} ({}, {} threads): {:.1f} tokens/s".format(
+                model_name, quantize, torch.get_num_threads(), self.tokens_per_sec))
+        self._worker = threading.Thread(target=self._serve, name="hf-" + model_name, daemon=True)
+        self._worker.start()
+
+    @torch.inference_mode()
+    def measure_speed(self, new_tokens=32) -> float:
+        inputs = self.tokenizer(["The patient presents with"], return_tensors="pt").to(self.model.device)
+        start = time.perf_counter()
+        self.model.generate(**inputs, max_new_tokens=new_tokens, min_new_tokens=new_tokens, do_sample=False,
+                            pad_token_id=self.tokenizer.pad_token_id)
+        return new_tokens / (time.perf_counter() - start)
+
+    def format_prompt(self, system_prompt, prompt):
+        if getattr(self.tokenizer, "chat_template", None):
+            messages = [{"role": "system", "content": system_prompt}, {"role": "user", "content": prompt}]
+            return self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        return system_prompt + "\n\n" + prompt
+
+    def submit(self, system_prompt, prompt, max_tokens=200, conversation=None) -> Future:
+        future = Future()
+        self._queue.put((self.format_prompt(system_prompt, prompt), max_tokens, conversation, future))
+        return future
+
+    def generate(self, system_prompt, prompt, max_tokens=200, conversation=None) -> str:
+        return self.submit(system_prompt, prompt, max_tokens, conversation).result()
+
+    def release(self, conversation) -> None:
+        with self._conv_lock:
+            self._conversations.pop(conversation, None)
+
+    def close(self) -> None:
+        """Stop the worker once the queued requests are served."""
+        self._queue.put(None)
+        self._worker.join()
+        with self._conv_lock:
+            self._conversations.clear()
+
+    def _next_batch(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                req = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if req is None:
+                self._queue.put(None)
+                break
+            batch.append(req)
+        return batch
+
+    def _serve(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            # conversations run one by one on their own cache, the rest share one call
+            plain = [req for req in batch if req[2] is None or self.max_conversations == 0]
+            for text, max_tokens, conversation, future in batch:
+                if conversation is not None and self.max_conversations > 0:
+                    try:
+                        future.set_result(self._generate_cached(conversation, text, max_tokens))
+                    except Exception as e:
+                        self.release(conversation)
+                        future.set_exception(e)
+            if not plain:
+                continue
+            try:
+                outputs = self._generate_batch([req[0] for req in plain], [req[1] for req in plain])
+            except Exception as e:
+                for req in plain:
+                    req[3].set_exception(e)
+                continue
+            for req, out in zip(plain, outputs):
+                req[3].set_result(out)
+
+    @torch.inference_mode()
+    def _generate_batch(self, texts, max_tokens):
+        inputs = self.tokenizer(texts, return_tensors="pt", padding=True).to(self.model.device)
+        output_ids = self.model.generate(
+            **inputs,
+            max_new_tokens=max(max_tokens),
+            do_sample=False,
+            pad_token_id=self.tokenizer.pad_token_id,
+        )
+        self.batches += 1
+        self.requests += len(texts)
+        self.prompt_tokens += int(inputs["attention_mask"].sum())
+        # left padding: every prompt ends at the same position
+        new_tokens = output_ids[:, inputs["input_ids"].shape[1]:]
+        return [self.tokenizer.decode(ids[:n], skip_special_tokens=True).strip()
+                for ids, n in zip(new_tokens, max_tokens)]
+
+    @torch.inference_mode()
+    def _generate_cached(self, conversation, text, max_tokens):
+        input_ids = self.tokenizer(text, return_tensors="pt")["input_ids"].to(self.model.device)
+        ids = input_ids[0].tolist()
+        with self._conv_lock:
+            cached_ids, cache = self._conversations.pop(conversation, (None, None))
+        reuse = 0
+        if cache is not None:
+            # keep at least one prompt token to feed the model
+            reuse = min(_common_prefix(cached_ids, ids), len(ids) - 1)
+            if reuse > 0:
+                cache.crop(reuse)
+            else:
+                cache = None
+        out = self.model.generate(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            past_key_values=cache,
+            max_new_tokens=max_tokens,
+            do_sample=False,
+            pad_token_id=self.tokenizer.pad_token_id,
+            return_dict_in_generate=True,
+        )
+        self.requests += 1
+        self.prompt_tokens += len(ids)
+        self.reused_tokens += reuse
+        sequence = out.sequences[0]
+        cache = out.past_key_values
+        with self._conv_lock:
+            self._conversations[conversation] = (sequence.tolist()[:cache.get_seq_length()], cache)
+            while len(self._conversations) > self.max_conversations:
+                self._conversations.popitem(last=False)
+        return self.tokenizer.decode(sequence[len(ids):], skip_special_tokens=True).strip()
+
+
+def release_conversation(conversation) -> None:
+    """Drop the cached state of a finished conversation on every loaded model."""
+    with _servers_lock:
+        servers = list(_servers.values())
+    for server in servers:
+        server.release(conversation)
+
+
+def get_local_model(model_name) -> LocalModelServer:
+    with _servers_lock:
+        server = _servers.get(model_name)
+        if server is None:
+            server = LocalModelServer(model_name, **_settings)
+            _servers[model_name] = server
+        return server
+
+
+def unload_local_model(model_name) -> LocalModelServer:
+    """Stop and forget the shared server of `model_name`, the next use loads it again with the current settings."""
+    with _servers_lock:
+        server = _servers.pop(model_name, None)
+    if server is not None:
+        server.close()
+    return server
@@ -0,0 +1,227 @@
+import json, os, threading, time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Live metrics for long-running evaluations.
+# query_model reports every backend request (latency, cache hits, retries,
+# rate-limit errors) and the runners report scenario progress. The numbers are
+# served in Prometheus text format on http://<host>:<port>/metrics and/or
+# rewritten as JSON to a status file every few seconds, so throughput drops
+# and provider outages show up while the run is still going.
+
+LATENCY_BUCKETS = (0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+RATE_WINDOW_S = 60.0
+
+
+def is_rate_limit(error: Exception) -> bool:
+    status = getattr(error, "status_code", None) or getattr(error, "http_status", None)
+    text = "{} {}".format(type(error).__name__, error).lower()
+    return status == 429 or "429" in text or "ratelimit" in text or "rate limit" in text
+
+
+def _backend():
+    return {"requests": 0, "cached": 0, "errors": 0, "retries": 0, "rate_limited": 0,
+            "latency_sum": 0.0, "buckets": [0] * (len(LATENCY_BUCKETS) + 1), "recent": deque()}
+
+
+class Metrics:
+    def __init__(self, total_scenarios=None):
+        self.total_scenarios = total_scenarios
+        self.started = time.time()
+        self.done = 0
+        self.in_flight = 0
+        self.failed = 0
+        self.diagnosed = 0
+        self.correct = 0
+        self.backends = {}
+        self.status_file = None
+        self._server = None
+        self._status_stop = None
+        self._lock = threading.Lock()
+
+    def add_scenarios(self, n: int) -> None:
+        with self._lock:
+            self.total_scenarios = (self.total_scenarios or 0) + n
+
+    def scenario_started(self) -> None:
+        with self._lock:
+            self.in_flight += 1
+
+    def scenario_finished(self, result=None) -> None:
+        """`result` is the run_scenario dict, None if the scenario failed."""
+        with self._lock:
+            self.in_flight -= 1
+            if result is None:
+                self.failed += 1
+                return
+            self.done += 1
+            if result.get("correct") is not None:
+                self.diagnosed += 1
+                self.correct += int(result["correct"])
+
+    def observe_request(self, backend: str, latency=None, cached=False) -> None:
+        now = time.time()
+        with self._lock:
+            b = self.backends.setdefault(backend, _backend())
+            b["requests"] += 1
+            b["recent"].append(now)
+            while b["recent"] and b["recent"][0] < now - RATE_WINDOW_S:
+                b["recent"].popleft()
+            if cached:
+                b["cached"] += 1
+                return
+            b["latency_sum"] += latency
+            idx = next((i for i, edge in enumerate(LATENCY_BUCKETS) if latency <= edge), len(LATENCY_BUCKETS))
+            b["buckets"][idx] += 1
+
+    def observe_error(self, backend: str, error: Exception, retrying=True) -> None:
+        with self._lock:
+            b = self.backends.setdefault(backend, _backend())
+            b["errors"] += 1
+            b["retries"] += int(retrying)
+            b["rate_limited"] += int(is_rate_limit(error))
+
+    def snapshot(self) -> dict:
+        now = time.time()
+        with self._lock:
+            elapsed = now - self.started
+            finished = self.done + self.failed
+            remaining = None
+            eta = None
+            if self.total_scenarios is not None:
+                remaining = max(self.total_scenarios - finished - self.in_flight, 0)
+                if finished:
+                    # completion rate so far, which already reflects the concurrency
+                    eta = (remaining + self.in_flight) * elapsed / finished
+            requests = sum(b["requests"] for b in self.backends.values())
+            cached = sum(b["cached"] for b in self.backends.values())
+            backends = {}
+            for name, b in self.backends.items():
+                live = b["requests"] - b["cached"]
+                backends[name] = {
+                    "requests": b["requests"],
+                    "cached": b["cached"],
+                    "requests_per_min": len([t for t in b["recent"] if t >= now - RATE_WINDOW_S]) * 60.0 / RATE_WINDOW_S,
+                    "mean_latency_s": b["latency_sum"] / live if live else None,
+                    "latency_buckets": dict(zip([str(e) for e in LATENCY_BUCKETS] + ["+Inf"], b["buckets"])),
+                    "latency_sum_s": b["latency_sum"],
+                    "errors": b["errors"],
+                    "retries": b["retries"],
+                    "rate_limited": b["rate_limited"],
+                }
+            return {
+                "time": now,
+                "elapsed_s": elapsed,
+                "scenarios": {"total": self.total_scenarios, "done": self.done, "failed": self.failed,
+                              "in_flight": self.in_flight, "remaining": remaining},
+                "accuracy": self.correct / self.done if self.done else None,
+                "diagnosed": self.diagnosed,
+                "cache_hit_ratio": cached / requests if requests else None,
+                "eta_s": eta,
+                "backends": backends,
+            }
+
+    def prometheus(self) -> str:
+        snap = self.snapshot()
+        sc = snap["scenarios"]
+        lines = [
+            "# TYPE agentclinic_scenarios_done_total counter",
+            "agentclinic_scenarios_done_total {}".format(sc["done"]),
+            "# TYPE agentclinic_scenarios_failed_total counter",
+            "agentclinic_scenarios_failed_total {}".format(sc["failed"]),
+            "# TYPE agentclinic_scenarios_in_flight gauge",
+            "agentclinic_scenarios_in_flight {}".format(sc["in_flight"]),
+        ]
+        if sc["remaining"] is not None:
+            lines += ["# TYPE agentclinic_scenarios_remaining gauge",
+                      "agentclinic_scenarios_remaining {}".format(sc["remaining"])]
+        if snap["accuracy"] is not None:
+            lines += ["# TYPE agentclinic_accuracy gauge", "agentclinic_accuracy {:.6f}".format(snap["accuracy"])]
+        if snap["cache_hit_ratio"] is not None:
+            lines += ["# TYPE agentclinic_cache_hit_ratio gauge",
+                      "agentclinic_cache_hit_ratio {:.6f}".format(snap["cache_hit_ratio"])]
+        if snap["eta_s"] is not None:
+            lines += ["# TYPE agentclinic_eta_seconds gauge", "agentclinic_eta_seconds {:.1f}".format(snap["eta_s"])]
+        per_backend = [
+            ("agentclinic_requests_total", "counter", lambda b: b["requests"] - b["cached"]),
+            ("agentclinic_cached_requests_total", "counter", lambda b: b["cached"]),
+            ("agentclinic_request_errors_total", "counter", lambda b: b["errors"]),
+            ("agentclinic_retries_total", "counter", lambda b: b["retries"]),
+            ("agentclinic_rate_limited_total", "counter", lambda b: b["rate_limited"]),
+        ]
+        for name, kind, value in per_backend:
+            lines.append("# TYPE {} {}".format(name, kind))
+            for backend, b in sorted(snap["backends"].items()):
+                lines.append('{}{{backend="{}"}} {}'.format(name, backend, value(b)))
+        lines.append("# TYPE agentclinic_request_latency_seconds histogram")
+        for backend, b in sorted(snap["backends"].items()):
+            count = 0
+            for edge, n in b["latency_buckets"].items():
+                count += n
+                lines.append('agentclinic_request_latency_seconds_bucket{{backend="{}",le="{}"}} {}'.format(backend, edge, count))
+            lines.append('agentclinic_request_latency_seconds_sum{{backend="{}"}} {:.3f}'.format(backend, b["latency_sum_s"]))
+            lines.append('agentclinic_request_latency_seconds_count{{backend="{}"}} {}'.format(backend, count))
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int, host: str = "127.0.0.1") -> None:
+        """Prometheus endpoint at http://host:port/metrics on a background thread."""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip("/") not in ("", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def start_status_file(self, path: str, interval: float = 15.0) -> None:
+        self.status_file = path
+        self._status_stop = threading.Event()
+
+        def _loop():
+            while not self._status_stop.wait(interval):
+                self.write_status(path)
+
+        threading.Thread(target=_loop, daemon=True).start()
+
+    def close(self) -> None:
+        """Stops the endpoint and writes the final status file."""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if self._status_stop is not None:
+            self._status_stop.set()
+            self.write_status(self.status_file)
+
+    def write_status(self, path) -> None:
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.snapshot(), f, indent=2)
+        os.replace(tmp_path, path)
+
+
+def start_metrics(port=None, status_file=None, interval=15.0, total_scenarios=None):
+    """Metrics wired into query_model, or None when neither an endpoint nor a status file is requested."""
+    if not port and not status_file:
+        return None
+    from utilities.utility import set_metrics
+    metrics = Metrics(total_scenarios)
+    if port:
+        metrics.serve(port)
+        print("Metrics on http://127.0.0.1:{}/metrics".format(port))
+    if status_file:
+        metrics.start_status_file(status_file, interval)
+    set_metrics(metrics)
+    return metrics
@@ -0,0 +1,143 @@
+import json, sqlite3, threading, time
+from typing import List, Optional
+
+from agents.models import NotePayload
+
+# Append-only store for structured SOAP notes.
+# Every note is one row of a single SQLite file; the full NotePayload is kept
+# as JSON and the fields used to compare runs (diagnosis, confidence,
+# turn range, models, ...) are indexed columns, so notes from many runs can be
+# bulk-loaded and queried without scanning thousands of files.
+# Dialogue transcripts and objective caches are stored alongside, so notes can
+# be regenerated offline (soap_batch.py) without re-simulating the dialogue.
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS notes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id TEXT NOT NULL,
+    scenario_id INTEGER,
+    dataset TEXT,
+    doctor_llm TEXT,
+    soap_llm TEXT,
+    diagnosis TEXT,
+    confidence REAL,
+    turn_start INTEGER,
+    turn_end INTEGER,
+    note_status TEXT,
+    created REAL,
+    payload TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS notes_run ON notes (run_id, scenario_id);
+CREATE INDEX IF NOT EXISTS notes_scenario ON notes (dataset, scenario_id);
+CREATE INDEX IF NOT EXISTS notes_diagnosis ON notes (diagnosis);
+CREATE TABLE IF NOT EXISTS transcripts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id TEXT NOT NULL,
+    scenario_id INTEGER,
+    dataset TEXT,
+    doctor_llm TEXT,
+    created REAL,
+    lines TEXT NOT NULL,
+    objective_cache TEXT
+);
+CREATE INDEX IF NOT EXISTS transcripts_run ON transcripts (run_id, scenario_id);
+"""
+
+COLUMNS = ["id", "run_id", "scenario_id", "dataset", "doctor_llm", "soap_llm", "diagnosis",
+           "confidence", "turn_start", "turn_end", "note_status", "created"]
+
+
+class NoteStore:
+    def __init__(self, path="soap_notes/notes.sqlite"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+
+    def add(self, note: NotePayload, *, run_id: str, scenario_id: Optional[int] = None, dataset: str = "",
+            doctor_llm: str = "", soap_llm: str = "") -> int:
+        turn_range = list(note.meta.turn_range) + [None, None]
+        row = (run_id, scenario_id, dataset, doctor_llm, soap_llm, note.diagnosis.final,
+               note.diagnosis.confidence, turn_range[0], turn_range[1], note.meta.note_status,
+               time.time(), note.model_dump_json())
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT INTO notes (run_id, scenario_id, dataset, doctor_llm, soap_llm, diagnosis, confidence, "
+                "turn_start, turn_end, note_status, created, payload) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                row)
+            self._conn.commit()
+            return cur.lastrowid
+
+    def query(self, where: str = "", params=(), with_payload: bool = False) -> List[dict]:
+        """
+        Rows as dicts, e.g. query("run_id = ? AND confidence >= ?", (run, 0.8)).
+        With `with_payload` the parsed NotePayload is included as "note".
+        """
+        cols = COLUMNS + (["payload"] if with_payload else [])
+        sql = "SELECT {} FROM notes".format(", ".join(cols))
+        if where:
+            sql += " WHERE " + where
+        sql += " ORDER BY id"
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        out = []
+        for row in rows:
+            rec = dict(zip(cols, row))
+            if with_payload:
+                rec["note"] = NotePayload.model_validate_json(rec.pop("payload"))
+            out.append(rec)
+        return out
+
+    def has_note(self, run_id: str, scenario_id: int) -> bool:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM notes WHERE run_id = ? AND scenario_id = ? LIMIT 1", (run_id, scenario_id)).fetchone()
+        return row is not None
+
+    def add_transcript(self, lines: List[list], *, run_id: str, scenario_id: Optional[int] = None,
+                       dataset: str = "", doctor_llm: str = "", objective_cache: Optional[dict] = None) -> int:
+        """`lines` is a list of [turn, role, text] as passed to SoapAgent.observe."""
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT INTO transcripts (run_id, scenario_id, dataset, doctor_llm, created, lines, objective_cache) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (run_id, scenario_id, dataset, doctor_llm, time.time(), json.dumps(lines, ensure_ascii=False),
+                 json.dumps(objective_cache, ensure_ascii=False) if objective_cache is not None else None))
+            self._conn.commit()
+            return cur.lastrowid
+
+    def transcripts(self, run_id: Optional[str] = None) -> List[dict]:
+        sql = "SELECT run_id, scenario_id, dataset, doctor_llm, lines, objective_cache FROM transcripts"
+        params = ()
+        if run_id is not None:
+            sql += " WHERE run_id = ?"
+            params = (run_id,)
+        with self._lock:
+            rows = self._conn.execute(sql + " ORDER BY id", params).fetchall()
+        return [{"run_id": r[0], "scenario_id": r[1], "dataset": r[2], "doctor_llm": r[3],
+                 "lines": json.loads(r[4]), "objective_cache": json.loads(r[5]) if r[5] else None} for r in rows]
+
+    def runs(self) -> List[str]:
+        with self._lock:
+            return [r[0] for r in self._conn.execute("SELECT DISTINCT run_id FROM notes ORDER BY run_id")]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Query the SOAP note store")
+    parser.add_argument("--store", type=str, default="soap_notes/notes.sqlite")
+    parser.add_argument("--where", type=str, default="", help="SQL filter, e.g. \"run_id = 'x' AND confidence > 0.5\"")
+    parser.add_argument("--payload", action="store_true", help="Print the full notes as JSON lines")
+    args = parser.parse_args()
+    store = NoteStore(args.store)
+    for rec in store.query(args.where, with_payload=args.payload):
+        if args.payload:
+            rec["note"] = rec["note"].model_dump()
+        print(json.dumps(rec, ensure_ascii=False))
@@ -0,0 +1,203 @@
+import hashlib, json, os, re, threading, urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from utilities.utility import query_model
+
+# IPIP-NEO administration for the agents.
+# Questions come from a local, versioned bank (IPIP-BIG5/questions/), so taking
+# the inventory needs no network once the bank has been prepared (with --prepare
+# or on first use). Items are sent in concurrent batches outside the agent's
+# dialogue history, answers are requested as "id: score" lines so they can be
+# matched by id, and the batch size adapts to how completely the model answers.
+# Answers are cached per (model, persona prompt, question set).
+
+BANK_DIR = "IPIP-BIG5/questions"
+CACHE_PATH = "IPIP-BIG5/inventory_cache.json"
+# five-factor-e question files the bank is prepared from
+BANK_SOURCE = "https://raw.githubusercontent.com/NeuroQuestAi/five-factor-e/main/data/IPIP-NEO/{}/questions.json"
+BANK_VERSION = 1
+
+INVENTORY_PROMPT = (
+    "**Inventory Mode**. You are completing a standardized personality inventory (IPIP-NEO). "
+    "Rate how accurately each statement describes you with ONE integer 1-5, where "
+    "1=Very Inaccurate, 2=Moderately Inaccurate, 3=Neither, 4=Moderately Accurate, 5=Very Accurate.\n"
+    "Answer EVERY item on its own line in the form \"<id>: <score>\", for example \"17: 4\". "
+    "Do not add explanations or commentary.\n\n"
+)
+
+class IncompleteInventory(RuntimeError):
+    """Some items were still unanswered after every round; `answers` holds the rest."""
+
+    def __init__(self, backend, answers, missing):
+        super().__init__("{} left {} of {} IPIP-NEO items unanswered (ids {}{})".format(
+            backend, len(missing), len(answers) + len(missing), ", ".join(map(str, missing[:10])),
+            ", ..." if len(missing) > 10 else ""))
+        self.answers = answers
+        self.missing = missing
+
+
+_ANSWER_RE = re.compile(r"(\d+)\s*[\.:=)\-]\s*([1-5])\b")
+_cache_lock = threading.Lock()
+
+
+def _sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def _manifest_path(bank_dir):
+    return os.path.join(bank_dir, "manifest.json")
+
+
+def prepare_question_bank(question_set: int, bank_dir: str = BANK_DIR) -> str:
+    """Download one question set into the local bank and record its hash."""
+    with urllib.request.urlopen(BANK_SOURCE.format(question_set)) as r:
+        data = r.read()
+    if not json.loads(data.decode("utf-8")).get("questions"):
+        raise ValueError("Downloaded file missing 'questions' key.")
+    os.makedirs(bank_dir, exist_ok=True)
+    path = os.path.join(bank_dir, "{}.json".format(question_set))
+    with open(path, "wb") as f:
+        f.write(data)
+    manifest = {"version": BANK_VERSION, "sets": {}}
+    if os.path.exists(_manifest_path(bank_dir)):
+        with open(_manifest_path(bank_dir), "r") as f:
+            manifest = json.load(f)
+    manifest["sets"][str(question_set)] = {"source": BANK_SOURCE.format(question_set), "sha256": _sha256(data)}
+    with open(_manifest_path(bank_dir), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return path
+
+
+def load_question_bank(question_set: int, bank_dir: str = BANK_DIR, allow_download: bool = False):
+    """Returns [{'id': int, 'text': str}, ...] sorted by id, verified against the manifest."""
+    if question_set not in (120, 300):
+        raise ValueError("question_set must be 120 or 300")
+    path = os.path.join(bank_dir, "{}.json".format(question_set))
+    if not os.path.exists(path):
+        if not allow_download:
+            raise FileNotFoundError(
+                "IPIP-NEO-{0} question bank not found in {1}. Prepare it once with: "
+                "python -m utilities.personality_inventory --prepare {0}".format(question_set, bank_dir))
+        prepare_question_bank(question_set, bank_dir)
+    with open(path, "rb") as f:
+        data = f.read()
+    with open(_manifest_path(bank_dir), "r") as f:
+        entry = json.load(f)["sets"].get(str(question_set), {})
+    if entry.get("sha256") != _sha256(data):
+        raise ValueError("{} does not match the bank manifest".format(path))
+    questions = [{"id": int(q["id"]), "text": q["text"]} for q in json.loads(data.decode("utf-8"))["questions"]]
+    questions.sort(key=lambda q: q["id"])
+    return questions
+
+
+def parse_answers(resp: str, expected_ids) -> dict:
+    """Extract {id: score} for the expected ids from an "id: score" formatted reply."""
+    expected = set(expected_ids)
+    answers = {}
+    for qid, score in _ANSWER_RE.findall(str(resp)):
+        qid = int(qid)
+        if qid in expected and qid not in answers:
+            answers[qid] = int(score)
+    return answers
+
+
+def _cache_key(backend: str, system_prompt: str, question_set: int) -> str:
+    blob = json.dumps([BANK_VERSION, backend, system_prompt, question_set])
+    return _sha256(blob.encode("utf-8"))
+
+
+def _load_cache(cache_path):
+    if not os.path.exists(cache_path):
+        return {}
+    with open(cache_path, "r") as f:
+        return json.load(f)
+
+
+def _store_cache(cache_path, key, answers):
+    with _cache_lock:
+        cache = _load_cache(cache_path)
+        cache[key] = {str(qid): score for qid, score in answers.items()}
+        tmp_path = cache_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, cache_path)
+
+
+def administer_inventory(
+        backend: str,
+        system_prompt: str,
+        *,
+        question_set: int = 120,
+        batch_size: int = 30,
+        min_batch_size: int = 5,
+        max_batch_size: int = 60,
+        max_workers: int = 4,
+        max_rounds: int = 4,
+        use_cache: bool = True,
+        cache_path: str = CACHE_PATH,
+        bank_dir: str = BANK_DIR,
+        allow_download: bool = False,
+        show_progress: bool = True,
+) -> dict:
+    """
+    Ask every inventory item and return {question_id: 1..5}.
+    Each round sends the unanswered items in concurrent batches; items a batch
+    missed are retried next round with a smaller batch size, complete rounds
+    grow it. Raises IncompleteInventory if items are still unanswered after
+    `max_rounds`. The bank is prepared (downloaded once) if it is missing and
+    `allow_download` is set.
+    """
+    key = _cache_key(backend, system_prompt, question_set)
+    if use_cache:
+        cached = _load_cache(cache_path).get(key)
+        if cached is not None:
+            if show_progress:
+                print("[IPIP-NEO] Using cached answers for {}".format(backend))
+            return {int(qid): score for qid, score in cached.items()}
+
+    questions = load_question_bank(question_set, bank_dir, allow_download)
+    id2text = {q["id"]: q["text"] for q in questions}
+    collected = {}
+
+    def _ask(chunk):
+        prompt = INVENTORY_PROMPT + "\n".join("{}. {}".format(qid, id2text[qid]) for qid in chunk)
+        resp = query_model(backend, prompt, system_prompt, max_tokens=8 * len(chunk) + 20, role="inventory")
+        return parse_answers(resp, chunk)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        for _round in range(max_rounds):
+            missing = [qid for qid in id2text if qid not in collected]
+            if not missing:
+                break
+            chunks = [missing[i:i + batch_size] for i in range(0, len(missing), batch_size)]
+            before = len(collected)
+            for answers in ex.map(_ask, chunks):
+                collected.update(answers)
+            rate = (len(collected) - before) / len(missing)
+            # adapt the batch size to how reliably this model fills a batch
+            if rate < 0.9:
+                batch_size = max(min_batch_size, batch_size // 2)
+            else:
+                batch_size = min(max_batch_size, int(batch_size * 1.5))
+            if show_progress:
+                print("[IPIP-NEO] Collected {}/{} ({} calls, next batch size {})".format(
+                    len(collected), len(id2text), len(chunks), batch_size))
+
+    missing = [qid for qid in id2text if qid not in collected]
+    if missing:
+        # made-up answers would skew the scores
+        raise IncompleteInventory(backend, collected, missing)
+    if use_cache:
+        _store_cache(cache_path, key, collected)
+    return collected
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Prepare the local IPIP-NEO question bank")
+    parser.add_argument("--prepare", type=int, nargs="*", choices=[120, 300], default=[120, 300])
+    parser.add_argument("--bank_dir", type=str, default=BANK_DIR)
+    args = parser.parse_args()
+    for _set in args.prepare:
+        print("Saved", prepare_question_bank(_set, args.bank_dir))
@@ -0,0 +1,220 @@
+import builtins, functools, io, os, sys, threading, time
+
+# Profiling hooks for the orchestration hot path (agentclinic.py --profile).
+# install() wraps main, run_scenario, the agent inference and prompt-building
+# methods, query_model, grading, persona loading, print and sleep in timing
+# spans. Each span measures wall time and the calling thread's CPU time, so
+# wall - CPU is time spent waiting (on a provider, or on a local model's
+# server thread) and CPU is local work. Optionally a cProfile per thread or a
+# stack sampler adds per-function detail the spans do not cover.
+# dump() writes a per-span breakdown (report.txt) and flamegraph-compatible
+# collapsed stacks (*.folded, for flamegraph.pl or speedscope).
+
+SPAN_METHODS = [
+    ("agents.DoctorAgent", "DoctorAgent", ["inference_doctor", "system_prompt"]),
+    ("agents.PatientAgent", "PatientAgent", ["inference_patient", "system_prompt"]),
+    ("agents.MeasurementAgent", "MeasurementAgent", ["inference_measurement", "system_prompt"]),
+]
+# module-level functions, replaced wherever they were imported by name
+SPAN_FUNCTIONS = [
+    ("utilities.utility", ["query_model", "compare_results", "persona_card_from_json", "persona_card",
+                           "load_personalities"]),
+    ("agentclinic", ["main", "run_scenario", "build_agents", "objective_cache"]),
+]
+
+
+def _empty():
+    return {"calls": 0, "wall": 0.0, "cpu": 0.0, "self_wall": 0.0, "self_cpu": 0.0}
+
+
+class Profiler:
+    def __init__(self, mode="spans", sample_interval_ms=5.0):
+        """`mode` is "spans", "cprofile" (spans + cProfile per thread) or "sample" (spans + stack sampling)."""
+        self.mode = mode
+        self.sample_interval = sample_interval_ms / 1000.0
+        self.stats = {}
+        self.folded_wall = {}
+        self.folded_cpu = {}
+        self.samples = {}
+        self._profiles = []
+        self._restore = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._sampler = None
+        self._stop = threading.Event()
+
+    # spans
+
+    def _enter(self, name):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        if not stack and self.mode == "cprofile":
+            import cProfile
+            prof = cProfile.Profile()
+            try:
+                prof.enable()
+            except ValueError:
+                # newer Pythons allow only one active profiler, later threads go without
+                prof = None
+            if prof is not None:
+                with self._lock:
+                    self._profiles.append(prof)
+            self._local.cprofile = prof
+        # [name, wall start, cpu start, child wall, child cpu]
+        stack.append([name, time.perf_counter(), time.thread_time(), 0.0, 0.0])
+
+    def _exit(self):
+        stack = self._local.stack
+        wall_end, cpu_end = time.perf_counter(), time.thread_time()
+        name, wall_start, cpu_start, child_wall, child_cpu = stack[-1]
+        wall, cpu = wall_end - wall_start, cpu_end - cpu_start
+        path = ";".join(frame[0] for frame in stack)
+        stack.pop()
+        if stack:
+            stack[-1][3] += wall
+            stack[-1][4] += cpu
+        elif getattr(self._local, "cprofile", None) is not None:
+            self._local.cprofile.disable()
+            self._local.cprofile = None
+        self_wall, self_cpu = max(wall - child_wall, 0.0), max(cpu - child_cpu, 0.0)
+        with self._lock:
+            st = self.stats.setdefault(name, _empty())
+            st["calls"] += 1
+            st["wall"] += wall
+            st["cpu"] += cpu
+            st["self_wall"] += self_wall
+            st["self_cpu"] += self_cpu
+            self.folded_wall[path] = self.folded_wall.get(path, 0.0) + self_wall
+            self.folded_cpu[path] = self.folded_cpu.get(path, 0.0) + self_cpu
+
+    def wrap(self, fn, name):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            self._enter(name)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self._exit()
+        wrapper.__wrapped_by_profiler__ = fn
+        return wrapper
+
+    def _replace(self, owner, attr, value):
+        self._restore.append((owner, attr, getattr(owner, attr)))
+        setattr(owner, attr, value)
+
+    def install(self, namespace=None) -> None:
+        """
+        Wraps the hot-path functions in spans. `namespace` is the globals() of
+        the running script, so `python agentclinic.py` (module __main__) is
+        covered as well as an imported agentclinic.
+        """
+        import importlib
+        for module_name, class_name, methods in SPAN_METHODS:
+            cls = getattr(importlib.import_module(module_name), class_name)
+            for method in methods:
+                self._replace(cls, method, self.wrap(getattr(cls, method), "{}.{}".format(class_name, method)))
+        modules = [m for m in list(sys.modules.values()) if m is not None]
+        for module_name, names in SPAN_FUNCTIONS:
+            home = sys.modules.get(module_name)
+            if home is None and namespace is not None and module_name == "agentclinic":
+                home = sys.modules.get(namespace.get("__name__"))
+            if home is None:
+                continue
+            for fn_name in names:
+                original = getattr(home, fn_name, None)
+                if original is None:
+                    continue
+                wrapped = self.wrap(original, fn_name)
+                for module in modules:
+                    if getattr(module, fn_name, None) is original:
+                        self._replace(module, fn_name, wrapped)
+                if namespace is not None and namespace.get(fn_name) is original:
+                    self._restore.append((namespace, fn_name, original))
+                    namespace[fn_name] = wrapped
+        self._replace(builtins, "print", self.wrap(builtins.print, "print"))
+        # turn delays and retry back-off
+        self._replace(time, "sleep", self.wrap(time.sleep, "sleep"))
+        if self.mode == "sample":
+            self._sampler = threading.Thread(target=self._sample_loop, daemon=True)
+            self._sampler.start()
+
+    def uninstall(self) -> None:
+        for owner, attr, original in reversed(self._restore):
+            if isinstance(owner, dict):
+                owner[attr] = original
+            else:
+                setattr(owner, attr, original)
+        self._restore = []
+        if self._sampler is not None:
+            self._stop.set()
+            self._sampler.join()
+            self._sampler = None
+
+    # sampling
+
+    def _sample_loop(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.sample_interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                names = []
+                while frame is not None:
+                    code = frame.f_code
+                    if code is _WRAPPER_CODE:
+                        frame = frame.f_back
+                        continue
+                    names.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                path = ";".join(reversed(names))
+                self.samples[path] = self.samples.get(path, 0) + 1
+
+    # output
+
+    def report(self) -> str:
+        with self._lock:
+            stats = {k: dict(v) for k, v in self.stats.items()}
+        total = stats.get("main", {}).get("wall") or sum(s["self_wall"] for s in stats.values())
+        cpu = sum(s["self_cpu"] for s in stats.values())
+        backend = stats.get("query_model", _empty())
+        out = io.StringIO()
+        out.write("wall {:.2f}s  local CPU {:.2f}s  waiting on backends {:.2f}s  sleeping {:.2f}s\n\n".format(
+            total, cpu, max(backend["self_wall"] - backend["self_cpu"], 0.0), stats.get("sleep", _empty())["self_wall"]))
+        cols = "{:<40} {:>7} {:>10} {:>10} {:>10} {:>10} {:>10}\n"
+        out.write(cols.format("span", "calls", "wall_s", "self_wall", "self_cpu", "self_wait", "cpu_ms/call"))
+        for name, s in sorted(stats.items(), key=lambda kv: -kv[1]["self_wall"]):
+            out.write(cols.format(name, s["calls"], "{:.3f}".format(s["wall"]), "{:.3f}".format(s["self_wall"]),
+                                  "{:.3f}".format(s["self_cpu"]), "{:.3f}".format(max(s["self_wall"] - s["self_cpu"], 0.0)),
+                                  "{:.3f}".format(1000 * s["self_cpu"] / s["calls"])))
+        return out.getvalue()
+
+    def dump(self, out_dir) -> str:
+        """Writes report.txt, spans_wall.folded, spans_cpu.folded and the cProfile/sample output."""
+        os.makedirs(out_dir, exist_ok=True)
+        with open(os.path.join(out_dir, "report.txt"), "w") as f:
+            f.write(self.report())
+        # collapsed stacks, values in microseconds
+        for name, folded in (("spans_wall.folded", self.folded_wall), ("spans_cpu.folded", self.folded_cpu)):
+            with open(os.path.join(out_dir, name), "w") as f:
+                for path, seconds in sorted(folded.items()):
+                    if int(seconds * 1e6):
+                        f.write("{} {}\n".format(path, int(seconds * 1e6)))
+        if self._profiles:
+            import pstats
+            stats = pstats.Stats(self._profiles[0])
+            for prof in self._profiles[1:]:
+                stats.add(prof)
+            stats.dump_stats(os.path.join(out_dir, "cprofile.pstats"))
+            with open(os.path.join(out_dir, "cprofile.txt"), "w") as f:
+                stats.stream = f
+                stats.sort_stats("tottime").print_stats(60)
+        if self.samples:
+            with open(os.path.join(out_dir, "samples.folded"), "w") as f:
+                for path, count in sorted(self.samples.items()):
+                    f.write("{} {}\n".format(path, count))
+        return out_dir
+
+
+# span wrappers are left out of sampled stacks
+_WRAPPER_CODE = Profiler(None).wrap(len, "").__code__
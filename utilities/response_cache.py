@@ -0,0 +1,45 @@
+import hashlib, json, sqlite3, threading, time
+
+# Persistent cache of backend responses for query_model.
+# Identical requests (same model, prompts, output limit and image) are served
+# from a local SQLite file instead of the provider. It is shared by every
+# thread of a run and by later runs pointed at the same file.
+
+
+class ResponseCache:
+    def __init__(self, path="response_cache.sqlite"):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, model TEXT, response TEXT, created REAL)")
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(model_str, prompt, system_prompt, max_tokens, image_url=None) -> str:
+        blob = json.dumps([model_str, system_prompt, prompt, max_tokens, image_url])
+        return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, model_str, response) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, response, created) VALUES (?, ?, ?, ?)",
+                (key, model_str, response, time.time()))
+            self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
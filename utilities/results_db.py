@@ -0,0 +1,256 @@
+import json, re, sqlite3, threading, time, uuid
+from dataclasses import asdict, is_dataclass
+from typing import Dict, List
+
+# Local database of simulation results.
+# One SQLite file holds every run: its configuration, one row per scenario
+# (diagnosis, moderator grade, turns), the per-turn dialogue events and the
+# tests the doctor requested, with indexes for the usual aggregate queries
+# (accuracy by model x bias x dataset, turns to diagnosis, requested tests,
+# spend per role).
+# Runs of kind "prefix" (the shared opening turns of fork_runner.py) only count
+# towards spend: accuracy, turns, requested tests and the scheduler's history
+# look at "full" runs.
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    started REAL,
+    dataset TEXT,
+    doctor_llm TEXT,
+    patient_llm TEXT,
+    measurement_llm TEXT,
+    moderator_llm TEXT,
+    doctor_bias TEXT,
+    patient_bias TEXT,
+    total_inferences INTEGER,
+    config TEXT,
+    kind TEXT NOT NULL DEFAULT 'full'
+);
+CREATE TABLE IF NOT EXISTS scenarios (
+    run_id TEXT NOT NULL,
+    scenario_id INTEGER NOT NULL,
+    correct INTEGER,
+    diagnosis TEXT,
+    correct_diagnosis TEXT,
+    grade TEXT,
+    turns INTEGER,
+    finished REAL,
+    PRIMARY KEY (run_id, scenario_id)
+);
+CREATE TABLE IF NOT EXISTS turns (
+    run_id TEXT NOT NULL,
+    scenario_id INTEGER NOT NULL,
+    turn INTEGER NOT NULL,
+    role TEXT,
+    text TEXT
+);
+CREATE TABLE IF NOT EXISTS test_requests (
+    run_id TEXT NOT NULL,
+    scenario_id INTEGER NOT NULL,
+    turn INTEGER,
+    test TEXT
+);
+CREATE TABLE IF NOT EXISTS costs (
+    run_id TEXT NOT NULL,
+    scenario_id INTEGER NOT NULL,
+    role TEXT,
+    calls INTEGER,
+    cached_calls INTEGER,
+    prompt_tokens INTEGER,
+    completion_tokens INTEGER,
+    cost_usd REAL
+);
+CREATE INDEX IF NOT EXISTS runs_models ON runs (doctor_llm, doctor_bias, dataset);
+CREATE INDEX IF NOT EXISTS turns_scenario ON turns (run_id, scenario_id, turn);
+CREATE INDEX IF NOT EXISTS tests_name ON test_requests (test);
+CREATE INDEX IF NOT EXISTS tests_scenario ON test_requests (run_id, scenario_id);
+CREATE INDEX IF NOT EXISTS costs_scenario ON costs (run_id, scenario_id);
+"""
+
+RUN_COLUMNS = ["dataset", "doctor_llm", "patient_llm", "measurement_llm", "moderator_llm", "doctor_bias",
+               "patient_bias", "total_inferences"]
+
+RUN_KINDS = ("full", "prefix")
+
+_TEST_RE = re.compile(r"REQUEST TEST\s*:\s*([^\n.]+)")
+
+
+def new_run_id(prefix: str = "") -> str:
+    """`<prefix>-<time>-<random suffix>`, unique even for runs started in the same second."""
+    stamp = "{}-{}".format(time.strftime("%Y%m%d-%H%M%S"), uuid.uuid4().hex[:6])
+    return "{}-{}".format(prefix, stamp) if prefix else stamp
+
+
+def requested_tests(text: str) -> List[str]:
+    return [t.strip().strip("[]\"' ") for t in _TEST_RE.findall(text or "") if t.strip()]
+
+
+class ResultsDB:
+    def __init__(self, path="results.sqlite"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_SCHEMA)
+        # databases written before run kinds existed
+        if "kind" not in {row[1] for row in self._conn.execute("PRAGMA table_info(runs)")}:
+            self._conn.execute("ALTER TABLE runs ADD COLUMN kind TEXT NOT NULL DEFAULT 'full'")
+        self._conn.commit()
+
+    def add_run(self, run_id: str, cfg, kind: str = "full") -> None:
+        """
+        `cfg` is a ClinicConfig (or a dict with the same fields), `kind` is "full" or "prefix" (partial
+        dialogues shared by forked runs). Raises ValueError if `run_id` exists.
+        """
+        if kind not in RUN_KINDS:
+            raise ValueError("kind must be one of {}".format(RUN_KINDS))
+        config = asdict(cfg) if is_dataclass(cfg) else dict(cfg)
+        with self._lock:
+            if self._conn.execute("SELECT 1 FROM runs WHERE run_id = ?", (run_id,)).fetchone():
+                raise ValueError("Run {} already exists in {}".format(run_id, self.path))
+            self._conn.execute(
+                "INSERT INTO runs (run_id, started, {}, config, kind) VALUES (?, ?, {}, ?, ?)".format(
+                    ", ".join(RUN_COLUMNS), ", ".join("?" for _ in RUN_COLUMNS)),
+                [run_id, time.time()] + [config.get(c) for c in RUN_COLUMNS] + [json.dumps(config, default=str), kind])
+            self._conn.commit()
+
+    def add_scenario(self, run_id: str, result: dict) -> None:
+        """Store a run_scenario result with its transcript, requested tests and per-role cost."""
+        sid = result["scenario_id"]
+        transcript = result.get("transcript", [])
+        tests = [(run_id, sid, turn, test) for turn, role, text in transcript if role == "Doctor"
+                 for test in requested_tests(text)]
+        correct = None if result.get("correct") is None else int(result["correct"])
+        with self._lock:
+            # a re-run of the same scenario replaces its rows
+            for table in ("scenarios", "turns", "test_requests", "costs"):
+                self._conn.execute("DELETE FROM {} WHERE run_id = ? AND scenario_id = ?".format(table), (run_id, sid))
+            self._conn.execute(
+                "INSERT INTO scenarios (run_id, scenario_id, correct, diagnosis, correct_diagnosis, grade, turns, finished) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (run_id, sid, correct, result.get("diagnosis"), result.get("correct_diagnosis"), result.get("grade"),
+                 result.get("turns"), time.time()))
+            self._conn.executemany("INSERT INTO turns (run_id, scenario_id, turn, role, text) VALUES (?, ?, ?, ?, ?)",
+                                   [(run_id, sid, turn, role, text) for turn, role, text in transcript])
+            self._conn.executemany("INSERT INTO test_requests (run_id, scenario_id, turn, test) VALUES (?, ?, ?, ?)", tests)
+            self._conn.executemany(
+                "INSERT INTO costs (run_id, scenario_id, role, calls, cached_calls, prompt_tokens, completion_tokens, "
+                "cost_usd) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(run_id, sid, role, u["calls"], u["cached_calls"], u["prompt_tokens"], u["completion_tokens"],
+                  u["cost_usd"]) for role, u in result.get("cost", {}).items()])
+            self._conn.commit()
+
+    def execute(self, sql: str, params=()) -> List[dict]:
+        with self._lock:
+            cur = self._conn.execute(sql, params)
+            cols = [d[0] for d in cur.description] if cur.description else []
+            return [dict(zip(cols, row)) for row in cur.fetchall()]
+
+    def accuracy(self, by: List[str], where: str = "", params=()) -> List[dict]:
+        """Accuracy over graded scenarios, grouped by run columns."""
+        return self._grouped("COUNT(*) AS scenarios, SUM(s.correct IS NOT NULL) AS diagnosed, "
+                             "AVG(COALESCE(s.correct, 0)) AS accuracy", by, where, params)
+
+    def turns_to_diagnosis(self, by: List[str], where: str = "", params=()) -> List[dict]:
+        cond = "s.correct IS NOT NULL" + (" AND (" + where + ")" if where else "")
+        return self._grouped("COUNT(*) AS diagnosed, AVG(s.turns) AS mean_turns, MIN(s.turns) AS min_turns, "
+                             "MAX(s.turns) AS max_turns", by, cond, params)
+
+    def top_tests(self, limit: int = 20, where: str = "", params=()) -> List[dict]:
+        sql = ("SELECT t.test, COUNT(*) AS requests, COUNT(DISTINCT t.run_id || ':' || t.scenario_id) AS scenarios "
+               "FROM test_requests t JOIN runs r ON r.run_id = t.run_id WHERE r.kind = 'full'")
+        if where:
+            sql += " AND (" + where + ")"
+        return self.execute(sql + " GROUP BY t.test ORDER BY requests DESC LIMIT ?", tuple(params) + (limit,))
+
+    def costs(self, by: List[str], where: str = "", params=()) -> List[dict]:
+        """Spend grouped by run columns and/or "role"."""
+        keys = ", ".join("c.role" if c == "role" else "r." + c for c in by if c == "role" or self._check_column(c))
+        sql = ("SELECT {}SUM(c.calls) AS calls, SUM(c.prompt_tokens) AS prompt_tokens, "
+               "SUM(c.completion_tokens) AS completion_tokens, SUM(c.cost_usd) AS cost_usd, "
+               "SUM(c.cost_usd) / COUNT(DISTINCT c.run_id || ':' || c.scenario_id) AS cost_per_scenario "
+               "FROM costs c JOIN runs r ON r.run_id = c.run_id").format(keys + ", " if keys else "")
+        if where:
+            sql += " WHERE " + where
+        if keys:
+            sql += " GROUP BY {0} ORDER BY {0}".format(keys)
+        return self.execute(sql, params)
+
+    def scenario_history(self, dataset: str, doctor_llm: str = None) -> Dict[int, dict]:
+        """Mean turns and tokens per scenario over earlier runs, {scenario_id: {"turns", "tokens", "runs"}}."""
+        sql = ("SELECT s.scenario_id, COUNT(*) AS runs, AVG(s.turns) AS turns, AVG(c.tokens) AS tokens "
+               "FROM scenarios s JOIN runs r ON r.run_id = s.run_id "
+               "LEFT JOIN (SELECT run_id, scenario_id, SUM(prompt_tokens + completion_tokens) AS tokens "
+               "FROM costs GROUP BY run_id, scenario_id) c ON c.run_id = s.run_id AND c.scenario_id = s.scenario_id "
+               "WHERE r.dataset = ? AND s.turns IS NOT NULL AND r.kind = 'full'")
+        params = [dataset]
+        if doctor_llm is not None:
+            sql += " AND r.doctor_llm = ?"
+            params.append(doctor_llm)
+        rows = self.execute(sql + " GROUP BY s.scenario_id", params)
+        return {r["scenario_id"]: {"turns": r["turns"], "tokens": r["tokens"], "runs": r["runs"]} for r in rows}
+
+    @staticmethod
+    def _check_column(col) -> bool:
+        if col not in RUN_COLUMNS + ["run_id"]:
+            raise ValueError("Cannot group by {}".format(col))
+        return True
+
+    def _grouped(self, aggregates: str, by: List[str], where: str, params) -> List[dict]:
+        for col in by:
+            self._check_column(col)
+        keys = ", ".join("r." + c for c in by)
+        # prefix runs are partial dialogues, their outcomes are already in the forked runs
+        sql = "SELECT {}{} FROM scenarios s JOIN runs r ON r.run_id = s.run_id WHERE r.kind = 'full'".format(
+            keys + ", " if keys else "", aggregates)
+        if where:
+            sql += " AND (" + where + ")"
+        if keys:
+            sql += " GROUP BY {0} ORDER BY {0}".format(keys)
+        return self.execute(sql, params)
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def _print_rows(rows: List[dict]) -> None:
+    if not rows:
+        print("(no rows)")
+        return
+    cols = list(rows[0].keys())
+    fmt = lambda v: "{:.3f}".format(v) if isinstance(v, float) else str(v)
+    widths = [max(len(c), *(len(fmt(r[c])) for r in rows)) for c in cols]
+    print("  ".join(c.ljust(w) for c, w in zip(cols, widths)))
+    for r in rows:
+        print("  ".join(fmt(r[c]).ljust(w) for c, w in zip(cols, widths)))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Aggregate queries over the run results database")
+    parser.add_argument("query", choices=["accuracy", "turns", "tests", "costs", "runs", "sql"])
+    parser.add_argument("--db", type=str, default="results.sqlite")
+    parser.add_argument("--by", type=str, default="doctor_llm,doctor_bias,dataset",
+                        help="Run columns to group by: " + ",".join(RUN_COLUMNS + ["run_id"]) + " (and role for costs)")
+    parser.add_argument("--where", type=str, default="", help="SQL filter on s.* (scenarios), r.* (runs) or t.* (tests)")
+    parser.add_argument("--top", type=int, default=20, help="Rows for the tests query")
+    parser.add_argument("--sql", type=str, default="", help="Raw SELECT for the sql query")
+    args = parser.parse_args()
+
+    db = ResultsDB(args.db)
+    by = [c.strip() for c in args.by.split(",") if c.strip()]
+    if args.query == "accuracy":
+        _print_rows(db.accuracy(by, args.where))
+    elif args.query == "turns":
+        _print_rows(db.turns_to_diagnosis(by, args.where))
+    elif args.query == "costs":
+        _print_rows(db.costs(by, args.where))
+    elif args.query == "tests":
+        _print_rows(db.top_tests(args.top, args.where))
+    elif args.query == "runs":
+        _print_rows(db.execute("SELECT run_id, kind, started, {} FROM runs ORDER BY started".format(", ".join(RUN_COLUMNS))))
+    else:
+        _print_rows(db.execute(args.sql))
@@ -1,4 +1,4 @@
-import random, json
+import random, json, threading
 
 class ScenarioMedQA:
     def __init__(self, scenario_dict) -> None:
@@ -185,4 +185,24 @@ class ScenarioLoaderNEJM:
 
     def get_scenario(self, id):
         if id is None: return self.sample_scenario()
-        return self.scenarios[id]
\ No newline at end of file
+        return self.scenarios[id]
+
+# Shared scenario store: each dataset file is parsed once per process and the
+# loader is reused by every run, sweep cell and worker thread.
+_SCENARIO_LOADERS = {
+    "MedQA": ScenarioLoaderMedQA,
+    "MedQA_Ext": ScenarioLoaderMedQAExtended,
+    "NEJM": ScenarioLoaderNEJM,
+    "NEJM_Ext": ScenarioLoaderNEJMExtended,
+    "MIMICIV": ScenarioLoaderMIMICIV,
+}
+_loaded = {}
+_loaded_lock = threading.Lock()
+
+def get_scenario_loader(dataset):
+    if dataset not in _SCENARIO_LOADERS:
+        raise Exception("Dataset {} does not exist".format(str(dataset)))
+    with _loaded_lock:
+        if dataset not in _loaded:
+            _loaded[dataset] = _SCENARIO_LOADERS[dataset]()
+        return _loaded[dataset]
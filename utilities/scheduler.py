@@ -0,0 +1,135 @@
+import heapq, json, threading
+from queue import Queue
+
+# Makespan-aware scheduling of concurrent scenario runs.
+# Every job gets an estimated cost in turns: the mean turn count of the same
+# scenario in earlier runs of the results database (weighted by how token-heavy
+# those turns were), or, without history, the scenario's size relative to the
+# dataset average. Jobs are dealt longest-first onto per-worker queues, each
+# worker runs its longest job next and a worker that runs dry steals the
+# longest job queued on the most loaded worker, so the long 20-turn dialogues
+# start early instead of becoming stragglers at the end of the run.
+
+
+def scenario_size(scenario) -> int:
+    return len(json.dumps(getattr(scenario, "scenario_dict", {}), default=str))
+
+
+def estimate_costs(jobs, loaders, results=None):
+    """
+    Estimated cost in turns of each (cfg, scenario_id) job. `loaders` maps
+    dataset -> scenario loader, `results` is an optional ResultsDB.
+    """
+    history = {}
+    datasets = {}
+    for cfg, sid in jobs:
+        key = (cfg.dataset, cfg.doctor_llm)
+        if key not in history:
+            history[key] = results.scenario_history(cfg.dataset, cfg.doctor_llm) if results is not None else {}
+        if cfg.dataset not in datasets:
+            everything = results.scenario_history(cfg.dataset) if results is not None else {}
+            turns = [h["turns"] for h in everything.values()]
+            tokens = [h["tokens"] / h["turns"] for h in everything.values() if h["tokens"] and h["turns"]]
+            loader = loaders[cfg.dataset]
+            datasets[cfg.dataset] = {
+                "history": everything,
+                "mean_turns": sum(turns) / len(turns) if turns else None,
+                "tokens_per_turn": sum(tokens) / len(tokens) if tokens else None,
+                "mean_size": sum(scenario_size(s) for s in loader.scenarios) / max(loader.num_scenarios, 1),
+            }
+
+    costs = []
+    for cfg, sid in jobs:
+        ds = datasets[cfg.dataset]
+        past = history[(cfg.dataset, cfg.doctor_llm)].get(sid) or ds["history"].get(sid)
+        if past is not None:
+            cost = past["turns"]
+            if past["tokens"] and ds["tokens_per_turn"]:
+                # long prompts (many test results in the history) make turns slower
+                cost = past["tokens"] / ds["tokens_per_turn"]
+        else:
+            mean_turns = ds["mean_turns"] or cfg.total_inferences / 2
+            size = scenario_size(loaders[cfg.dataset].get_scenario(id=sid))
+            cost = mean_turns * size / ds["mean_size"] if ds["mean_size"] else mean_turns
+        costs.append(max(float(cost), 1.0))
+    return costs
+
+
+def makespan_bound(costs, workers) -> float:
+    """No schedule of these jobs on `workers` workers can finish faster than this."""
+    if not costs:
+        return 0.0
+    return max(max(costs), sum(costs) / workers)
+
+
+class LongestFirstPool:
+    """
+    Runs jobs on `max_workers` threads, longest estimated cost first, with work
+    stealing between the per-worker queues. Jobs listed in `after[i]` are held
+    back until job i has finished and then queued on the worker that ran it.
+    """
+
+    def __init__(self, max_workers=8):
+        self.max_workers = max_workers
+        self.steals = 0
+
+    def run(self, jobs, costs, fn, after=None):
+        """Yields (job, result, error) in completion order."""
+        after = after or {}
+        held = {i for deps in after.values() for i in deps}
+        n = self.max_workers
+        queues = [[] for _ in range(n)]
+        load = [0.0] * n
+        for i in sorted((i for i in range(len(jobs)) if i not in held), key=lambda i: -costs[i]):
+            w = min(range(n), key=load.__getitem__)
+            heapq.heappush(queues[w], (-costs[i], i))
+            load[w] += costs[i]
+        state = {"held": len(held)}
+        cond = threading.Condition()
+        finished = Queue()
+
+        def _take(w):
+            with cond:
+                while True:
+                    if queues[w]:
+                        owner = w
+                    else:
+                        owner = max(range(n), key=load.__getitem__)
+                        if not queues[owner]:
+                            if state["held"] == 0:
+                                return None
+                            # everything left waits on a running job
+                            cond.wait()
+                            continue
+                        self.steals += 1
+                    _, i = heapq.heappop(queues[owner])
+                    load[owner] -= costs[i]
+                    return i
+
+        def _release(w, i):
+            with cond:
+                for j in after.get(i, []):
+                    heapq.heappush(queues[w], (-costs[j], j))
+                    load[w] += costs[j]
+                    state["held"] -= 1
+                cond.notify_all()
+
+        def _worker(w):
+            while True:
+                i = _take(w)
+                if i is None:
+                    return
+                try:
+                    item = (jobs[i], fn(jobs[i]), None)
+                except BaseException as e:
+                    item = (jobs[i], None, e)
+                _release(w, i)
+                finished.put(item)
+
+        threads = [threading.Thread(target=_worker, args=(w,), daemon=True) for w in range(n)]
+        for t in threads:
+            t.start()
+        for _ in range(len(jobs)):
+            yield finished.get()
+        for t in threads:
+            t.join()
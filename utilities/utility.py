@@ -1,17 +1,105 @@
-import anthropic
-from transformers import pipeline
-import openai, re, time, json, replicate, os
+import importlib, re, time, json, os, sys
+
+
+class _LazyModule:
+    # provider SDKs are imported on first use, so a run only pays for the backends it selects
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(importlib.import_module(self._name), attr)
+
+
+openai = _LazyModule("openai")
+anthropic = _LazyModule("anthropic")
+replicate = _LazyModule("replicate")
 
 llama2_url = "meta/llama-2-70b-chat"
 llama3_url = "meta/meta-llama-3-70b-instruct"
 mixtral_url = "mistralai/mixtral-8x7b-instruct-v0.1"
 
+def backend_module(model_str):
+    if model_str.startswith("HF_"):
+        return "utilities.local_backend"
+    if model_str == "claude3.5sonnet":
+        return "anthropic"
+    if model_str in ["llama-2-70b-chat", "mixtral-8x7b", "llama-3-70b-instruct"]:
+        return "replicate"
+    return "openai"
+
+# optional utilities.response_cache.ResponseCache shared by every query_model call
+_response_cache = None
+
+def set_response_cache(cache):
+    global _response_cache
+    _response_cache = cache
+
+# optional utilities.cost_tracker.CostTracker recording every query_model call
+_cost_tracker = None
+
+def set_cost_tracker(tracker):
+    global _cost_tracker
+    _cost_tracker = tracker
+
+def get_cost_tracker():
+    return _cost_tracker
+
+# optional utilities.metrics.Metrics receiving request latencies, retries and cache hits
+_metrics = None
+
+def set_metrics(metrics):
+    global _metrics
+    _metrics = metrics
+
+def get_metrics():
+    return _metrics
+
+# optional utilities.image_cache.ImageCache, images are then sent inline from local files
+_image_cache = None
+
+def set_image_cache(cache):
+    global _image_cache
+    _image_cache = cache
+
+def image_url_for(scene, model_str):
+    if _image_cache is None:
+        return scene.image_url
+    try:
+        return _image_cache.data_url(scene.image_url, model_str)
+    except Exception:
+        if _image_cache.offline_dir:
+            raise
+        # not cached and the download failed: let the provider try the remote URL
+        return scene.image_url
+
+def backend_label(module_name):
+    return "local" if module_name == "utilities.local_backend" else module_name
+
+def _token_usage(response, message, prompt_text, answer):
+    # provider-reported usage when available, otherwise an estimate
+    from utilities.cost_tracker import estimate_tokens
+    if isinstance(response, dict) and response.get("usage"):
+        return response["usage"]["prompt_tokens"], response["usage"]["completion_tokens"]
+    if message is not None and getattr(message, "usage", None) is not None:
+        return message.usage.input_tokens, message.usage.output_tokens
+    return estimate_tokens(prompt_text), estimate_tokens(answer)
+
 def parse_big5(s: str):
     vals = [float(x.strip()) for x in s.split(',')]
     assert len(vals) == 5, "Use 5 floats for O,C,E,A,N"
     keys = ['O','C','E','A','N']
     return {k: v for k, v in zip(keys, vals)}
 
+def big5_string(profile: dict):
+    # {"openness": .., "conscientiousness": .., ...} -> "O,C,E,A,N" as used by parse_big5
+    return ",".join(str(profile[k]) for k in ["openness", "conscientiousness", "extraversion", "agreeableness", "neuroticism"])
+
+def load_personalities(json_path='IPIP-BIG5/personalities_config.json'):
+    # role -> "O,C,E,A,N"
+    with open(json_path, 'r') as f:
+        personalities = json.load(f)
+    return {role: big5_string(profile) for role, profile in personalities.items()}
+
 def persona_card(role_name: str, big5: dict):
     # keep it short; long persona dumps hurt token budget
     return (
@@ -70,27 +158,63 @@ def persona_card_from_json(json_path: str):
 
     return card
 
-def compare_results(diagnosis, correct_diagnosis, moderator_llm, mod_pipe):
-    answer = query_model(moderator_llm, "\nHere is the correct diagnosis: " + correct_diagnosis + "\n Here was the doctor dialogue: " + diagnosis + "\nAre these the same?", "You are responsible for determining if the corrent diagnosis and the doctor diagnosis are the same disease. Please respond only with Yes or No. Nothing else.")
+def grading_prompts(diagnosis, correct_diagnosis, personality=""):
+    system_prompt = "You are responsible for determining if the corrent diagnosis and the doctor diagnosis are the same disease. Please respond only with Yes or No. Nothing else."
+    if personality:
+        system_prompt += persona_card("Moderator", parse_big5(personality))
+    return "\nHere is the correct diagnosis: " + correct_diagnosis + "\n Here was the doctor dialogue: " + diagnosis + "\nAre these the same?", system_prompt
+
+def compare_results(diagnosis, correct_diagnosis, moderator_llm, mod_pipe, personality=""):
+    prompt, system_prompt = grading_prompts(diagnosis, correct_diagnosis, personality)
+    answer = query_model(moderator_llm, prompt, system_prompt, role="moderator")
     return answer.lower()
 
 def load_huggingface_model(model_name):
-    pipe = pipeline("text-generation", model=model_name, device_map="auto")
-    return pipe
+    # shared per-process server, also used by query_model for "HF_<model_name>"
+    from utilities.local_backend import get_local_model
+    return get_local_model(model_name)
+
+def inference_huggingface(prompt, pipe, system_prompt="", max_tokens=100, conversation=None):
+    return pipe.generate(system_prompt, prompt, max_tokens, conversation)
+
+def kv_reuse(model_str) -> bool:
+    """True if `model_str` is a local model that keeps each agent dialogue's KV cache between turns."""
+    return (model_str.startswith("HF_") and "utilities.local_backend" in sys.modules
+            and sys.modules["utilities.local_backend"].kv_reuse_enabled())
 
-def inference_huggingface(prompt, pipe):
-    response = pipe(prompt, max_new_tokens=100)[0]["generated_text"]
-    response = response.replace(prompt, "")
-    return response
+def end_conversation(conversation):
+    # frees the KV cache local models keep for a finished agent dialogue
+    if conversation is not None and "utilities.local_backend" in sys.modules:
+        sys.modules["utilities.local_backend"].release_conversation(conversation)
 
 def query_model(model_str, prompt, system_prompt, tries=30, timeout=20.0, image_requested=False, scene=None,
-                max_prompt_len=2 ** 14, clip_prompt=False, max_tokens=200):
+                max_prompt_len=2 ** 14, clip_prompt=False, max_tokens=200, conversation=None, role=None):
     if model_str not in ["gpt4", "gpt3.5", "gpt4o", 'llama-2-70b-chat', "mixtral-8x7b", "gpt-4o-mini",
-                         "llama-3-70b-instruct", "gpt4v", "claude3.5sonnet", "o1-preview"] and "_HF" not in model_str:
+                         "llama-3-70b-instruct", "gpt4v", "claude3.5sonnet", "o1-preview"] and not model_str.startswith("HF_"):
         raise Exception("No model by the name {}".format(model_str))
-    for _ in range(tries):
-        if clip_prompt: prompt = prompt[:max_prompt_len]
+    backend = backend_module(model_str)
+    # clip first, the cache key must describe the prompt that is actually sent
+    if clip_prompt: prompt = prompt[:max_prompt_len]
+    cache_key = None
+    if _response_cache is not None:
+        cache_key = _response_cache.make_key(model_str, prompt, system_prompt, max_tokens,
+                                             scene.image_url if image_requested else None)
+        cached = _response_cache.get(cache_key)
+        if cached is not None:
+            if _cost_tracker is not None:
+                _cost_tracker.record(model_str, 0, 0, role=role, cached=True)
+            if _metrics is not None:
+                _metrics.observe_request(backend_label(backend), cached=True)
+            return cached
+    # outside the retry loop: neither a missing SDK, a spent budget nor a missing offline image is transient
+    importlib.import_module(backend)
+    if _cost_tracker is not None:
+        _cost_tracker.check()
+    image_url = image_url_for(scene, model_str) if image_requested else None
+    for attempt in range(tries):
         try:
+            response = message = None
+            started = time.time()
             if image_requested:
                 messages = [
                     {"role": "system", "content": system_prompt},
@@ -99,7 +223,7 @@ def query_model(model_str, prompt, system_prompt, tries=30, timeout=20.0, image_
                          {"type": "text", "text": prompt},
                          {"type": "image_url",
                           "image_url": {
-                              "url": "{}".format(scene.image_url),
+                              "url": image_url,
                           },
                           },
                      ]}, ]
@@ -132,7 +256,7 @@ def query_model(model_str, prompt, system_prompt, tries=30, timeout=20.0, image_
                         max_tokens=max_tokens,
                     )
                 answer = response["choices"][0]["message"]["content"]
-            if model_str == "gpt4":
+            elif model_str == "gpt4":
                 messages = [
                     {"role": "system", "content": system_prompt},
                     {"role": "user", "content": prompt}]
@@ -233,14 +357,20 @@ def query_model(model_str, prompt, system_prompt, tries=30, timeout=20.0, image_
                         "max_new_tokens": max_tokens})
                 answer = ''.join(output)
                 answer = re.sub(r"\s+", " ", answer)
-            elif "HF_" in model_str:
-                input_text = system_prompt + prompt
-                # if self.pipe is None:
-                #    self.pipe = load_huggingface_model(self.backend.replace("HF_", ""))
-                raise Exception("Sorry, fixing TODO :3")  # inference_huggingface(input_text, self.pipe)
+            elif model_str.startswith("HF_"):
+                answer = inference_huggingface(prompt, load_huggingface_model(model_str[len("HF_"):]),
+                                               system_prompt, max_tokens, conversation)
+            if _metrics is not None:
+                _metrics.observe_request(backend_label(backend), time.time() - started)
+            if _cost_tracker is not None:
+                _cost_tracker.record(model_str, *_token_usage(response, message, system_prompt + prompt, answer), role=role)
+            if cache_key is not None:
+                _response_cache.put(cache_key, model_str, answer)
             return answer
 
         except Exception as e:
+            if _metrics is not None:
+                _metrics.observe_error(backend_label(backend), e, retrying=attempt < tries - 1)
             time.sleep(timeout)
             continue
     raise Exception("Max retries: timeout")